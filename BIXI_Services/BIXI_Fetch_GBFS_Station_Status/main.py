@@ -1,17 +1,19 @@
 import json
 import boto3
-import os
+import base64
+import hashlib
+import io
 import pandas as pd
 import pytz
 from datetime import datetime
 from urllib.request import Request, urlopen
 
+# Set up S3, reused between the invocations of a warm container
+s3 = boto3.client('s3')
 
-def lambda_handler(event, context):
-    s3 = boto3.client('s3')
 
+def lambda_handler(event, context):
     bucket_name = event['bucket_name']
-    temp_file_path = event.get('file_path', '/tmp/file.parquet')
 
     eastern = pytz.timezone('America/Toronto')
     now = datetime.now(eastern)
@@ -33,25 +35,34 @@ def lambda_handler(event, context):
     #Create dataframe with only the stations status
     df = pd.DataFrame(data_dict["data"]["stations"])
 
-    # Save Dataframe 
-    df.to_parquet(temp_file_path, compression="gzip")
+    # Serialize the Dataframe in memory
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, compression="gzip")
 
     # Define S3 object name
     s3_file = f'{folder_name}/gbfs_data_station_status_{fetch_time_unix}.parquet'
 
     try:
-        s3.upload_file(temp_file_path, bucket_name, s3_file)
+        put_parquet_buffer(bucket_name, s3_file, buffer)
         print(f'Successfully stored {s3_file} in S3.')
     except Exception as e:
         print(f"Failed to upload to S3: {e}")
         return
-    finally:
-        # Always try to remove the file from /tmp, even if upload fails
-        try:
-            os.remove(temp_file_path)
-        except Exception as e:
-            print(f"Failed to delete temporary file: {e}")
-    
+
+
+def put_parquet_buffer(bucket_name, key, buffer, metadata=None):
+    """
+    Store a Parquet file serialized in memory with a single put_object, without going through /tmp. The SHA-256
+    checksum is computed before the request so S3 validates the object without a second pass on the data.
+    :param bucket_name: Bucket name in S3
+    :param key: the key under which to store the file
+    :param buffer: io.BytesIO holding the Parquet file
+    :param metadata: optional user metadata of the object
+    """
+    body = buffer.getvalue()
+    checksum = base64.b64encode(hashlib.sha256(body).digest()).decode('ascii')
+    s3.put_object(Bucket=bucket_name, Key=key, Body=body, ChecksumSHA256=checksum, Metadata=metadata or {})
+
 
 # You can set the environment variables 'API_URL' and 'bucket_name' accordingly.
 # Example usage: lambda_handler({'bucket_name': 'my-s3-bucket'}, None)
@@ -1,4 +1,8 @@
 import boto3 #ASSURER VOUS QU'IL NE SOIT PAS DANS LE REQUIREMENTS.TXT
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
 import pandas
 import polars as pl
 import fastparquet
@@ -11,15 +15,85 @@ import io
 
 s3 = boto3.client('s3')
 
+# Largest difference (seconds) between the fetch of a position and the scheduled arrival of the stop it is matched to.
+# The next day runs the same trip_ids, its positions are a day away from the schedule.
+MATCH_TOLERANCE = 7200
+
+# Columns of the snapshots of STM_Fetch_GTFS_VehiclePositions read by the intraday mode, with the dtypes of the daily
+# file (the snapshots keep the ids as strings)
+SNAPSHOT_DTYPES = {
+    'id': pl.Int32,
+    'timefetch': pl.Int64,
+    'vehicle_currentStatus': pl.Utf8,
+    'vehicle_currentStopSequence': pl.Int64,
+    'vehicle_occupancyStatus': pl.Utf8,
+    'vehicle_timestamp': pl.Int64,
+    'vehicle_trip_routeId': pl.Int64,
+    'vehicle_trip_tripId': pl.Int64,
+    'vehicle_vehicle_id': pl.Utf8,
+}
+# Hours of the next day in its head file, the rows fetched before <next day> HEAD_HOURS:00 (see
+# download_next_day_vehicle_positions). Copy of HEAD_HOURS in STM_Merge_Daily_GTFS_VehiclePositions/main.py, keep them
+# in sync
+HEAD_HOURS = 6
+
+# Trips after a shard matched in the first pass of get_next_matched_trip (twice as many in each pass after it)
+MATCH_LOOKAHEAD_TRIPS = 16
+# Seconds of snapshots read again before the cursor of the intraday mode: the key of a micro-batch file is the time of
+# its first snapshot, and a file can be uploaded after the next one. The positions already read are skipped by trip.
+INTRADAY_LOOKBACK = 300
+
 def lambda_handler(event, context):
 
     bucket_static_daily = event['daily_static_bucket']
     bucket_vehicle_positions_daily_merge = event['bucket_vehicle_positions_daily_merge']
     output_bucket = event['output_bucket']
     timezone_str = event.get('timezone', 'America/Montreal')  # Default to 'America/Montreal' if not specified
+    # 'daily' analyses the day before yesterday, 'backfill' a range of days, 'intraday' the new snapshots of the current
+    # service days and 'reconcile' replaces the intraday results of the day before yesterday by the daily analysis
+    mode = event.get('mode', 'daily')
+
+    # Ranges of trip_id analysed separately, the memory used is the one of a shard (see analyse_daily_stops)
+    shards = event.get('shards', 1)
 
     eastern = pytz.timezone(timezone_str)
 
+    if mode == 'intraday':
+        bucket_vehicle_positions = event['bucket_vehicle_positions']  # Snapshots of STM_Fetch_GTFS_VehiclePositions
+        now = datetime.now(eastern)
+        if 'date' in event:
+            service_days = [eastern.localize(datetime.strptime(event['date'], '%Y%m%d'))]
+            now_unix = None
+        else:
+            # The trips of yesterday running after midnight, until the last one is over
+            today = eastern.localize(datetime(now.year, now.month, now.day))
+            service_days = [today - timedelta(days=1), today]
+            now_unix = int(now.timestamp())
+        stops = {}
+        for service_day in service_days:
+            rows = intraday_daily_stops(bucket_static_daily, bucket_vehicle_positions, output_bucket, service_day,
+                                        timezone_str, now_unix)
+            if rows is not None:
+                stops[service_day.strftime('%Y-%m-%d')] = rows
+        return {
+            'statusCode': 200,
+            'body': f'{sum(stops.values())} stops finalized for {", ".join(stops) or "no service day"}.',
+            'stops': stops
+        }
+
+    if mode == 'backfill':
+        # Range of service days (Format YYYYMMDD, both included)
+        start_date = eastern.localize(datetime.strptime(event['start_date'], '%Y%m%d'))
+        end_date = eastern.localize(datetime.strptime(event['end_date'], '%Y%m%d'))
+        workers = event.get('workers', os.cpu_count())  # Default the available cores, days analysed at the same time
+        days = backfill_daily_stops(bucket_static_daily, bucket_vehicle_positions_daily_merge, output_bucket,
+                                    start_date, end_date, timezone_str, workers, shards)
+        return {
+            'statusCode': 200,
+            'body': f'{len(days)} days analysed from {event["start_date"]} to {event["end_date"]}.',
+            'days': days
+        }
+
     # Extract the date from the event, or use the current date in the specified timezone (Format YYYYMMDD)
     date_str = event.get('date', datetime.now(eastern).strftime('%Y%m%d'))
 
@@ -30,38 +104,210 @@ def lambda_handler(event, context):
     next_day = date_obj + timedelta(days=1)
 
     folder_name = date_obj.strftime('%Y/%m/%d')
-    folder_name_next_day = next_day.strftime('%Y/%m/%d')
-
-
     file_name = date_obj.strftime('%Y-%m-%d')
-    file_name_next_day = next_day.strftime('%Y-%m-%d')
-
-    # Define the name of the local files
-    local_static_file_name = f'/tmp/filtered_stop_times_{file_name}.parquet'
-    local_file_name = f'/tmp/Daily_merge_{file_name}.parquet'
-    local_file_name_next_day = f'/tmp/Daily_merge_{file_name_next_day}.parquet'
 
-    # Define the folder and file structure on S3
-    key_static = f'{folder_name}/filtered_stop_times/filtered_stop_times_{file_name}.parquet'
-    key = f'{folder_name}/Daily_GTFS_VehiclePosition_{file_name}.parquet'
-    key_next_day = f'{folder_name_next_day}/Daily_GTFS_VehiclePosition_{file_name_next_day}.parquet'
+    # Define the folder and file structure on S3, and the name of the local files
+    key_static, local_static_file_name = get_static_file(date_obj)
+    key, local_file_name = get_vehicle_positions_file(date_obj)
 
     # Download files locally
     local_path_static = download_file_to_tmp(bucket_static_daily, key_static, local_static_file_name)
     local_day_path = download_file_to_tmp(bucket_vehicle_positions_daily_merge, key, local_file_name)
-    local_next_day_path = download_file_to_tmp(bucket_vehicle_positions_daily_merge, key_next_day, local_file_name_next_day)
+    local_next_day_path = download_next_day_vehicle_positions(bucket_vehicle_positions_daily_merge, local_path_static,
+                                                              date_obj, next_day, timezone_str)
 
-    df = pl.read_parquet(local_day_path)
-    df_next_day = pl.read_parquet(local_next_day_path)
-    df_stop_times = pl.read_parquet(local_path_static)
+    analyse_daily_stops(date_obj, timezone_str, local_path_static, local_day_path, local_next_day_path,
+                        f'/tmp/data_stops_{file_name}.parquet', shards)
+
+    # Upload the final file back to S3
+    output_key = f'{folder_name}/data_stops_{file_name}.parquet'  # Set your output file path here
+    upload_file_from_tmp(f'/tmp/data_stops_{file_name}.parquet', output_bucket, output_key)
+
+    if mode == 'reconcile':
+        reconcile_intraday_stops(f'/tmp/data_stops_{file_name}.parquet', output_bucket, date_obj, timezone_str)
+
+    clean_tmp_folder()
+
+
+def get_static_file(date_obj):
+    """
+    :return: the key on S3 and the local path of the filtered stop_times of a day
+    """
+    file_name = date_obj.strftime('%Y-%m-%d')
+    return (f"{date_obj.strftime('%Y/%m/%d')}/filtered_stop_times/filtered_stop_times_{file_name}.parquet",
+            f'/tmp/filtered_stop_times_{file_name}.parquet')
+
+
+def get_vehicle_positions_file(date_obj):
+    """
+    :return: the key on S3 and the local path of the daily file of VehiclePositions of a day
+    """
+    file_name = date_obj.strftime('%Y-%m-%d')
+    return (f"{date_obj.strftime('%Y/%m/%d')}/Daily_GTFS_VehiclePosition_{file_name}.parquet",
+            f'/tmp/Daily_merge_{file_name}.parquet')
+
+
+def get_vehicle_positions_head_file(date_obj):
+    """
+    :return: the key on S3 and the local path of the head file of VehiclePositions of a day
+    """
+    file_name = date_obj.strftime('%Y-%m-%d')
+    return (f"{date_obj.strftime('%Y/%m/%d')}/Daily_GTFS_VehiclePosition_{file_name}_head.parquet",
+            f'/tmp/Daily_merge_{file_name}_head.parquet')
 
-    # Drop useless column
-    df_stop_times = df_stop_times.drop({'departure_time'})
-    # We create the new column 'arrival_time_unix' converting the time in UNIX.
-    df_stops_unix = adding_arrival_time_unix(df_stop_times, date_obj)
+
+def download_next_day_vehicle_positions(bucket, local_path_static, date_obj, next_day, timezone_str):
+    """
+    Download the VehiclePositions of the next day read by the analysis of a day. The positions fetched after the latest
+    arrival of the day plus MATCH_TOLERANCE are never matched: when it is before the end of the head of the next day,
+    the head file written by STM_Merge_Daily_GTFS_VehiclePositions is downloaded instead of the daily file. The head
+    has the rows fetched before its end, and the last row of each (trip, stop sequence) fetched after it, so the
+    positions of the analysis are compared to the same stop sequences as with the daily file, and its stops are the
+    same.
+    :param bucket: bucket of the daily files of VehiclePositions
+    :param local_path_static: local path of the filtered stop_times of the day
+    :param date_obj: the service day
+    :param next_day: the day after it
+    :param timezone_str: timezone of the agency
+    :return: local path of the head file, or of the daily file (False if the download failed)
+    """
+    latest_arrival_unix = (adding_arrival_time_unix(pl.scan_parquet(local_path_static), date_obj, timezone_str)
+                           .select(pl.col('arrival_time_unix').max()).collect().item())
+    head_end = pytz.timezone(timezone_str).localize(datetime(next_day.year, next_day.month, next_day.day, HEAD_HOURS))
+    if latest_arrival_unix is not None and latest_arrival_unix + MATCH_TOLERANCE < head_end.timestamp():
+        key, local_file_name = get_vehicle_positions_head_file(next_day)
+        local_path = download_file_to_tmp(bucket, key, local_file_name)
+        if local_path:
+            return local_path
+        # The days merged before the head files
+    key, local_file_name = get_vehicle_positions_file(next_day)
+    return download_file_to_tmp(bucket, key, local_file_name)
+
+
+def analyse_daily_stops(date_obj, timezone_str, local_path_static, local_day_path, local_next_day_path, output_path,
+                        shards=1):
+    """
+    Analyse the VehiclePositions of a service day against its stop_times and write the data_stops file.
+    :param date_obj: the service day
+    :param timezone_str: timezone of the agency
+    :param local_path_static: local path of the filtered stop_times of the day
+    :param local_day_path: local path of the daily file of VehiclePositions of the day
+    :param local_next_day_path: local path of the daily file (or of the head file) of VehiclePositions of the next day
+    :param output_path: local path of the data_stops file written
+    :param shards: number of ranges of trip_id analysed one after the other (see get_trip_ranges), the memory used is
+    the one of a shard
+    :return: output_path
+    """
+    if shards <= 1:
+        return analyse_stops_shard(date_obj, timezone_str, local_path_static, local_day_path, local_next_day_path,
+                                   output_path)
+
+    trip_ranges = get_trip_ranges(scan_vehicle_positions(local_day_path, local_next_day_path), shards)
+    root, ext = os.path.splitext(output_path)
+    shard_paths = [f'{root}_shard_{i}{ext}' for i in range(len(trip_ranges))]
+    for shard_path, trip_range in zip(shard_paths, trip_ranges):
+        analyse_stops_shard(date_obj, timezone_str, local_path_static, local_day_path, local_next_day_path, shard_path,
+                            trip_range)
+
+    # The shards are in the order of trip_id, the order of the analysis of all the trips
+    if shard_paths:
+        pl.concat([pl.scan_parquet(shard_path) for shard_path in shard_paths]).collect().write_parquet(output_path)
+    else:
+        analyse_stops_shard(date_obj, timezone_str, local_path_static, local_day_path, local_next_day_path,
+                            output_path)
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+    return output_path
+
+
+def scan_vehicle_positions(local_day_path, local_next_day_path):
+    """
+    :return: LazyFrame of the VehiclePositions of the day and of the next day (the trips running past midnight)
+    """
+    return pl.concat([pl.scan_parquet(local_day_path), pl.scan_parquet(local_next_day_path)])
+
+
+def get_trip_ranges(df_vehicle_positions, shards):
+    """
+    Split the trip_ids of the positions into ranges of about the same number of trips. The positions of a trip are
+    compared to the ones around them in the order of trip_id: the first one to the last position of the previous
+    trip (filter_daily_vehicle_position), the last one to the first matched position of the next trips
+    (calculate_offset_for_last_stop_sequence). A shard also reads the trip before its range (all the positions before
+    it for the first range, the ones without trip included), and the trips after it up to the first one with a
+    matched position (get_next_matched_trip), so its stops are the ones of the analysis of all the trips.
+    :param df_vehicle_positions: LazyFrame of the positions, as returned by scan_vehicle_positions
+    :param shards: number of ranges
+    :return: list of (first trip_id read or None for the first range, first trip_id, last trip_id), in the order of
+    trip_id
+    """
+    trip_ids = (df_vehicle_positions.select(pl.col('vehicle_trip_tripId').cast(pl.Int64).unique().drop_nulls().sort())
+                .collect().to_series().to_list())
+    bounds = sorted({len(trip_ids) * i // shards for i in range(shards + 1)})
+    return [(trip_ids[start - 1] if start else None, trip_ids[start], trip_ids[end - 1])
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def get_next_matched_trip(df_vehicle_positions, df_stop_times, date_obj, timezone_str, last):
+    """
+    Find the trip the last matched position of a range of trips is compared to: the first trip after the range with
+    a matched position. The next MATCH_LOOKAHEAD_TRIPS trips after the range are matched together in one pass (with
+    the trip before them, the first position of a trip is compared to the last one of the previous trip), and only
+    the columns used by the match are read. Without a matched trip among them, the pass is done again on twice as many
+    trips after them.
+    :param df_vehicle_positions: LazyFrame of the positions, as returned by scan_vehicle_positions
+    :param df_stop_times: LazyFrame of the stop_times of the day
+    :param last: last trip_id of the range
+    :return: trip_id of the first trip after last with a matched position, or last if there is none (the trips after
+    it are not compared to the range)
+    """
+    vehicle_trip_id = pl.col('vehicle_trip_tripId')
+    previous = last
+    count = MATCH_LOOKAHEAD_TRIPS
+    while True:
+        upper = (df_vehicle_positions.filter(vehicle_trip_id > previous)
+                 .select(vehicle_trip_id.unique().sort().head(count).max()).collect().item())
+        if upper is None:
+            return last
+        df_positions = rename_and_convert_columns(df_vehicle_positions.filter(
+            vehicle_trip_id.is_between(previous, upper)))
+        df_stops_unix = adding_arrival_time_unix(
+            df_stop_times.filter(pl.col('trip_id').is_between(previous, upper, closed='right')), date_obj, timezone_str)
+        matched = (select_matched_positions(df_positions, df_stops_unix).filter(pl.col('trip_id') > previous)
+                   .select(pl.col('trip_id').min()).collect().item())
+        if matched is not None:
+            return matched
+        previous = upper
+        count *= 2
+
+
+def analyse_stops_shard(date_obj, timezone_str, local_path_static, local_day_path, local_next_day_path, output_path,
+                        trip_range=None):
+    """
+    Analyse the VehiclePositions of a range of trips of a service day (see analyse_daily_stops) and write their stops.
+    :param trip_range: trip_ids read and written, as returned by get_trip_ranges (None: all the trips)
+    :return: output_path
+    """
+    # The files are scanned: the analysis is one lazy query, only the columns it uses are read
+    df_stop_times = pl.scan_parquet(local_path_static)
 
     # Merge the two DFs (current_day + next_day) of VehiclePositions
-    dfs_daily_vehicle_positions_merge = pl.concat([df, df_next_day], rechunk=True)
+    dfs_daily_vehicle_positions_merge = scan_vehicle_positions(local_day_path, local_next_day_path)
+    if trip_range is not None:
+        # The daily files are sorted by trip, the row groups of the other trips are skipped
+        first_read, first, last = trip_range
+        last_read = get_next_matched_trip(dfs_daily_vehicle_positions_merge, df_stop_times, date_obj, timezone_str,
+                                          last)
+        if first_read is None:
+            read_positions = (pl.col('vehicle_trip_tripId') <= last_read) | pl.col('vehicle_trip_tripId').is_null()
+            read_stop_times = pl.col('trip_id') <= last_read
+        else:
+            read_positions = pl.col('vehicle_trip_tripId').is_between(first_read, last_read)
+            read_stop_times = pl.col('trip_id').is_between(first_read, last_read)
+        dfs_daily_vehicle_positions_merge = dfs_daily_vehicle_positions_merge.filter(read_positions)
+        df_stop_times = df_stop_times.filter(read_stop_times)
+
+    # We create the new column 'arrival_time_unix' converting the time in UNIX.
+    df_stops_unix = adding_arrival_time_unix(df_stop_times, date_obj, timezone_str)
 
     # We rename a column and convert the type of others
     dfs_daily_vehicle_positions_merge = rename_and_convert_columns(dfs_daily_vehicle_positions_merge)
@@ -71,17 +317,56 @@ def lambda_handler(event, context):
     # We proceed with the analysis of the DATA based on the daily stop_times file provided
     df_processed = process_based_on_daily_static_files(dfs_daily_vehicle_positions_merge, df_stops_unix)
 
-    # We remove the duplicate rows
-    df_processed = (df_processed.unique(subset=['trip_id', 'vehicle_currentStopSequence'])
-                    .sort(['trip_id', 'vehicle_currentStopSequence', 'timefetch']))
+    df_final = select_stop_offsets(df_processed)
+    if trip_range is not None:
+        df_final = df_final.filter(pl.col('trip_id').is_between(first, last))
+    df_final.collect().write_parquet(output_path)
+    return output_path
+
+
+@contextlib.contextmanager
+def process_pool(workers):
+    """
+    Pool of processes sharing the cores of the machine. The pool needs POSIX semaphores (not available in Lambda):
+    with one worker, there is no pool (None) and the work is done by this process.
+    """
+    if workers <= 1:
+        yield None
+        return
+    # Polars sizes its thread pool when it is imported: the cores are shared between the processes
+    polars_max_threads = os.environ.get('POLARS_MAX_THREADS')
+    os.environ['POLARS_MAX_THREADS'] = str(max(1, (os.cpu_count() or 1) // workers))
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                      mp_context=multiprocessing.get_context('spawn'))
+    try:
+        yield executor
+    finally:
+        executor.shutdown()
+        if polars_max_threads is None:
+            del os.environ['POLARS_MAX_THREADS']
+        else:
+            os.environ['POLARS_MAX_THREADS'] = polars_max_threads
+
+
+def select_stop_offsets(df_processed):
+    """
+    Keep one row per stop, with the columns of the data_stops file.
+    :param df_processed: Dataframe (or LazyFrame) as returned by process_based_on_daily_static_files
+    :return: Dataframe (or LazyFrame) of the stops, in the order of df_processed
+    """
+    # We remove the duplicate rows, keeping the first position at each stop (the rows are still in the order of the sort)
+    df_processed = df_processed.unique(subset=['trip_id', 'vehicle_currentStopSequence'], keep='first',
+                                       maintain_order=True)
 
     df_processed = df_processed.with_columns(((pl.col('arrival_time_offset') + pl.col('departure_time_offset'))/2).alias('offset'))
 
-    # Select only the columns you want to keep from the right DataFrame
-    df_processed = df_processed.select([
+    # The columns of the stop_times were joined by process_based_on_daily_static_files, in the same order
+    df_final = df_processed.select([
         'trip_id',
-        'vehicle_currentStopSequence',
-        'vehicle_currentStatus',
+        'arrival_time',
+        'stop_id',
+        pl.col('vehicle_currentStopSequence').alias('stop_sequence'),
+        'arrival_time_unix',
         'id',
         'vehicle_occupancyStatus',
         'offset',
@@ -90,28 +375,336 @@ def lambda_handler(event, context):
         'departure_time_offset'
     ])
 
-    # Perform the join
-    df_final = df_stops_unix.join(
-        df_processed,
-        how='inner',
-        left_on=['trip_id', 'stop_sequence'],
-        right_on=['trip_id', 'vehicle_currentStopSequence']
-    )
-
-    # Drop a double column and rename some.
-    df_final = df_final.drop('vehicle_currentStatus')
+    # Rename some columns.
     df_final = df_final.rename({'id': 'vehicleID', 'vehicle_occupancyStatus': 'Current_Occupancy',
                                 'vehicle_trip_routeId': 'routeId'})
-    df_final = df_final.cast({'routeId': pl.Int64})
+    return df_final.cast({'routeId': pl.Int64})
 
-    df_final.write_parquet(f'/tmp/data_stops_{file_name}.parquet')
 
-    # Upload the final file back to S3
-    output_key = f'{folder_name}/data_stops_{file_name}.parquet'  # Set your output file path here
-    upload_file_from_tmp(f'/tmp/data_stops_{file_name}.parquet', output_bucket, output_key)
+def backfill_daily_stops(bucket_static_daily, bucket_vehicle_positions_daily_merge, output_bucket, start_date, end_date,
+                         timezone_str, workers, shards=1):
+    """
+    Analyse the service days from start_date to end_date, and upload their data_stops files. Each daily file of
+    VehiclePositions is downloaded once: the file of a day is also the next day of the day before, it is deleted when
+    the two days are analysed. The days are analysed by a pool of processes while the files of the next days are
+    downloaded. The pool needs POSIX semaphores (not available in Lambda): with one worker, the days are analysed by
+    this process.
+    :param bucket_static_daily: bucket of the filtered stop_times
+    :param bucket_vehicle_positions_daily_merge: bucket of the daily files of VehiclePositions
+    :param output_bucket: bucket of the data_stops files
+    :param start_date: first service day (localized)
+    :param end_date: last service day (localized)
+    :param timezone_str: timezone of the agency
+    :param workers: number of days analysed at the same time
+    :param shards: number of ranges of trip_id analysed one after the other for each day (see analyse_daily_stops)
+    :return: the days analysed (YYYY-MM-DD), in order
+    """
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    # Local path of the daily files of VehiclePositions (False if missing) and number of days still reading them
+    vehicle_positions_paths = {}
+    readers = {}
+    for day in days:
+        for date_obj in [day, day + timedelta(days=1)]:
+            readers[date_obj.date()] = readers.get(date_obj.date(), 0) + 1
+
+    def release(date_obj):
+        readers[date_obj.date()] -= 1
+        path = vehicle_positions_paths.get(date_obj.date())
+        if not readers[date_obj.date()] and path and os.path.exists(path):
+            os.remove(path)
+
+    def download_vehicle_positions(date_obj):
+        if date_obj.date() not in vehicle_positions_paths:
+            key, local_file_name = get_vehicle_positions_file(date_obj)
+            vehicle_positions_paths[date_obj.date()] = download_file_to_tmp(bucket_vehicle_positions_daily_merge, key,
+                                                                            local_file_name)
+        return vehicle_positions_paths[date_obj.date()]
+
+    def finish(day, local_path_static, output_path, error):
+        os.remove(local_path_static)
+        release(day)
+        release(day + timedelta(days=1))
+        if error is not None:
+            print(f'Failed to analyse {day.strftime("%Y-%m-%d")}: {error}')
+            return None
+        upload_file_from_tmp(output_path, output_bucket, f"{day.strftime('%Y/%m/%d')}/{os.path.basename(output_path)}")
+        os.remove(output_path)
+        return day.strftime('%Y-%m-%d')
+
+    analysed = []
+    with process_pool(workers) as executor:
+        futures = {}
+        for day in days:
+            key_static, local_static_file_name = get_static_file(day)
+            local_path_static = download_file_to_tmp(bucket_static_daily, key_static, local_static_file_name)
+            local_day_path = download_vehicle_positions(day)
+            local_next_day_path = download_vehicle_positions(day + timedelta(days=1))
+            output_path = f"/tmp/data_stops_{day.strftime('%Y-%m-%d')}.parquet"
+            if not (local_path_static and local_day_path and local_next_day_path):
+                if local_path_static:
+                    os.remove(local_path_static)
+                release(day)
+                release(day + timedelta(days=1))
+                print(f'Skipping {day.strftime("%Y-%m-%d")}: missing file')
+                continue
+            args = (day, timezone_str, local_path_static, local_day_path, local_next_day_path, output_path, shards)
+            if executor is None:
+                try:
+                    analyse_daily_stops(*args)
+                    error = None
+                except Exception as e:
+                    error = e
+                analysed.append(finish(day, local_path_static, output_path, error))
+            else:
+                futures[executor.submit(analyse_daily_stops, *args)] = (day, local_path_static, output_path)
+                # At most two days per worker are downloaded ahead, the files of a long range don't fill /tmp
+                while len(futures) >= 2 * workers:
+                    done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        analysed.append(finish(*futures.pop(future), future.exception()))
+        for future in concurrent.futures.as_completed(futures):
+            analysed.append(finish(*futures[future], future.exception()))
+    return sorted(day for day in analysed if day is not None)
+
+
+def get_intraday_state_file(date_obj):
+    """
+    :return: the key on S3 and the local path of the state of the intraday analysis of a service day
+    """
+    file_name = date_obj.strftime('%Y-%m-%d')
+    return (f"{date_obj.strftime('%Y/%m/%d')}/intraday_state_{file_name}.parquet",
+            f'/tmp/intraday_state_{file_name}.parquet')
 
-    clean_tmp_folder()
 
+def get_intraday_cursor_file(date_obj):
+    """
+    :return: the key on S3 and the local path of the cursor of the intraday analysis of a service day: the time of the
+    last snapshot read. It is kept apart from the state, which is empty when no trip is running.
+    """
+    file_name = date_obj.strftime('%Y-%m-%d')
+    return (f"{date_obj.strftime('%Y/%m/%d')}/intraday_cursor_{file_name}.json",
+            f'/tmp/intraday_cursor_{file_name}.json')
+
+
+def get_intraday_partition_key(date_obj, hour_start_unix, suffix):
+    """
+    :return: the key on S3 of a file of the hourly partition of the intraday stops of a service day. The partition of
+    a local hour is named by the UNIX time of its start, so the two hours of the end of the DST have their own
+    partition.
+    """
+    return f"{date_obj.strftime('%Y/%m/%d')}/intraday/{hour_start_unix}/data_stops_{suffix}.parquet"
+
+
+def intraday_daily_stops(bucket_static_daily, bucket_vehicle_positions, output_bucket, service_day, timezone_str,
+                         now_unix=None):
+    """
+    Analyse the snapshots of VehiclePositions fetched since the last run for a service day, and append the stops
+    passed by the vehicles to the hourly partitions of the day. The state of the trips and the cursor of the snapshots
+    are kept on S3 between the runs (see advance_intraday_stops): the runs must not overlap, the function has a
+    reserved concurrency of 1 (template.yml).
+    :param bucket_static_daily: bucket of the filtered stop_times
+    :param bucket_vehicle_positions: bucket of the snapshots of STM_Fetch_GTFS_VehiclePositions
+    :param output_bucket: bucket of the intraday stops and of the state
+    :param service_day: the service day (localized)
+    :param timezone_str: timezone of the agency
+    :param now_unix: UNIX time of the run, the service day is skipped once all its trips are over (None: never skipped)
+    :return: the number of stops finalized, None if the service day is skipped
+    """
+    key_static, local_static_file_name = get_static_file(service_day)
+    local_path_static = download_file_to_tmp(bucket_static_daily, key_static, local_static_file_name)
+    if not local_path_static:
+        print(f'Skipping {service_day.strftime("%Y-%m-%d")}: missing stop_times')
+        return None
+    df_stops_unix = adding_arrival_time_unix(pl.read_parquet(local_path_static), service_day, timezone_str)
+    os.remove(local_path_static)
+    latest_arrival_unix = df_stops_unix['arrival_time_unix'].max()
+    if now_unix is not None and (latest_arrival_unix is None or now_unix > latest_arrival_unix + MATCH_TOLERANCE):
+        return None
+
+    key_state, local_state_file_name = get_intraday_state_file(service_day)
+    local_state_path = download_file_to_tmp(output_bucket, key_state, local_state_file_name)
+    if local_state_path:
+        df_state = pl.read_parquet(local_state_path)
+        os.remove(local_state_path)
+    else:
+        # First run of the service day
+        df_state = pl.DataFrame(schema=get_intraday_state_schema())
+
+    # The snapshots of the day, and the ones of the next day for the trips running after midnight, from the last
+    # snapshot read (the state written before the cursor has its positions)
+    key_cursor, local_cursor_file_name = get_intraday_cursor_file(service_day)
+    local_cursor_path = download_file_to_tmp(output_bucket, key_cursor, local_cursor_file_name)
+    if local_cursor_path:
+        with open(local_cursor_path) as f:
+            cursor = json.load(f)['timefetch']
+        os.remove(local_cursor_path)
+    else:
+        cursor = df_state['timefetch'].max()
+    snapshot_keys = []
+    for date_obj in [service_day, service_day + timedelta(days=1)]:
+        prefix = f"{date_obj.strftime('%Y/%m/%d')}/"
+        start_after = None if cursor is None else f'{prefix}STM_GTFS_VehiclePositions_{cursor - INTRADAY_LOOKBACK}'
+        snapshot_keys.extend(list_keys(bucket_vehicle_positions, prefix, start_after))
+    df_positions = read_snapshots(bucket_vehicle_positions, snapshot_keys)
+
+    df_stops, df_state = advance_intraday_stops(df_state, df_positions, df_stops_unix)
+
+    if not df_stops.is_empty():
+        # A file per run in the partitions, named by the last snapshot read
+        write_intraday_partitions(df_stops, output_bucket, service_day, df_positions['timefetch'].max(), timezone_str)
+    df_state.write_parquet(local_state_file_name)
+    upload_file_from_tmp(local_state_file_name, output_bucket, key_state)
+    os.remove(local_state_file_name)
+    cursor = max(filter(None, [cursor, df_positions['timefetch'].max()]), default=None)
+    if cursor is not None:
+        with open(local_cursor_file_name, 'w') as f:
+            json.dump({'timefetch': cursor}, f)
+        upload_file_from_tmp(local_cursor_file_name, output_bucket, key_cursor)
+        os.remove(local_cursor_file_name)
+    print(f'{len(snapshot_keys)} snapshots read for {service_day.strftime("%Y-%m-%d")}, {len(df_stops)} stops finalized')
+    return len(df_stops)
+
+
+def get_intraday_state_schema():
+    """
+    :return: the schema of the state of the intraday analysis: positions with the columns of the snapshots used by
+    the analysis, and 'open' (True for the positions of the stop where the vehicle is, False for the last position of
+    the trip)
+    """
+    schema = {('trip_id' if col == 'vehicle_trip_tripId' else col): dtype for col, dtype in SNAPSHOT_DTYPES.items()}
+    return {**schema, 'open': pl.Boolean}
+
+
+def read_snapshots(bucket, file_keys):
+    """
+    Download snapshot files of VehiclePositions and read the columns used by the analysis.
+    :param bucket: bucket of the snapshots
+    :param file_keys: keys of the snapshots (..._<timefetch>[.v<version>].parquet)
+    :return: Polars DataFrame with the columns of the state (without 'open'), in the order of the files
+    """
+    schema = get_intraday_state_schema()
+    del schema['open']
+    dfs = [pl.DataFrame(schema=schema)]
+    for file_key in file_keys:
+        local_path = download_file_to_tmp(bucket, file_key, f'/tmp/{os.path.basename(file_key)}')
+        if not local_path:
+            continue
+        df = pl.read_parquet(local_path)
+        os.remove(local_path)
+        # The single snapshots have the time of the fetch in their name only
+        timefetch = int(file_key.split('_')[-1].split('.')[0])
+        columns = [(pl.col(col) if col in df.columns else pl.lit(timefetch if col == 'timefetch' else None))
+                   .cast(dtype, strict=False).alias(col) for col, dtype in SNAPSHOT_DTYPES.items()]
+        dfs.append(df.select(columns).rename({'vehicle_trip_tripId': 'trip_id'}).select(list(schema)))
+    return pl.concat(dfs)
+
+
+def advance_intraday_stops(df_state, df_positions, df_stop_times_unix, tolerance=MATCH_TOLERANCE):
+    """
+    Advance the intraday analysis of a service day with new positions. The arrival and departure offsets of a stop are
+    final once the vehicle has a matched position at a further stop: all the positions of the stop are known, and the
+    next one (used by the offset of "IN_TRANSIT_TO"). The state keeps, for each trip, its last position (the stop
+    sequence and the status the next positions are compared to) and the matched positions of the stop where the
+    vehicle is. The trips are dropped from the state once they are over: their last stop is only in the daily analysis.
+    The positions are filtered and the offsets calculated like the daily analysis does, with the positions of each trip
+    read in order: a position fetched before the last one of its trip, or at an earlier stop, is skipped.
+    :param df_state: state returned by the previous call (schema of get_intraday_state_schema)
+    :param df_positions: new positions, as returned by read_snapshots
+    :param df_stop_times_unix: Dataframe of the stop_times of the service day, as returned by adding_arrival_time_unix
+    :param tolerance: largest difference in seconds between timefetch and arrival_time_unix
+    :return: Dataframe of the stops passed (columns of the data_stops file), and the new state
+    """
+    stop = ['trip_id', 'vehicle_currentStopSequence']
+    sort_columns = [*stop, 'timefetch']
+    state_columns = list(get_intraday_state_schema())
+    # Time of the last snapshot read, the trips are over once their window ends before it
+    cursor = pl.concat([df_state['timefetch'], df_positions['timefetch']]).max()
+
+    # The trips run again the next day with the same trip_id: only the positions around the schedule of the day
+    df_trip_windows = df_stop_times_unix.group_by('trip_id').agg(
+        (pl.col('arrival_time_unix').min() - tolerance).alias('window_start'),
+        (pl.col('arrival_time_unix').max() + tolerance).alias('window_end'))
+    df_last = df_state.filter(~pl.col('open'))
+    df_positions = (df_positions.join(df_trip_windows, on='trip_id')
+                    .filter(pl.col('timefetch').is_between(pl.col('window_start'), pl.col('window_end')))
+                    .join(df_last.select('trip_id', pl.col('timefetch').alias('last_timefetch'),
+                                         pl.col('vehicle_currentStopSequence').alias('last_stop_sequence')),
+                          on='trip_id', how='left')
+                    .filter(pl.col('last_timefetch').is_null() |
+                            ((pl.col('timefetch') > pl.col('last_timefetch')) &
+                             (pl.col('vehicle_currentStopSequence') >= pl.col('last_stop_sequence'))))
+                    .with_columns(pl.lit(False).alias('open'))
+                    .select(state_columns))
+
+    # The last position of the trip goes first, the new positions are compared to it
+    df = pl.concat([df_last.with_columns(pl.lit(True).alias('is_last')),
+                    df_positions.with_columns(pl.lit(False).alias('is_last'))]).sort(sort_columns)
+    # Repeated observations, suppressed from the daily file by STM_Merge_Daily_GTFS_VehiclePositions
+    repeated = pl.all_horizontal([(pl.col(col) == pl.col(col).shift(1).over('trip_id')).fill_null(False)
+                                  for col in ['vehicle_vehicle_id', 'vehicle_timestamp']])
+    df = df.filter(~repeated)
+    # Filtered like filter_daily_vehicle_position, the first position of a trip is a change of stop sequence
+    stop_sequence_changed = pl.col('vehicle_currentStopSequence').diff().over('trip_id').fill_null(1).ne(0)
+    df_new = df.filter(~pl.col('is_last') &
+                       ((stop_sequence_changed & (pl.col('vehicle_currentStatus') == 'IN_TRANSIT_TO')) |
+                        (pl.col('vehicle_currentStatus') == 'STOPPED_AT'))).select(state_columns)
+
+    # The positions of the stops where the vehicles were, and the new ones, matched to the stop_times
+    df_matched = match_stop_times(pl.concat([df_state.filter(pl.col('open')), df_new]).sort(sort_columns),
+                                  df_stop_times_unix, tolerance)
+    df_matched = df_matched.filter(pl.col('vehicle_timestamp').is_not_null()).with_columns(
+        (pl.col('vehicle_currentStopSequence') == pl.col('vehicle_currentStopSequence').max().over('trip_id'))
+        .alias('open'))
+
+    df_stops = select_stop_offsets(calculate_stop_offsets(df_matched).filter(~pl.col('open')))
+
+    # New state: the last position of the trips not over, and the positions of the stops not passed yet
+    df_last = df.group_by('trip_id', maintain_order=True).last().select(state_columns)
+    df_state = pl.concat([df_last, df_matched.filter(pl.col('open')).select(state_columns)])
+    df_state = (df_state.join(df_trip_windows, on='trip_id')
+                .filter(pl.col('window_end') >= cursor).select(state_columns).sort(sort_columns))
+    return df_stops, df_state
+
+
+def write_intraday_partitions(df_stops, output_bucket, service_day, suffix, timezone_str='America/Montreal'):
+    """
+    Write the stops in the hourly partitions of the intraday stops of a service day, by local hour of their scheduled
+    arrival: one file per partition, named by the suffix.
+    :param timezone_str: timezone of the agency, the hours of the partitions are the ones of its clock
+    :return: the keys written
+    """
+    # Truncated in the timezone, not in UTC: the offset of a timezone is not always a whole number of hours
+    df_stops = df_stops.with_columns(pl.from_epoch('arrival_time_unix').dt.replace_time_zone('UTC')
+                                     .dt.convert_time_zone(timezone_str).dt.truncate('1h').dt.epoch('s')
+                                     .alias('hour_start_unix'))
+    keys = []
+    for df_hour in df_stops.partition_by('hour_start_unix', maintain_order=True):
+        key = get_intraday_partition_key(service_day, df_hour['hour_start_unix'][0], suffix)
+        local_file_name = f'/tmp/{key.replace("/", "_")}'
+        df_hour.drop('hour_start_unix').write_parquet(local_file_name)
+        upload_file_from_tmp(local_file_name, output_bucket, key)
+        os.remove(local_file_name)
+        keys.append(key)
+    return keys
+
+
+def reconcile_intraday_stops(output_path, output_bucket, date_obj, timezone_str='America/Montreal'):
+    """
+    Replace the intraday stops of a service day by the stops of its daily analysis, and delete its intraday state and
+    cursor: the hourly partitions of the day then hold the rows of its data_stops file.
+    :param output_path: local path of the data_stops file of the day
+    :param output_bucket: bucket of the intraday stops
+    :param date_obj: the service day
+    :param timezone_str: timezone of the agency
+    """
+    stale_keys = list_keys(output_bucket, f"{date_obj.strftime('%Y/%m/%d')}/intraday/")
+    # The partitions are written before the intraday files are deleted, a reader never misses a stop
+    keys = write_intraday_partitions(pl.read_parquet(output_path), output_bucket, date_obj, 'daily', timezone_str)
+    for key in stale_keys:
+        if key not in keys:
+            delete_file_from_s3(output_bucket, key)
+    delete_file_from_s3(output_bucket, get_intraday_state_file(date_obj)[0])
+    delete_file_from_s3(output_bucket, get_intraday_cursor_file(date_obj)[0])
 
 
 def download_file_to_tmp(bucket, key, local_file_name):
@@ -153,6 +746,36 @@ def upload_file_from_tmp(local_file_name, bucket, key):
         return False
 
 
+def list_keys(bucket, prefix, start_after=None):
+    """
+    :param bucket: Bucket name in S3
+    :param prefix: prefix of the keys
+    :param start_after: the keys listed come after this one (in the order of S3), None to list them all
+    :return: the keys of the Parquet files under the prefix, in the order of S3
+    """
+    s3 = boto3.client('s3')
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after is not None:
+        kwargs['StartAfter'] = start_after
+    keys = []
+    for page in s3.get_paginator('list_objects_v2').paginate(**kwargs):
+        keys.extend(content['Key'] for content in page.get('Contents', []) if content['Key'].endswith('.parquet'))
+    return keys
+
+
+def delete_file_from_s3(bucket, key):
+    """
+    :return: True if the file was deleted (or did not exist), False otherwise.
+    """
+    s3 = boto3.client('s3')
+    try:
+        s3.delete_object(Bucket=bucket, Key=key)
+        return True
+    except Exception as e:
+        print(f'Error deleting file {bucket}/{key}: {e}')
+        return False
+
+
 def clean_tmp_folder():
     tmp_dir = '/tmp'
     for item in os.listdir(tmp_dir):
@@ -166,51 +789,65 @@ def clean_tmp_folder():
             print(f"Failed to delete {item_path}. Reason: {e}")
 
 
-def adding_arrival_time_unix(df_temp, date_obj):
+def adding_arrival_time_unix(df_temp, date_obj, timezone_str='America/Montreal'):
     """
-    Create a new column "arrival_time_unix", it uses the existing column "arrival_time" and using the day passed in
-    the event convert that time in a UNIX value for the timezone (also given in the event). In case where the value is
-    greater than 23:59:59, we increment the date by 1. ex: (event date: 2023-12-01) 25:54:00 -> 1:54:00 AM of 2023-12-02
-    and then convert that to a UNIX value
-    :param df_temp: Dataframe to apply the addition to
-    :return: Dataframe with the modification sorted by trip_id and arrival_time_unix
+    Create a new column "arrival_time_unix", it uses the existing column "arrival_time" and the service day passed in
+    the event to convert that time in a UNIX value for the timezone (also given in the event). GTFS times are measured
+    from "noon minus 12h" of the service day, so a value greater than 23:59:59 falls on the next day.
+    ex: (event date: 2023-12-01) 25:54:00 -> 1:54:00 AM of 2023-12-02 and then convert that to a UNIX value
+    :param df_temp: Dataframe (or LazyFrame) to apply the addition to
+    :param date_obj: the service day
+    :param timezone_str: timezone of the agency
+    :return: Dataframe (or LazyFrame) with the modification, in the order of df_temp
     """
-    df_temp = df_temp.with_columns(df_temp['arrival_time'].str.split_exact(':', 2).struct.
-                                         rename_fields(["hours", "minutes", "seconds"])
-                                         .alias('time_split')).unnest('time_split')
+    dtype = df_temp.schema['arrival_time']
+    df_temp = df_temp.with_columns(gtfs_time_to_unix('arrival_time', date_obj, timezone_str, dtype).alias('arrival_time_unix'))
+    if dtype in pl.INTEGER_DTYPES:
+        # The static files store the times in seconds, the output keeps the HH:MM:SS of the feed
+        df_temp = df_temp.with_columns(seconds_to_gtfs_time('arrival_time'))
 
-    # Convert 'hours', 'minutes', and 'seconds' to integers
-    df_temp = df_temp.with_columns([
-        pl.col("hours").cast(pl.Int32),
-        pl.col("minutes").cast(pl.Int32),
-        pl.col("seconds").cast(pl.Int32)
-    ])
+    return df_temp.select(pl.col('trip_id'), pl.col('arrival_time'), pl.col('stop_id'), pl.col('stop_sequence'),
+                          pl.col('arrival_time_unix'))
 
-    # Adjust for hours >= 24 and calculate additional days
-    df_temp = df_temp.with_columns([
-        (pl.col("hours") % 24).alias("adjusted_hours"),
-        (pl.col("hours") / 24).floor().cast(pl.Int32).alias("additional_days")
-    ])
 
-    # Extract year, month, and day from the localized date_obj
-    year, month, day = date_obj.year, date_obj.month, date_obj.day
-
-    # Create DateTime objects and convert to UNIX timestamps
-    df_temp = df_temp.with_columns(
-        (pl.datetime(year, month, day, "adjusted_hours", "minutes", "seconds", time_zone='America/Montreal') +
-         pl.duration(days="additional_days")).alias("datetime")
-    )
+def seconds_to_gtfs_time(column):
+    """
+    :return: Polars expression formatting seconds from "noon minus 12h" as a GTFS time (HH:MM:SS)
+    """
+    seconds = pl.col(column)
+    return pl.format('{}:{}:{}', *[part.cast(pl.Utf8).str.zfill(2)
+                                   for part in [seconds // 3600, seconds // 60 % 60, seconds % 60]]).alias(column)
 
-    # Convert to UNIX timestamp
-    df_temp = df_temp.with_columns(
-        pl.col("datetime").dt.timestamp('ms').alias("arrival_time_unix")
-    )
 
-    return df_temp.select(pl.col('trip_id'), pl.col('arrival_time'), pl.col('stop_id'), pl.col('stop_sequence')
-                          , (pl.col('arrival_time_unix') / 1000).cast(pl.Int64)).sort(['trip_id', 'stop_sequence'])
+# Copy of gtfs_time_to_unix in STM_Create_Daily_Stops_Info/main.py, keep them in sync
+def gtfs_time_to_unix(column, service_date, timezone_str, dtype=pl.Utf8):
+    """
+    Convert a column of GTFS times (HH:MM:SS, the hours can go past 24) to UNIX time, in a single expression run
+    by Polars. A GTFS time is measured from "noon minus 12h" of the service date, in the timezone of the agency: on the
+    days of a DST change, this reference is not midnight, and no time of the day is ambiguous or missing.
+    :param column: name of the column holding the times
+    :param service_date: date (or datetime) of the service day
+    :param timezone_str: timezone of the agency (ex: 'America/Montreal')
+    :param dtype: dtype of the column, the HH:MM:SS strings of the feed or an integer number of seconds from "noon
+    minus 12h" (as written by STM_Fetch_Update_GTFS_Static_files)
+    :return: Polars expression of the UNIX times (Int64), null where the time is missing or invalid
+    """
+    noon = pytz.timezone(timezone_str).localize(datetime(service_date.year, service_date.month, service_date.day, 12))
+    reference = int(noon.timestamp()) - 12 * 3600
+    if dtype in pl.INTEGER_DTYPES:
+        return reference + pl.col(column).cast(pl.Int64)
+    parts = pl.col(column).str.split_exact(':', 2)
+    hours, minutes, seconds = (parts.struct.field(f'field_{i}').cast(pl.Int64, strict=False) for i in range(3))
+    return reference + hours * 3600 + minutes * 60 + seconds
 
 
 def rename_and_convert_columns(df):
+    """
+    Rename the trip id of the VehiclePositions, convert the columns used by the analysis and sort the rows. This is the
+    only sort of the analysis: the steps after it keep the order of the rows.
+    :param df: Dataframe (or LazyFrame) of the VehiclePositions of the two days
+    :return: Dataframe (or LazyFrame) sorted by trip_id, vehicle_currentStopSequence and timefetch
+    """
     df_temp = df.rename({'vehicle_trip_tripId': 'trip_id'})
     try:
         df_temp = df_temp.cast({'id': pl.Int32,'timefetch': pl.Int64, 'vehicle_position_bearing': pl.Int32,
@@ -240,30 +877,27 @@ def filter_daily_vehicle_position(df):
 def calculate_offset_for_stopped_status(df):
     """
     Calculate the offset for the stop_sequence where the vehicle_status is "stopped_at"
-    :param df: Dataframe to calculate the offset on
-    :return: Dataframe sorted by trip_id and vehicle_stop
+    :param df: Dataframe to calculate the offset on, sorted by trip_id, vehicle_currentStopSequence and timefetch
+    :return: Dataframe in the same order
     """
-    df = df.with_columns([
+    return df.with_columns([
         pl.when(pl.col('vehicle_currentStatus') == "STOPPED_AT")
         .then(pl.col('vehicle_timestamp') - pl.col('arrival_time_unix'))
         .otherwise(None)
         .alias('offset')
     ])
 
-    # return the DF sorted by 'trip_id' and 'vehicle_currentStopSequence'
-    return df.sort(['trip_id', 'vehicle_currentStopSequence'])
-
 
 def calculate_offset_for_in_transit_status(df):
-    # Use the `shift()` function to get the 'vehicle_timestamp' of the next 'vehicle_currentStopSequence'
-    # within each 'trip_id'. We shift by -1 to get the next value.
+    # Use the `shift()` function to get the 'vehicle_timestamp' of the next row. The rows are sorted by trip_id, so
+    # the next row is the next position of the trip, unless it is from a different 'trip_id'.
     df = df.with_columns(
-        pl.col('vehicle_timestamp').shift(-1).over('trip_id').alias('next_vehicle_timestamp')
+        pl.col('vehicle_timestamp').shift(-1).alias('next_vehicle_timestamp')
     )
 
     # Calculate the offset for 'IN_TRANSIT_TO' using the 'next_vehicle_timestamp'
     # If the next row is from a different 'trip_id', we should not calculate the offset, so we also check for this
-    df = df.with_columns([
+    return df.with_columns([
         pl.when(
             (pl.col('vehicle_currentStatus') == 'IN_TRANSIT_TO') &
             (pl.col('trip_id') == pl.col('trip_id').shift(-1))
@@ -274,8 +908,6 @@ def calculate_offset_for_in_transit_status(df):
         ).alias('offset')
     ])
 
-    return df.sort(['trip_id', 'vehicle_currentStopSequence'])
-
 
 def calculate_offset_for_last_stop_sequence(df):
     try:
@@ -289,7 +921,7 @@ def calculate_offset_for_last_stop_sequence(df):
 
         # Calculate the offset using the new 'next_vehicle_timestamp' column
         # Make sure to compare the vehicle IDs to ensure they are the same before using the next timestamp
-        df = df.with_columns([
+        return df.with_columns([
             pl.when(
                 (pl.col('vehicle_currentStatus') != 'STOPPED_AT') &
                 (pl.col('vehicle_vehicle_id') == pl.col('vehicle_vehicle_id').shift(-1)) &
@@ -300,7 +932,6 @@ def calculate_offset_for_last_stop_sequence(df):
                 pl.col('offset')
             ).alias('offset')
         ])
-        return df.sort(['trip_id', 'vehicle_currentStopSequence'])
     except Exception as e:
         print(f'Failed to calculate offset_for_the_last_stop_sequence {df}')
         print(f'Error: {e}')
@@ -310,70 +941,102 @@ def calculate_arrival_departure_offset(df):
     """
     Calculate the arrival and departure time offset based on how many value there is for a stop_sequence
     If we have more than one value of offsets for a stop_sequence, we have the information of arrival and departure
-    to that stop, we then take the lowest has arrival and highest as departure. If we have 1 value we assign that one
-    for both (arrival and departure offset)
-    :param df: Dataframe to calculate
+    to that stop, we then take the first one has arrival and last one as departure. If we have 1 value we assign that
+    one for both (arrival and departure offset)
+    :param df: Dataframe to calculate, sorted by trip_id, vehicle_currentStopSequence and timefetch
     :return: Dataframe with values added
     """
     try:
-        # Calculate the first and last offset for each group
-        first_offset = df.group_by(['trip_id', 'vehicle_currentStopSequence']).agg(
-            pl.first('offset').alias('arrival_time_offset')
-        ).with_columns(pl.col('vehicle_currentStopSequence').cast(pl.Int64))  # Cast if necessary
-
-        last_offset = df.group_by(['trip_id', 'vehicle_currentStopSequence']).agg(
-            pl.last('offset').alias('departure_time_offset')
-        ).with_columns(pl.col('vehicle_currentStopSequence').cast(pl.Int64))  # Cast if necessary
-
-        # Join the first and last offsets back to the original DataFrame
-        df = df.join(first_offset, on=['trip_id', 'vehicle_currentStopSequence'], how='left')
-        df = df.join(last_offset, on=['trip_id', 'vehicle_currentStopSequence'], how='left')
-        return df
+        # First and last offset of each stop of a trip, computed by window over the rows of the stop
+        stop = ['trip_id', 'vehicle_currentStopSequence']
+        return df.with_columns([
+            pl.col('offset').first().over(stop).alias('arrival_time_offset'),
+            pl.col('offset').last().over(stop).alias('departure_time_offset')
+        ])
     except Exception as e:
         print(f'Failed to calculate arrival_departure_offset of {df}')
         print(f'Error: {e}')
         raise
 
 
+def match_stop_times(df_vehicle_positions, df_stops_unix, tolerance=MATCH_TOLERANCE):
+    """
+    Match each position to the scheduled stop event of its trip_id and vehicle_currentStopSequence nearest to the
+    time of the fetch, within the tolerance, by an as-of join grouped by trip_id and stop sequence. The positions
+    without a stop event (see the documentation for why that would happen) or too far from it are dropped.
+    :param df_vehicle_positions: Dataframe (or LazyFrame) of the positions, sorted by timefetch in each trip_id and
+    vehicle_currentStopSequence
+    :param df_stops_unix: Dataframe (or LazyFrame) of the stop_times, as returned by adding_arrival_time_unix
+    :param tolerance: largest difference in seconds between timefetch and arrival_time_unix
+    :return: Dataframe (or LazyFrame) of the matched positions with the columns of the stop_times, in the order of
+    df_vehicle_positions
+    """
+    # The stop events are sorted by time in each group of the as-of join, and the events of a group are contiguous
+    df_stop_events = (df_stops_unix.filter(pl.col('arrival_time_unix').is_not_null())
+                      .sort(['trip_id', 'stop_sequence', 'arrival_time_unix']))
+    df_matched = df_vehicle_positions.join_asof(df_stop_events, left_on='timefetch', right_on='arrival_time_unix',
+                                                by_left=['trip_id', 'vehicle_currentStopSequence'],
+                                                by_right=['trip_id', 'stop_sequence'],
+                                                strategy='nearest', tolerance=tolerance)
+    return df_matched.filter(pl.col('arrival_time_unix').is_not_null())
+
+
 def process_based_on_daily_static_files(dfs_daily_vehicle_positions_merge, df_stops_unix):
+    """
+    Match the VehiclePositions with the stop_times of the day and calculate the offset of the vehicles at each stop.
+    :param dfs_daily_vehicle_positions_merge: Dataframe (or LazyFrame) of the VehiclePositions, as returned by
+    rename_and_convert_columns
+    :param df_stops_unix: Dataframe (or LazyFrame) of the stop_times, as returned by adding_arrival_time_unix
+    :return: Dataframe (or LazyFrame) of the positions with an offset, with the columns of the stop_times, sorted by
+    trip_id, vehicle_currentStopSequence and timefetch
+    """
     try:
-        # We filter to only keep the positions(rows) we need to process (remove duplicate)
-        df_filtered_vehicle_positions = filter_daily_vehicle_position(dfs_daily_vehicle_positions_merge)
-        #df_filtered_vehicle_positions.write_parquet('df_filtered_vehicle_positions.parquet')  # Used to generate the map
+        df_time_difference = select_matched_positions(dfs_daily_vehicle_positions_merge, df_stops_unix)
 
-        # We then reduce the number of rows to keep, only the one with value for a stop_sequence
-        df_merge = df_filtered_vehicle_positions.join(df_stops_unix, how='outer',
-                                                      left_on=['trip_id', 'vehicle_currentStopSequence'],
-                                                      right_on=['trip_id', 'stop_sequence'])
+        return calculate_stop_offsets(df_time_difference)
 
-        # We remove the rows of data that doesn't have an arrival_time_unix (see the documentation for why that would happen)
-        df_merge = df_merge.filter(pl.col('arrival_time_unix').is_not_null())
-        df_merge = df_merge.filter(pl.col('vehicle_timestamp').is_not_null())
+    except Exception as e:
+        print(f'Failed to process {dfs_daily_vehicle_positions_merge} and {df_stops_unix} for daily static file')
+        print(f'Error: {e}')
+        raise
 
-        # We create a column 'offset' and calculate a value to be able to the remove the vehiclePosition of the next day.
-        df_merge = df_merge.with_columns((pl.col('timefetch') - pl.col('arrival_time_unix')).alias('offset'))
-        # Filter out rows where the absolute value of the offset is greater than 7200 seconds(2 hours)(trip_id of the next_day)
-        df_time_difference = df_merge.filter(pl.col('offset').abs() <= 7200)
-        df_time_difference = df_time_difference.with_columns(pl.lit(None).alias('offset'))
 
-        # Calculate offset for "STOPPED_AT" VehicleStatus
-        df_time_difference = calculate_offset_for_stopped_status(df_time_difference)
+def select_matched_positions(dfs_daily_vehicle_positions_merge, df_stops_unix):
+    """
+    :param dfs_daily_vehicle_positions_merge: Dataframe (or LazyFrame) of the VehiclePositions, as returned by
+    rename_and_convert_columns
+    :param df_stops_unix: Dataframe (or LazyFrame) of the stop_times, as returned by adding_arrival_time_unix
+    :return: Dataframe (or LazyFrame) of the positions matched to a stop, with the columns of the stop_times, sorted by
+    trip_id, vehicle_currentStopSequence and timefetch
+    """
+    # We filter to only keep the positions(rows) we need to process (remove duplicate)
+    df_filtered_vehicle_positions = filter_daily_vehicle_position(dfs_daily_vehicle_positions_merge)
+    #df_filtered_vehicle_positions.write_parquet('df_filtered_vehicle_positions.parquet')  # Used to generate the map
 
-        # Calculate offset for "IN_TRANSIT_TO" VehicleStatus
-        df_time_difference = calculate_offset_for_in_transit_status(df_time_difference)
+    # We then match each position to its scheduled stop, the positions of the next day (same trip_id) are too far
+    # from the schedule to be matched
+    df_merge = match_stop_times(df_filtered_vehicle_positions, df_stops_unix)
+    return df_merge.filter(pl.col('vehicle_timestamp').is_not_null())
 
-        # Calculate offset for the last stop of a trip
-        df_time_difference = calculate_offset_for_last_stop_sequence(df_time_difference)
 
-        # Determine the arrival and departure offset for each stop if possible
-        df_time_difference = calculate_arrival_departure_offset(df_time_difference)
+def calculate_stop_offsets(df_time_difference):
+    """
+    Calculate the offset of the matched positions, and the arrival and departure offset of their stop.
+    :param df_time_difference: Dataframe (or LazyFrame) of the matched positions, sorted by trip_id,
+    vehicle_currentStopSequence and timefetch
+    :return: Dataframe (or LazyFrame) of the positions with an offset of at most 1800 seconds, in the same order
+    """
+    # Calculate offset for "STOPPED_AT" VehicleStatus
+    df_time_difference = calculate_offset_for_stopped_status(df_time_difference)
+
+    # Calculate offset for "IN_TRANSIT_TO" VehicleStatus
+    df_time_difference = calculate_offset_for_in_transit_status(df_time_difference)
 
-        # Remove the stops with an offset of more than 1800 seconds (30 minutes)
-        df_time_difference = df_time_difference.filter(pl.col('offset').abs() <= 1800)
+    # Calculate offset for the last stop of a trip
+    df_time_difference = calculate_offset_for_last_stop_sequence(df_time_difference)
 
-        return df_time_difference.sort(['trip_id', 'vehicle_currentStopSequence', 'timefetch'])
+    # Determine the arrival and departure offset for each stop if possible
+    df_time_difference = calculate_arrival_departure_offset(df_time_difference)
 
-    except Exception as e:
-        print(f'Failed to process {dfs_daily_vehicle_positions_merge} and {df_stops_unix} for daily static file')
-        print(f'Error: {e}')
-        raise
\ No newline at end of file
+    # Remove the stops with an offset of more than 1800 seconds (30 minutes)
+    return df_time_difference.filter(pl.col('offset').abs() <= 1800)
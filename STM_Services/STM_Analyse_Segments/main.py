@@ -1,5 +1,6 @@
 import json
 import boto3
+import hashlib
 import os
 import time
 import pytz
@@ -9,6 +10,8 @@ import polars as pl
 import pandas as pd
 import polars.selectors as cs
 
+from botocore.exceptions import ClientError
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from urllib.request import Request, urlopen
 from pymongo.mongo_client import MongoClient
@@ -18,6 +21,13 @@ from gridfs import GridFS
 # Set up S3 client
 s3 = boto3.client('s3')
 
+STATIC_BUCKET = 'monitoring-mtl-gtfs-static'
+# Versions of the static feed and their tables, written by STM_Fetch_Update_GTFS_Static_files
+FEED_INDEX_KEY = 'feed_index.json'
+# Static tables kept by a warm container between invocations, see DimensionCache
+DIMENSION_CACHE_DIR = '/tmp/dimension_cache'
+DIMENSION_CACHE_TABLES = 8
+
 def download_from_s3(bucket_name, file_key):
     try:
         response = s3.get_object(Bucket=bucket_name, Key=file_key)
@@ -26,12 +36,117 @@ def download_from_s3(bucket_name, file_key):
         print(f"Error downloading file {file_key} from S3: {e}")
         return None
     
-def get_static_trips():
-    file_key = 'trips/trips.parquet'
-    bucket = 'monitoring-mtl-gtfs-static'
-    static_trips = download_from_s3(bucket, file_key)
+def get_static_trips(service_date):
+    # Trips of the version of the static feed in effect on the day, downloaded once per version by a warm container.
+    # The tables of a version never change, the one stored before the feed index is checked with its ETag.
+    feed = resolve_feed_version(load_feed_index(STATIC_BUCKET), service_date)
+    file_key = 'trips/trips.parquet' if feed is None else feed['tables']['trips']
+    static_trips = dimension_cache.get(STATIC_BUCKET, file_key, immutable=feed is not None)
+    print(f'Dimension cache: {dimension_cache.metrics}')
     return static_trips
 
+# Copy of load_feed_index and resolve_feed_version in STM_Create_Daily_Stops_Info/main.py, keep them in sync
+def load_feed_index(static_bucket):
+    """
+    :return: the versions of the static feed, in the order they were published, empty if the static bucket has no
+    feed index yet
+    """
+    try:
+        response = s3.get_object(Bucket=static_bucket, Key=FEED_INDEX_KEY)
+        return json.loads(response['Body'].read())['versions']
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return []
+
+def resolve_feed_version(feed_index, service_date):
+    """
+    Find the version of the static feed in effect on a service date: among the versions whose calendar covers the
+    date, the last one published on or before it. A date older than the publication of these versions (a backfill)
+    gets the first of them, and a date covered by no version the last version published.
+    :param feed_index: versions of the static feed, from load_feed_index
+    :param service_date: date of the service day
+    :return: entry of the version in the feed index, None if there is none
+    """
+    date_str = service_date.strftime('%Y%m%d')
+    covering = [feed for feed in feed_index
+                if feed['start_date'] is not None and feed['start_date'] <= date_str <= feed['end_date']]
+    published = [feed for feed in covering if feed['published'] <= date_str]
+    if published:
+        return published[-1]
+    if covering:
+        return covering[0]
+    return feed_index[-1] if feed_index else None
+
+# Copy of DimensionCache in STM_Create_Daily_Stops_Info/main.py (only the load can return None), keep them in sync
+class DimensionCache:
+    """
+    Static tables (trips) kept between the invocations of a warm container. A table is downloaded once,
+    written uncompressed as an Arrow IPC file in /tmp and read back memory-mapped: its columns are in the page cache
+    instead of the heap of the process, and it is not decoded again while the container lives.
+    A table is identified by its key and ETag. The ETag of a mutable key is checked with a HEAD request on each call,
+    a key of a version of the static feed is immutable (its name contains the hash of its content) and is not
+    checked. The least recently used tables above max_tables are removed. The files also serve a new instance in the
+    same container (the runtime is restarted after a failed invocation, /tmp is kept).
+    """
+
+    def __init__(self, s3, load, directory=DIMENSION_CACHE_DIR, max_tables=DIMENSION_CACHE_TABLES):
+        """
+        :param s3: S3 client, for the HEAD requests
+        :param load: function (bucket, key) -> Polars DataFrame or None, called on a miss
+        """
+        self.s3 = s3
+        self.load = load
+        self.directory = directory
+        self.max_tables = max_tables
+        self.tables = OrderedDict()  # (bucket, key) -> (etag, path, DataFrame)
+        self.metrics = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'head_requests': 0}
+
+    def get(self, bucket, key, immutable=False):
+        """
+        :param immutable: True if the object at this key never changes, its ETag is not checked
+        :return: the table as a Polars DataFrame, None if it could not be loaded
+        """
+        etag = None
+        if not immutable:
+            etag = self.s3.head_object(Bucket=bucket, Key=key)['ETag']
+            self.metrics['head_requests'] += 1
+
+        cached = self.tables.get((bucket, key))
+        if cached is not None and cached[0] == etag:
+            self.tables.move_to_end((bucket, key))
+            self.metrics['memory_hits'] += 1
+            return cached[2]
+        if cached is not None:
+            # The object changed since it was cached
+            self._remove((bucket, key))
+
+        path = os.path.join(self.directory, hashlib.sha256(f'{bucket}/{key}/{etag}'.encode()).hexdigest()[:16] + '.arrow')
+        if os.path.exists(path):
+            self.metrics['disk_hits'] += 1
+        else:
+            self.metrics['misses'] += 1
+            df = self.load(bucket, key)
+            if df is None:
+                return None
+            os.makedirs(self.directory, exist_ok=True)
+            df.write_ipc(f'{path}.tmp')
+            os.replace(f'{path}.tmp', path)
+        df = pl.read_ipc(path, memory_map=True)
+
+        self.tables[(bucket, key)] = (etag, path, df)
+        while len(self.tables) > self.max_tables:
+            self._remove(next(iter(self.tables)))
+        return df
+
+    def _remove(self, table):
+        _, path, _ = self.tables.pop(table)
+        if os.path.exists(path):
+            os.remove(path)
+
+# download_from_s3 is looked up on each miss, so it can be patched
+dimension_cache = DimensionCache(s3, lambda bucket, key: download_from_s3(bucket, key))
+
 def get_daily_parquet_file(bucket_name, prefix):
 
     # List objects in the bucket with the specified prefix
@@ -114,7 +229,7 @@ def lambda_handler(event, context):
     daily_data = daily_data.select(['trip_id', 'routeId', 'stop_id', 'previous_stop_id', 'offset_difference', 'Current_Occupancy', 'arrival_time_unix'])
 
     #Get the static trips from S3
-    df_static_trips = get_static_trips()
+    df_static_trips = get_static_trips(date_obj.date())
 
     # Aggregate to get unique route_id to shape_id mapping
     df_route_shape_map = df_static_trips.group_by("route_id").agg([
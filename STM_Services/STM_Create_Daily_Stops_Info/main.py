@@ -2,13 +2,23 @@ import boto3
 import pandas as pd
 import polars as pl
 import fastparquet
+import hashlib
+import json
 import os
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+from datetime import datetime
 import pytz
 
 # Initialize S3 client
 s3_client = boto3.client('s3')
 
+# Versions of the static feed and their tables, written by STM_Fetch_Update_GTFS_Static_files
+FEED_INDEX_KEY = 'feed_index.json'
+# Static tables kept by a warm container between invocations, see DimensionCache
+DIMENSION_CACHE_DIR = '/tmp/dimension_cache'
+DIMENSION_CACHE_TABLES = 8
+
 def lambda_handler(event, context):
     static_bucket = event['static_bucket']
     daily_static_bucket = event['daily_static_bucket']
@@ -31,71 +41,34 @@ def lambda_handler(event, context):
     filtered_trips_path = f'{folder_name}/filtered_trips/filtered_trips_{file_name}.parquet'
     filtered_stop_times_path = f'{folder_name}/filtered_stop_times/filtered_stop_times_{file_name}.parquet'
 
+    # Version of the static feed in effect on the day, the one the daily files were filtered from
+    feed = resolve_feed_version(load_feed_index(static_bucket), date_obj.date())
+
+    # stops and routes come from the dimension cache: a warm container downloads them once per version of the feed.
+    # The tables of a version never change, the ones stored before the feed index are checked with their ETag.
+    stops_df = dimension_cache.get(static_bucket, table_key(feed, 'stops'), immutable=feed is not None)
+
     # Download files from S3 to /tmp
-    stops_local_path = download_file_to_tmp(static_bucket, 'stops/stops.parquet')
     filtered_trips_local_path = download_file_to_tmp(daily_static_bucket, filtered_trips_path)
     filtered_stop_times_local_path = download_file_to_tmp(daily_static_bucket, filtered_stop_times_path)
-    routes_local_path = download_file_to_tmp(static_bucket, 'routes/routes.parquet')
 
-    # Read the necessary files from /tmp
-    stops_df = read_parquet_from_tmp(stops_local_path)
-    
-    filtered_trips_df = read_parquet_from_tmp(filtered_trips_local_path)
-    filtered_stop_times_df = read_parquet_from_tmp(filtered_stop_times_local_path)
-    routes_df = read_parquet_from_tmp(routes_local_path)
-
-    # Process the stop times into UNIX timestamp
-    #filtered_stop_times_df['arrival_time_unix'] = filtered_stop_times_df['arrival_time'].apply(lambda x: convert_to_unix(x, date_obj, local_timezone))
+    routes_df = dimension_cache.get(static_bucket, table_key(feed, 'routes'), immutable=feed is not None)
+    print(f'Dimension cache: {dimension_cache.metrics}')
 
-    filtered_stop_times_df = filtered_stop_times_df.with_columns(
-        pl.col('arrival_time').map_elements(lambda x: convert_to_unix(x, date_obj, local_timezone)).alias('arrival_time_unix')
-    )
-    
-    # Ensure data types for 'stop_id' match
-    stops_df = stops_df.with_columns(stops_df['stop_id'].cast(pl.Utf8))
-    filtered_stop_times_df = filtered_stop_times_df.with_columns(filtered_stop_times_df['stop_id'].cast(pl.Utf8))
-
-    # Merge with filtered_trips_df
-    merged_df = filtered_stop_times_df.join(
-        filtered_trips_df[['trip_id', 'route_id', 'trip_headsign', 'direction_id', 'shape_id', 'wheelchair_accessible']],
-        on='trip_id',
-        how='left'
-    )
-
-    # Merge with stops_df
-    merged_df = merged_df.join(
-        stops_df[['stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'wheelchair_boarding']],
-        on='stop_id',
-        how='left'
-    )
-
-    # Merge with routes_df
-    merged_df = merged_df.join(
-        routes_df[['route_id', 'route_long_name']],
-        on='route_id',
-        how='left'
-    )
-
-    # Apply the function on the DataFrame
-    merged_df = merged_df.with_columns([
-        create_route_info(merged_df['route_id'], merged_df['route_long_name'], merged_df['trip_headsign']).alias('route_info')
-    ])
-    
-    # Select required columns
-    final_df = merged_df[['route_id', 'route_info', 'trip_id', 'shape_id', 'wheelchair_accessible', 
-                          'arrival_time_unix', 'stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'wheelchair_boarding']]
+    # The stops info of the day as one lazy query, streamed from the daily files to the output file
+    stops_info_lf = build_daily_stops_info(pl.scan_parquet(filtered_stop_times_local_path),
+                                           pl.scan_parquet(filtered_trips_local_path), stops_df.lazy(),
+                                           routes_df.lazy(), date_obj, local_timezone)
 
     # Write and upload the DataFrame to S3
     output_file_path = f'{folder_name}/daily_stops_info/daily_stops_info_{file_name}.parquet'
     local_output_path = f"/tmp/{os.path.basename(output_file_path)}"
-    write_df_to_parquet_to_tmp(final_df, local_output_path)
+    stops_info_lf.sink_parquet(local_output_path)
     upload_file_from_tmp(output_bucket, output_file_path, local_output_path)
 
     # Clean up the /tmp directory if needed
-    os.remove(stops_local_path)
     os.remove(filtered_trips_local_path)
     os.remove(filtered_stop_times_local_path)
-    os.remove(routes_local_path)
 
     return {
         'statusCode': 200,
@@ -111,6 +84,120 @@ def download_file_to_tmp(bucket, key):
         print(f'Error downloading file from {bucket}/{key}: {e}')
         return False
 
+# load_feed_index, resolve_feed_version and DimensionCache are copied in STM_Analyse_Segments/main.py, and the
+# feed index helpers in STM_Filter_Daily_GTFS_Static_files/main.py (each Lambda is packaged alone): keep them in sync
+def load_feed_index(static_bucket):
+    """
+    :return: the versions of the static feed, in the order they were published, empty if the static bucket has no
+    feed index yet
+    """
+    try:
+        response = s3_client.get_object(Bucket=static_bucket, Key=FEED_INDEX_KEY)
+        return json.loads(response['Body'].read())['versions']
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return []
+
+def resolve_feed_version(feed_index, service_date):
+    """
+    Find the version of the static feed in effect on a service date: among the versions whose calendar covers the
+    date, the last one published on or before it. A date older than the publication of these versions (a backfill)
+    gets the first of them, and a date covered by no version the last version published.
+    :param feed_index: versions of the static feed, from load_feed_index
+    :param service_date: date of the service day
+    :return: entry of the version in the feed index, None if there is none
+    """
+    date_str = service_date.strftime('%Y%m%d')
+    covering = [feed for feed in feed_index
+                if feed['start_date'] is not None and feed['start_date'] <= date_str <= feed['end_date']]
+    published = [feed for feed in covering if feed['published'] <= date_str]
+    if published:
+        return published[-1]
+    if covering:
+        return covering[0]
+    return feed_index[-1] if feed_index else None
+
+def table_key(feed, table):
+    """
+    :return: key of a table of a version of the static feed, its key before the feed index if there is no version
+    """
+    if feed is None:
+        return f'{table}/{table}.parquet'
+    return feed['tables'][table]
+
+def load_static_table(bucket, key):
+    local_path = download_file_to_tmp(bucket, key)
+    df = read_parquet_from_tmp(local_path)
+    os.remove(local_path)
+    return df
+
+class DimensionCache:
+    """
+    Static tables (stops, routes) kept between the invocations of a warm container. A table is downloaded once,
+    written uncompressed as an Arrow IPC file in /tmp and read back memory-mapped: its columns are in the page cache
+    instead of the heap of the process, and it is not decoded again while the container lives.
+    A table is identified by its key and ETag. The ETag of a mutable key is checked with a HEAD request on each call,
+    a key of a version of the static feed is immutable (its name contains the hash of its content) and is not
+    checked. The least recently used tables above max_tables are removed. The files also serve a new instance in the
+    same container (the runtime is restarted after a failed invocation, /tmp is kept).
+    """
+
+    def __init__(self, s3, load, directory=DIMENSION_CACHE_DIR, max_tables=DIMENSION_CACHE_TABLES):
+        """
+        :param s3: S3 client, for the HEAD requests
+        :param load: function (bucket, key) -> Polars DataFrame, called on a miss
+        """
+        self.s3 = s3
+        self.load = load
+        self.directory = directory
+        self.max_tables = max_tables
+        self.tables = OrderedDict()  # (bucket, key) -> (etag, path, DataFrame)
+        self.metrics = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'head_requests': 0}
+
+    def get(self, bucket, key, immutable=False):
+        """
+        :param immutable: True if the object at this key never changes, its ETag is not checked
+        :return: the table as a Polars DataFrame
+        """
+        etag = None
+        if not immutable:
+            etag = self.s3.head_object(Bucket=bucket, Key=key)['ETag']
+            self.metrics['head_requests'] += 1
+
+        cached = self.tables.get((bucket, key))
+        if cached is not None and cached[0] == etag:
+            self.tables.move_to_end((bucket, key))
+            self.metrics['memory_hits'] += 1
+            return cached[2]
+        if cached is not None:
+            # The object changed since it was cached
+            self._remove((bucket, key))
+
+        path = os.path.join(self.directory, hashlib.sha256(f'{bucket}/{key}/{etag}'.encode()).hexdigest()[:16] + '.arrow')
+        if os.path.exists(path):
+            self.metrics['disk_hits'] += 1
+        else:
+            self.metrics['misses'] += 1
+            df = self.load(bucket, key)
+            os.makedirs(self.directory, exist_ok=True)
+            df.write_ipc(f'{path}.tmp')
+            os.replace(f'{path}.tmp', path)
+        df = pl.read_ipc(path, memory_map=True)
+
+        self.tables[(bucket, key)] = (etag, path, df)
+        while len(self.tables) > self.max_tables:
+            self._remove(next(iter(self.tables)))
+        return df
+
+    def _remove(self, table):
+        _, path, _ = self.tables.pop(table)
+        if os.path.exists(path):
+            os.remove(path)
+
+# load_static_table is looked up on each miss, so it can be patched
+dimension_cache = DimensionCache(s3_client, lambda bucket, key: load_static_table(bucket, key))
+
 def upload_file_from_tmp(bucket, key, local_path):
     s3_client.upload_file(Filename=local_path, Bucket=bucket, Key=key)
 
@@ -123,29 +210,72 @@ def write_df_to_parquet_to_tmp(df, local_path):
     df.write_parquet(local_path)
 
 
-def convert_to_unix(time_str, base_date, timezone_str):
-    time_parts = [int(part) for part in time_str.split(':')]
-    days_to_add = 0
-    if time_parts[0] >= 24:
-        time_parts[0] -= 24
-        days_to_add = 1
-    naive_base_date = base_date.replace(tzinfo=None)
-    time_obj = naive_base_date.replace(hour=time_parts[0], minute=time_parts[1], second=time_parts[2])
-    time_obj += timedelta(days=days_to_add)
-    local_timezone = pytz.timezone(timezone_str)
-    local_dt = local_timezone.localize(time_obj, is_dst=None)
-    return int(local_dt.timestamp())
+# gtfs_time_to_unix is copied in STM_Analyse_Daily_Stops_Data/main.py (each Lambda is packaged alone): keep them in sync
+def gtfs_time_to_unix(column, service_date, timezone_str, dtype=pl.Utf8):
+    """
+    Convert a column of GTFS times (HH:MM:SS, the hours can go past 24) to UNIX time, in a single expression run
+    by Polars. A GTFS time is measured from "noon minus 12h" of the service date, in the timezone of the agency: on the
+    days of a DST change, this reference is not midnight, and no time of the day is ambiguous or missing.
+    :param column: name of the column holding the times
+    :param service_date: date (or datetime) of the service day
+    :param timezone_str: timezone of the agency (ex: 'America/Montreal')
+    :param dtype: dtype of the column, the HH:MM:SS strings of the feed or an integer number of seconds from "noon
+    minus 12h" (as written by STM_Fetch_Update_GTFS_Static_files)
+    :return: Polars expression of the UNIX times (Int64), null where the time is missing or invalid
+    """
+    noon = pytz.timezone(timezone_str).localize(datetime(service_date.year, service_date.month, service_date.day, 12))
+    reference = int(noon.timestamp()) - 12 * 3600
+    if dtype in pl.INTEGER_DTYPES:
+        return reference + pl.col(column).cast(pl.Int64)
+    parts = pl.col(column).str.split_exact(':', 2)
+    hours, minutes, seconds = (parts.struct.field(f'field_{i}').cast(pl.Int64, strict=False) for i in range(3))
+    return reference + hours * 3600 + minutes * 60 + seconds
 
 
-def create_route_info(route_id, route_long_name, trip_headsign):
-    direction_mapping = {'E': 'EST', 'O': 'OUEST', 'S': 'SUD', 'N': 'NORD'}
+# Last character of trip_headsign (ex: "Station Henri-Bourassa / N") -> direction in route_info
+DIRECTIONS = {'E': 'EST', 'O': 'OUEST', 'S': 'SUD', 'N': 'NORD'}
+STOPS_INFO_COLUMNS = ['route_id', 'route_info', 'trip_id', 'shape_id', 'wheelchair_accessible', 'arrival_time_unix',
+                      'stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'wheelchair_boarding']
 
-    # Extract the last character of trip_headsign as direction (E, O, S, N)
-    direction = pl.col('trip_headsign').str.slice(-1)
 
-    # Map the extracted direction to the translated direction
-    translated_direction = direction.apply(lambda x: direction_mapping.get(x, x))
+def build_daily_stops_info(stop_times_lf, trips_lf, stops_lf, routes_lf, service_date, timezone_str):
+    """
+    Query of the stops info of a day: each stop time of the day with its trip, route and stop. Only the needed
+    columns are read, route_info is built once per (route_id, trip_headsign) then joined to the trips, and the plan
+    can be streamed (ex: sink_parquet).
+    :param stop_times_lf: filtered stop_times of the day, LazyFrame
+    :param trips_lf: filtered trips of the day, LazyFrame
+    :param stops_lf: stops table, LazyFrame
+    :param routes_lf: routes table, LazyFrame
+    :param service_date: date (or datetime) of the service day
+    :param timezone_str: timezone of the agency (ex: 'America/Montreal')
+    :return: LazyFrame with the STOPS_INFO_COLUMNS
+    """
+    trips_lf = trips_lf.select('trip_id', 'route_id', 'trip_headsign', 'shape_id', 'wheelchair_accessible')
+    route_info_lf = (trips_lf.select('route_id', 'trip_headsign').unique()
+                     .join(routes_lf.select('route_id', 'route_long_name'), on='route_id', how='left')
+                     .select('route_id', 'trip_headsign',
+                             create_route_info('route_id', 'route_long_name', 'trip_headsign').alias('route_info')))
+    trips_lf = trips_lf.join(route_info_lf, on=['route_id', 'trip_headsign'], how='left')
 
-    # Construct the route_info
-    route_info = route_id + " " + route_long_name + " dir. " + translated_direction
-    return route_info
+    # stop_id is an integer in stop_times and Categorical in stops, both are joined as strings
+    arrival_time_dtype = stop_times_lf.schema['arrival_time']
+    stop_times_lf = stop_times_lf.select(
+        'trip_id', pl.col('stop_id').cast(pl.Utf8),
+        gtfs_time_to_unix('arrival_time', service_date, timezone_str, arrival_time_dtype).alias('arrival_time_unix'))
+    stops_lf = stops_lf.select(pl.col('stop_id').cast(pl.Utf8), 'stop_name', 'stop_lat', 'stop_lon',
+                               'wheelchair_boarding')
+    return (stop_times_lf.join(trips_lf, on='trip_id', how='left')
+            .join(stops_lf, on='stop_id', how='left')
+            .select(STOPS_INFO_COLUMNS))
+
+
+def create_route_info(route_id, route_long_name, trip_headsign):
+    """
+    :return: Polars expression of the route info (ex: "10 De Lorimier dir. NORD"), null if a part is missing
+    """
+    # Last character of trip_headsign as direction (E, O, S, N), translated, other characters kept. trip_headsign is
+    # Categorical in the static files.
+    direction = pl.col(trip_headsign).cast(pl.Utf8).str.slice(-1)
+    translated_direction = direction.replace(DIRECTIONS)
+    return pl.format('{} {} dir. {}', route_id, route_long_name, translated_direction)
@@ -1,9 +1,10 @@
-from google.protobuf.json_format import MessageToDict
-import pandas as pd
+import polars as pl
 import boto3
-import fastparquet
+import base64
+import hashlib
+import io
+import urllib3
 from google.transit import gtfs_realtime_pb2
-from urllib.request import Request, urlopen
 from datetime import datetime
 import pytz
 import os
@@ -11,8 +12,40 @@ import os
 # Set up S3
 s3 = boto3.client('s3')
 
+# Pooled HTTP connection, kept alive between the invocations of a warm container
+http = urllib3.PoolManager()
 
-def lambda_handler(event, context): 
+# Validators of the last snapshot stored by this container, used to skip the snapshots that did not change.
+# Copy of the state in STM_Fetch_GTFS_VehiclePositions/main.py, keep them in sync
+last_snapshot = {'etag': None, 'last_modified': None, 'feed_timestamp': None, 'digest': None}
+snapshot_stats = {'fetched': 0, 'skipped': 0}
+
+# Long format of a TripUpdates snapshot: one row per (entity, stop_time_update), sorted by trip and stop sequence.
+# The ids repeated on every row are dictionary-encoded (Categorical) in the Parquet file.
+TRIP_UPDATES_SCHEMA = {
+    'trip_id': pl.Utf8,
+    'route_id': pl.Categorical,
+    'direction_id': pl.Int64,
+    'start_date': pl.Utf8,
+    'start_time': pl.Utf8,
+    'trip_schedule_relationship': pl.Categorical,
+    'vehicle_id': pl.Utf8,
+    'stop_sequence': pl.Int64,
+    'stop_id': pl.Categorical,
+    'arrival_time': pl.Int64,
+    'arrival_delay': pl.Int64,
+    'arrival_uncertainty': pl.Int64,
+    'departure_time': pl.Int64,
+    'departure_delay': pl.Int64,
+    'departure_uncertainty': pl.Int64,
+    'schedule_relationship': pl.Categorical,
+    'trip_delay': pl.Int64,
+    'timestamp': pl.Int64,
+    'timefetch': pl.Int64,
+}
+
+
+def lambda_handler(event, context):
     api_url = os.environ.get('API_URL_STM_TRIP')
     api_key = os.environ.get('API_KEY_STM')
 
@@ -24,46 +57,227 @@ def lambda_handler(event, context):
     fetch_time_unix = int(now.timestamp())
     folder_name = now.strftime('%Y/%m/%d')
 
-    feed = gtfs_realtime_pb2.FeedMessage()
-    request = Request(api_url, headers={'apikey': api_key})
+    duplicate_policy = event.get('duplicate_policy', 'skip')  # 'skip' or 'marker' (zero-byte object)
+
+    # Define S3 key
+    s3_file_key = f'{folder_name}/STM_GTFS_TripUpdates_{fetch_time_unix}.parquet'
 
     try:
-        response = urlopen(request)
+        response = fetch_snapshot(api_url, api_key)
     except Exception as e:
         print(f"Failed to make the request: {e}")
         return
 
-    feed.ParseFromString(response.read())
-
-    # Convert the feed object to a JSON-serializable dictionary
-    json_data_dict = MessageToDict(feed)
-
-    # Check if 'entity' is in data, if so normalize it  A VALIDER !!!!! DF['entity'] pour accéder aux DATAs
-    if 'entity' in json_data_dict:
-        df = pd.json_normalize(json_data_dict['entity'], sep='_')
-    else:
-        df = pd.DataFrame()
+    snapshot = read_snapshot(response)
+    if snapshot is None:
+        return skip_snapshot(bucket_name, s3_file_key, duplicate_policy, last_snapshot['feed_timestamp'],
+                             last_snapshot['digest'])
+    feed, feed_timestamp, digest = snapshot
 
-    # Sort the columns in the DataFrame
-    df = df.sort_index(axis=1)
+    # Decode the entities straight into typed columns
+    df = decode_trip_updates(feed, fetch_time_unix)
 
-    # Save Dataframe 
-    temp_file_path = '/tmp/file.parquet'
-    df.to_parquet(temp_file_path, compression='gzip')
-
-    # Define S3 key
-    s3_file_key = f'{folder_name}/STM_GTFS_TripUpdates_{fetch_time_unix}.parquet'
+    # Serialize the Dataframe in memory
+    buffer = io.BytesIO()
+    df.write_parquet(buffer, compression='gzip', statistics=True)
 
     # Upload the file to S3 with try-except for error handling
     try:
-        s3.upload_file(temp_file_path, bucket_name, s3_file_key)
+        put_parquet_buffer(bucket_name, s3_file_key, buffer, snapshot_metadata(feed_timestamp, digest))
         print(f'Successfully stored {s3_file_key} in S3.')
+        remember_snapshot(response, feed_timestamp, digest)
     except Exception as e:
         print(f"Failed to upload to S3: {e}")
         return
-    finally:
-        # Always try to remove the file from /tmp, even if upload fails
+
+    return {
+        'statusCode': 200,
+        'body': f'Stored {s3_file_key}',
+        'skipped': False,
+        'skip_rate': skip_rate()
+    }
+
+
+# Copy of put_parquet_buffer, fetch_snapshot, read_snapshot, is_unchanged_snapshot, remember_snapshot,
+# snapshot_metadata, skip_snapshot and skip_rate in STM_Fetch_GTFS_VehiclePositions/main.py, keep them in sync
+def put_parquet_buffer(bucket_name, key, buffer, metadata=None):
+    """
+    Store a Parquet file serialized in memory with a single put_object, without going through /tmp. The SHA-256
+    checksum is computed before the request so S3 validates the object without a second pass on the data.
+    :param bucket_name: Bucket name in S3
+    :param key: the key under which to store the file
+    :param buffer: io.BytesIO holding the Parquet file
+    :param metadata: optional user metadata of the object
+    """
+    body = buffer.getvalue()
+    checksum = base64.b64encode(hashlib.sha256(body).digest()).decode('ascii')
+    s3.put_object(Bucket=bucket_name, Key=key, Body=body, ChecksumSHA256=checksum, Metadata=metadata or {})
+
+
+def fetch_snapshot(api_url, api_key):
+    """
+    GET the feed through the pooled connection. When the validators (ETag, Last-Modified) of the last stored
+    snapshot are known, the request is conditional and the server answers 304 if nothing changed.
+    :param api_url: URL of the GTFS-RT feed
+    :param api_key: STM API key
+    :return: the urllib3 response (200 or 304)
+    """
+    headers = {'apikey': api_key}
+    if last_snapshot['etag']:
+        headers['If-None-Match'] = last_snapshot['etag']
+    if last_snapshot['last_modified']:
+        headers['If-Modified-Since'] = last_snapshot['last_modified']
+    response = http.request('GET', api_url, headers=headers)
+    snapshot_stats['fetched'] += 1
+    if response.status not in (200, 304):
+        raise urllib3.exceptions.HTTPError(f'HTTP {response.status}')
+    return response
+
+
+def read_snapshot(response):
+    """
+    Parse a fetched snapshot, unless it is unchanged since the last stored one.
+    :param response: the response of fetch_snapshot
+    :return: (feed, feed timestamp, digest of the content), None if the snapshot is unchanged
+    """
+    # The server confirmed that the snapshot did not change since the last one we stored
+    if response.status == 304:
+        snapshot_stats['skipped'] += 1
+        return None
+
+    data = response.data
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(data)
+
+    # Some servers do not support conditional requests, so we also compare the feed header and the content
+    feed_timestamp = feed.header.timestamp
+    digest = hashlib.sha256(data).hexdigest()
+    if is_unchanged_snapshot(feed_timestamp, digest):
+        snapshot_stats['skipped'] += 1
+        return None
+
+    return feed, feed_timestamp, digest
+
+
+def is_unchanged_snapshot(feed_timestamp, digest):
+    """
+    A snapshot is unchanged if its content is identical to the last stored one, or if the feed header says it
+    was produced at the same time.
+    """
+    if digest == last_snapshot['digest']:
+        return True
+    return bool(feed_timestamp) and feed_timestamp == last_snapshot['feed_timestamp']
+
+
+def remember_snapshot(response, feed_timestamp, digest):
+    last_snapshot['etag'] = response.headers.get('ETag')
+    last_snapshot['last_modified'] = response.headers.get('Last-Modified')
+    last_snapshot['feed_timestamp'] = feed_timestamp
+    last_snapshot['digest'] = digest
+
+
+def snapshot_metadata(feed_timestamp, digest):
+    return {'feed-timestamp': str(feed_timestamp), 'sha256': digest or ''}
+
+
+def skip_snapshot(bucket_name, s3_file_key, duplicate_policy, feed_timestamp, digest):
+    """
+    Skip an unchanged snapshot. With the 'marker' policy, a zero-byte '.duplicate' object is written in place of
+    the Parquet file so the fetch is still recorded (the merge only reads the '.parquet' files).
+    :return: the response of the lambda with the skip rate of this container
+    """
+    if duplicate_policy == 'marker':
+        marker_key = s3_file_key.replace('.parquet', '.duplicate')
         try:
-            os.remove(temp_file_path)
+            s3.put_object(Bucket=bucket_name, Key=marker_key, Body=b'',
+                          Metadata=snapshot_metadata(feed_timestamp, digest))
         except Exception as e:
-            print(f"Failed to delete temporary file: {e}")
\ No newline at end of file
+            print(f"Failed to upload to S3: {e}")
+
+    print(f'Unchanged snapshot (feed timestamp {feed_timestamp}), {s3_file_key} skipped. '
+          f'Skip rate: {snapshot_stats["skipped"]}/{snapshot_stats["fetched"]} ({skip_rate():.1%})')
+    return {
+        'statusCode': 200,
+        'body': f'Unchanged snapshot, {s3_file_key} skipped.',
+        'skipped': True,
+        'skip_rate': skip_rate()
+    }
+
+
+def skip_rate():
+    return snapshot_stats['skipped'] / snapshot_stats['fetched'] if snapshot_stats['fetched'] else 0.0
+
+
+def decode_trip_updates(feed, fetch_time_unix):
+    """
+    Walk the trip_update entities of a GTFS-RT feed and append one row per stop_time_update directly into column
+    buffers, without going through MessageToDict and pd.json_normalize. The fields of the trip are repeated on
+    each row. An entity without stop_time_update (ex: a canceled trip) is kept as a single row with null stop
+    fields. Fields that are not set in the message are stored as null.
+    :param feed: the parsed gtfs_realtime_pb2.FeedMessage
+    :param fetch_time_unix: UNIX time of the fetch, stored in 'timefetch'
+    :return: Polars DataFrame following TRIP_UPDATES_SCHEMA, sorted by trip_id and stop_sequence
+    """
+    columns = {name: [] for name in TRIP_UPDATES_SCHEMA}
+    trip_columns = ['trip_id', 'route_id', 'direction_id', 'start_date', 'start_time', 'trip_schedule_relationship',
+                    'vehicle_id', 'trip_delay', 'timestamp']
+    no_stop_time_update = [None]
+
+    trip_relationship = gtfs_realtime_pb2.TripDescriptor.ScheduleRelationship
+    stop_relationship = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.ScheduleRelationship
+
+    for entity in feed.entity:
+        if not entity.HasField('trip_update'):
+            continue
+        trip_update = entity.trip_update
+        trip = trip_update.trip
+
+        trip_values = [
+            _get(trip, 'trip_id'),
+            _get(trip, 'route_id'),
+            _get(trip, 'direction_id'),
+            _get(trip, 'start_date'),
+            _get(trip, 'start_time'),
+            _get_enum(trip, 'schedule_relationship', trip_relationship),
+            _get(trip_update.vehicle, 'id'),
+            _get(trip_update, 'delay'),
+            _get(trip_update, 'timestamp'),
+        ]
+
+        for stop_time_update in trip_update.stop_time_update or no_stop_time_update:
+            for name, value in zip(trip_columns, trip_values):
+                columns[name].append(value)
+
+            if stop_time_update is None:
+                for name in ['stop_sequence', 'stop_id', 'arrival_time', 'arrival_delay', 'arrival_uncertainty',
+                             'departure_time', 'departure_delay', 'departure_uncertainty', 'schedule_relationship']:
+                    columns[name].append(None)
+                continue
+
+            arrival = stop_time_update.arrival
+            departure = stop_time_update.departure
+            columns['stop_sequence'].append(_get(stop_time_update, 'stop_sequence'))
+            columns['stop_id'].append(_get(stop_time_update, 'stop_id'))
+            columns['arrival_time'].append(_get(arrival, 'time'))
+            columns['arrival_delay'].append(_get(arrival, 'delay'))
+            columns['arrival_uncertainty'].append(_get(arrival, 'uncertainty'))
+            columns['departure_time'].append(_get(departure, 'time'))
+            columns['departure_delay'].append(_get(departure, 'delay'))
+            columns['departure_uncertainty'].append(_get(departure, 'uncertainty'))
+            columns['schedule_relationship'].append(
+                _get_enum(stop_time_update, 'schedule_relationship', stop_relationship))
+
+    columns['timefetch'] = [fetch_time_unix] * len(columns['trip_id'])
+
+    # Sorted by trip so a reader can skip row groups with the trip_id statistics
+    return pl.DataFrame(columns, schema=TRIP_UPDATES_SCHEMA).sort(['trip_id', 'stop_sequence'])
+
+
+# Copy of _get and _get_enum in STM_Fetch_GTFS_VehiclePositions/main.py, keep them in sync
+def _get(message, field):
+    # Same semantic as MessageToDict: a field that is not set is missing (null), even if it has a default value
+    return getattr(message, field) if message.HasField(field) else None
+
+
+def _get_enum(message, field, enum_type):
+    return enum_type.Name(getattr(message, field)) if message.HasField(field) else None
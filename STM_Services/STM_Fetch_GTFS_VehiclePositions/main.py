@@ -1,8 +1,12 @@
-from google.protobuf.json_format import MessageToDict
-import pandas as pd
+import polars as pl
 import boto3
+import base64
+import hashlib
+import io
+import time
+import urllib3
+import pyarrow.parquet as pq
 from google.transit import gtfs_realtime_pb2
-from urllib.request import Request, urlopen
 from datetime import datetime
 import pytz
 import os
@@ -10,9 +14,54 @@ import os
 # Set up S3
 s3 = boto3.client('s3')
 
+# Pooled HTTP connection, kept alive between the invocations of a warm container
+http = urllib3.PoolManager()
+
+# Validators of the last snapshot stored by this container, used to skip the snapshots that did not change
+last_snapshot = {'etag': None, 'last_modified': None, 'feed_timestamp': None, 'digest': None}
+snapshot_stats = {'fetched': 0, 'skipped': 0}
+
+# Seconds kept at the end of a micro-batching invocation to write and upload the file
+UPLOAD_MARGIN_SECONDS = 5
+
+# Fixed schema of a VehiclePositions snapshot. The column names are the ones produced by
+# pd.json_normalize(MessageToDict(feed)['entity'], sep='_') so the merge stage keeps the same columns,
+# but the integers (timestamps, sequences) are stored as integers instead of strings.
+VEHICLE_POSITIONS_SCHEMA = {
+    'id': pl.Utf8,
+    'vehicle_congestionLevel': pl.Utf8,
+    'vehicle_currentStatus': pl.Utf8,
+    'vehicle_currentStopSequence': pl.Int64,
+    'vehicle_occupancyPercentage': pl.Int64,
+    'vehicle_occupancyStatus': pl.Utf8,
+    'vehicle_position_bearing': pl.Float64,
+    'vehicle_position_latitude': pl.Float64,
+    'vehicle_position_longitude': pl.Float64,
+    'vehicle_position_odometer': pl.Float64,
+    'vehicle_position_speed': pl.Float64,
+    'vehicle_stopId': pl.Utf8,
+    'vehicle_timestamp': pl.Int64,
+    'vehicle_trip_directionId': pl.Int64,
+    'vehicle_trip_routeId': pl.Utf8,
+    'vehicle_trip_scheduleRelationship': pl.Utf8,
+    'vehicle_trip_startDate': pl.Utf8,
+    'vehicle_trip_startTime': pl.Utf8,
+    'vehicle_trip_tripId': pl.Utf8,
+    'vehicle_vehicle_id': pl.Utf8,
+    'vehicle_vehicle_label': pl.Utf8,
+    'vehicle_vehicle_licensePlate': pl.Utf8,
+}
+
+# Versions of the schemas above in the registry of STM_Merge_Daily_GTFS_VehiclePositions. The version is part of the
+# file name (..._<timefetch>.v<version>.parquet) so the merge knows the columns of a file without reading it.
+# Any change to VEHICLE_POSITIONS_SCHEMA needs a new version, registered in the merge before this lambda is deployed.
+VEHICLE_POSITIONS_SCHEMA_VERSION = 2
+# A micro-batch file has the same columns plus 'timefetch'
+MICRO_BATCH_SCHEMA_VERSION = 3
+
+
+def lambda_handler(event, context):
 
-def lambda_handler(event, context): 
-    
     api_url = os.environ.get('API_URL_STM_VEHICLE')
     api_key = os.environ.get('API_KEY_STM')
 
@@ -24,46 +73,296 @@ def lambda_handler(event, context):
     fetch_time_unix = int(now.timestamp())
     folder_name = now.strftime('%Y/%m/%d')
 
-    feed = gtfs_realtime_pb2.FeedMessage()
-    request = Request(api_url, headers={'apikey': api_key})
-
-    try:
-        response = urlopen(request)
-    except Exception as e:
-        print(f"Failed to make the request: {e}")
-        return
+    duplicate_policy = event.get('duplicate_policy', 'skip')  # 'skip' or 'marker' (zero-byte object)
+    poll_interval = event.get('poll_interval')  # Seconds between two polls, enables the micro-batching mode
+    poll_window = event.get('poll_window', 50)  # Seconds of polling per invocation in micro-batching mode
 
-    feed.ParseFromString(response.read())
+    # Define S3 key
+    schema_version = MICRO_BATCH_SCHEMA_VERSION if poll_interval else VEHICLE_POSITIONS_SCHEMA_VERSION
+    s3_file_key = f'{folder_name}/STM_GTFS_VehiclePositions_{fetch_time_unix}.v{schema_version}.parquet'
 
-    # Convert the feed object to a JSON-serializable dictionary
-    json_data_dict = MessageToDict(feed)
+    # The Parquet file is serialized in memory
+    buffer = io.BytesIO()
 
-    # Check if 'entity' is in data, if so normalize it
-    if 'entity' in json_data_dict:
-        df = pd.json_normalize(json_data_dict['entity'], sep='_')
+    if poll_interval:
+        # Micro-batching: one file per invocation, one row group per snapshot
+        snapshots = poll_micro_batch(api_url, api_key, poll_interval, poll_window, context)
+        if not snapshots:
+            return skip_snapshot(bucket_name, s3_file_key, duplicate_policy, last_snapshot['feed_timestamp'],
+                                 last_snapshot['digest'])
+        write_row_groups(snapshots, buffer)
+        feed_timestamp = last_snapshot['feed_timestamp']
+        digest = last_snapshot['digest']
     else:
-        df = pd.DataFrame()
+        try:
+            response = fetch_snapshot(api_url, api_key)
+        except Exception as e:
+            print(f"Failed to make the request: {e}")
+            return
 
-    # Sort the columns in the DataFrame
-    df = df.sort_index(axis=1)
+        snapshot = read_snapshot(response)
+        if snapshot is None:
+            return skip_snapshot(bucket_name, s3_file_key, duplicate_policy, last_snapshot['feed_timestamp'],
+                                 last_snapshot['digest'])
+        feed, feed_timestamp, digest = snapshot
 
-    # Save Dataframe 
-    temp_file_path = '/tmp/file.parquet'
-    df.to_parquet(temp_file_path, compression="gzip")
+        # Decode the entities straight into typed columns
+        df = decode_vehicle_positions(feed)
 
-    # Define S3 key
-    s3_file_key = f'{folder_name}/STM_GTFS_VehiclePositions_{fetch_time_unix}.parquet'
+        # Save Dataframe
+        df.write_parquet(buffer, compression="gzip")
 
     # Upload the file to S3 with try-except for error handling
     try:
-        s3.upload_file(temp_file_path, bucket_name, s3_file_key)
+        put_parquet_buffer(bucket_name, s3_file_key, buffer, snapshot_metadata(feed_timestamp, digest))
         print(f'Successfully stored {s3_file_key} in S3.')
+        if not poll_interval:
+            remember_snapshot(response, feed_timestamp, digest)
     except Exception as e:
         print(f"Failed to upload to S3: {e}")
+        # The snapshots polled in memory were not stored, the next one must not be compared to them
+        last_snapshot.update(dict.fromkeys(last_snapshot))
         return
-    finally:
-        # Always try to remove the file from /tmp, even if upload fails
+
+    return {
+        'statusCode': 200,
+        'body': f'Stored {s3_file_key}',
+        'skipped': False,
+        'skip_rate': skip_rate()
+    }
+
+
+def poll_micro_batch(api_url, api_key, poll_interval, poll_window, context):
+    """
+    Poll the feed every poll_interval seconds during poll_window seconds (bounded by the remaining time of the
+    invocation) and keep the decoded new snapshots in memory, each one with the 'timefetch' of its poll.
+    :param api_url: URL of the GTFS-RT feed
+    :param api_key: STM API key
+    :param poll_interval: seconds between two polls
+    :param poll_window: seconds during which the feed is polled
+    :param context: lambda context, used to stop polling in time to upload the file
+    :return: list of the decoded snapshots (Polars DataFrames with the same schema)
+    """
+    start = time.time()
+    deadline = start + poll_window
+    if context is not None:
+        deadline = min(deadline, start + context.get_remaining_time_in_millis() / 1000 - UPLOAD_MARGIN_SECONDS)
+
+    snapshots = []
+    next_poll = start
+    while True:
+        delay = next_poll - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        fetch_time_unix = int(time.time())
+        try:
+            response = fetch_snapshot(api_url, api_key)
+            snapshot = read_snapshot(response)
+        except Exception as e:
+            print(f"Failed to make the request: {e}")
+            snapshot = None
+
+        if snapshot is not None:
+            feed, feed_timestamp, digest = snapshot
+            df = decode_vehicle_positions(feed).with_columns(
+                pl.lit(fetch_time_unix, dtype=pl.Int64).alias('timefetch'))
+            snapshots.append(df.select(sorted(df.columns)))
+            # The next polls are compared to this snapshot
+            remember_snapshot(response, feed_timestamp, digest)
+
+        next_poll += poll_interval
+        if next_poll >= deadline:
+            break
+
+    print(f'Polled {len(snapshots)} new snapshots in {time.time() - start:.1f}s')
+    return snapshots
+
+
+def write_row_groups(snapshots, sink):
+    """
+    Write the snapshots in a single Parquet file, one row group per snapshot, so a reader can still select a
+    snapshot with the statistics of 'timefetch'.
+    :param snapshots: list of Polars DataFrames with the same schema
+    :param sink: path or file-like object (ex: io.BytesIO) where to write the Parquet file
+    """
+    tables = [snapshot.to_arrow() for snapshot in snapshots]
+    with pq.ParquetWriter(sink, tables[0].schema, compression='gzip') as writer:
+        for table in tables:
+            writer.write_table(table, row_group_size=max(table.num_rows, 1))
+
+
+# The snapshot state above, put_parquet_buffer, fetch_snapshot, read_snapshot, is_unchanged_snapshot,
+# remember_snapshot, snapshot_metadata, skip_snapshot, skip_rate, _get and _get_enum are copied in
+# STM_Fetch_GTFS_TripUpdates/main.py (each Lambda is packaged alone): keep them in sync
+def put_parquet_buffer(bucket_name, key, buffer, metadata=None):
+    """
+    Store a Parquet file serialized in memory with a single put_object, without going through /tmp. The SHA-256
+    checksum is computed before the request so S3 validates the object without a second pass on the data.
+    :param bucket_name: Bucket name in S3
+    :param key: the key under which to store the file
+    :param buffer: io.BytesIO holding the Parquet file
+    :param metadata: optional user metadata of the object
+    """
+    body = buffer.getvalue()
+    checksum = base64.b64encode(hashlib.sha256(body).digest()).decode('ascii')
+    s3.put_object(Bucket=bucket_name, Key=key, Body=body, ChecksumSHA256=checksum, Metadata=metadata or {})
+
+
+def fetch_snapshot(api_url, api_key):
+    """
+    GET the feed through the pooled connection. When the validators (ETag, Last-Modified) of the last stored
+    snapshot are known, the request is conditional and the server answers 304 if nothing changed.
+    :param api_url: URL of the GTFS-RT feed
+    :param api_key: STM API key
+    :return: the urllib3 response (200 or 304)
+    """
+    headers = {'apikey': api_key}
+    if last_snapshot['etag']:
+        headers['If-None-Match'] = last_snapshot['etag']
+    if last_snapshot['last_modified']:
+        headers['If-Modified-Since'] = last_snapshot['last_modified']
+    response = http.request('GET', api_url, headers=headers)
+    snapshot_stats['fetched'] += 1
+    if response.status not in (200, 304):
+        raise urllib3.exceptions.HTTPError(f'HTTP {response.status}')
+    return response
+
+
+def read_snapshot(response):
+    """
+    Parse a fetched snapshot, unless it is unchanged since the last stored one.
+    :param response: the response of fetch_snapshot
+    :return: (feed, feed timestamp, digest of the content), None if the snapshot is unchanged
+    """
+    # The server confirmed that the snapshot did not change since the last one we stored
+    if response.status == 304:
+        snapshot_stats['skipped'] += 1
+        return None
+
+    data = response.data
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(data)
+
+    # Some servers do not support conditional requests, so we also compare the feed header and the content
+    feed_timestamp = feed.header.timestamp
+    digest = hashlib.sha256(data).hexdigest()
+    if is_unchanged_snapshot(feed_timestamp, digest):
+        snapshot_stats['skipped'] += 1
+        return None
+
+    return feed, feed_timestamp, digest
+
+
+def is_unchanged_snapshot(feed_timestamp, digest):
+    """
+    A snapshot is unchanged if its content is identical to the last stored one, or if the feed header says it
+    was produced at the same time.
+    """
+    if digest == last_snapshot['digest']:
+        return True
+    return bool(feed_timestamp) and feed_timestamp == last_snapshot['feed_timestamp']
+
+
+def remember_snapshot(response, feed_timestamp, digest):
+    last_snapshot['etag'] = response.headers.get('ETag')
+    last_snapshot['last_modified'] = response.headers.get('Last-Modified')
+    last_snapshot['feed_timestamp'] = feed_timestamp
+    last_snapshot['digest'] = digest
+
+
+def snapshot_metadata(feed_timestamp, digest):
+    return {'feed-timestamp': str(feed_timestamp), 'sha256': digest or ''}
+
+
+def skip_snapshot(bucket_name, s3_file_key, duplicate_policy, feed_timestamp, digest):
+    """
+    Skip an unchanged snapshot. With the 'marker' policy, a zero-byte '.duplicate' object is written in place of
+    the Parquet file so the fetch is still recorded (the merge only reads the '.parquet' files).
+    :return: the response of the lambda with the skip rate of this container
+    """
+    if duplicate_policy == 'marker':
+        marker_key = s3_file_key.replace('.parquet', '.duplicate')
         try:
-            os.remove(temp_file_path)
+            s3.put_object(Bucket=bucket_name, Key=marker_key, Body=b'',
+                          Metadata=snapshot_metadata(feed_timestamp, digest))
         except Exception as e:
-            print(f"Failed to delete temporary file: {e}")
\ No newline at end of file
+            print(f"Failed to upload to S3: {e}")
+
+    print(f'Unchanged snapshot (feed timestamp {feed_timestamp}), {s3_file_key} skipped. '
+          f'Skip rate: {snapshot_stats["skipped"]}/{snapshot_stats["fetched"]} ({skip_rate():.1%})')
+    return {
+        'statusCode': 200,
+        'body': f'Unchanged snapshot, {s3_file_key} skipped.',
+        'skipped': True,
+        'skip_rate': skip_rate()
+    }
+
+
+def skip_rate():
+    return snapshot_stats['skipped'] / snapshot_stats['fetched'] if snapshot_stats['fetched'] else 0.0
+
+
+def decode_vehicle_positions(feed):
+    """
+    Walk the vehicle entities of a GTFS-RT feed and append their fields directly into column buffers, without
+    going through MessageToDict and pd.json_normalize. Fields that are not set in the message are stored as null.
+    :param feed: the parsed gtfs_realtime_pb2.FeedMessage
+    :return: Polars DataFrame following VEHICLE_POSITIONS_SCHEMA, columns sorted by name
+    """
+    columns = {name: [] for name in VEHICLE_POSITIONS_SCHEMA}
+
+    vehicle_stop_status = gtfs_realtime_pb2.VehiclePosition.VehicleStopStatus
+    congestion_level = gtfs_realtime_pb2.VehiclePosition.CongestionLevel
+    occupancy_status = gtfs_realtime_pb2.VehiclePosition.OccupancyStatus
+    schedule_relationship = gtfs_realtime_pb2.TripDescriptor.ScheduleRelationship
+
+    for entity in feed.entity:
+        if not entity.HasField('vehicle'):
+            continue
+        vehicle = entity.vehicle
+        trip = vehicle.trip
+        descriptor = vehicle.vehicle
+        position = vehicle.position
+
+        columns['id'].append(entity.id)
+
+        columns['vehicle_congestionLevel'].append(
+            _get_enum(vehicle, 'congestion_level', congestion_level))
+        columns['vehicle_currentStatus'].append(
+            _get_enum(vehicle, 'current_status', vehicle_stop_status))
+        columns['vehicle_currentStopSequence'].append(_get(vehicle, 'current_stop_sequence'))
+        columns['vehicle_occupancyPercentage'].append(_get(vehicle, 'occupancy_percentage'))
+        columns['vehicle_occupancyStatus'].append(
+            _get_enum(vehicle, 'occupancy_status', occupancy_status))
+        columns['vehicle_stopId'].append(_get(vehicle, 'stop_id'))
+        columns['vehicle_timestamp'].append(_get(vehicle, 'timestamp'))
+
+        columns['vehicle_position_bearing'].append(_get(position, 'bearing'))
+        columns['vehicle_position_latitude'].append(_get(position, 'latitude'))
+        columns['vehicle_position_longitude'].append(_get(position, 'longitude'))
+        columns['vehicle_position_odometer'].append(_get(position, 'odometer'))
+        columns['vehicle_position_speed'].append(_get(position, 'speed'))
+
+        columns['vehicle_trip_directionId'].append(_get(trip, 'direction_id'))
+        columns['vehicle_trip_routeId'].append(_get(trip, 'route_id'))
+        columns['vehicle_trip_scheduleRelationship'].append(
+            _get_enum(trip, 'schedule_relationship', schedule_relationship))
+        columns['vehicle_trip_startDate'].append(_get(trip, 'start_date'))
+        columns['vehicle_trip_startTime'].append(_get(trip, 'start_time'))
+        columns['vehicle_trip_tripId'].append(_get(trip, 'trip_id'))
+
+        columns['vehicle_vehicle_id'].append(_get(descriptor, 'id'))
+        columns['vehicle_vehicle_label'].append(_get(descriptor, 'label'))
+        columns['vehicle_vehicle_licensePlate'].append(_get(descriptor, 'license_plate'))
+
+    return pl.DataFrame(columns, schema=VEHICLE_POSITIONS_SCHEMA)
+
+
+def _get(message, field):
+    # Same semantic as MessageToDict: a field that is not set is missing (null), even if it has a default value
+    return getattr(message, field) if message.HasField(field) else None
+
+
+def _get_enum(message, field, enum_type):
+    return enum_type.Name(getattr(message, field)) if message.HasField(field) else None
@@ -1,13 +1,73 @@
 import requests
+import csv
 import os
 import zipfile
 import boto3
-from io import BytesIO
+import base64
+import hashlib
+import json
 import polars as pl
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import datetime
 
 
 LAST_MODIFIED_KEY = "Last_modified.txt"
+# Versions of the static feed, read by the daily Lambdas to find the tables in effect on a service date
+FEED_INDEX_KEY = 'feed_index.json'
+# Part of the hash of the tables: bump it when their conversion changes (GTFS_SCHEMAS, encodings) so they are rewritten
+CONVERSION_VERSION = '1'
+HASH_LENGTH = 16  # Hex characters kept from the SHA-256 of a table or a feed version
+# Rows of a row group in the Parquet files, the unit skipped by the readers with the statistics
+ROW_GROUP_SIZE = 64 * 1024
+# Bytes of the ZIP received at a time, and bytes of a member parsed at a time (one batch of rows)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+CSV_BLOCK_SIZE = 2 * 1024 * 1024
+MULTIPART_PART_SIZE = 8 * 1024 * 1024  # S3 minimum is 5 MiB, except for the last part
+
+# Declared dtypes of the GTFS tables, instead of inferring them from the first rows of each file. The columns joined
+# with the real time feeds of the STM (trip, route and shape ids, stop ids and sequences of stop_times) are Int64, the
+# other ids are Categorical. The times (HH:MM:SS, the hours can go past 24) are stored as seconds from "noon minus 12h" of the
+# service day, see TIME_COLUMNS. A column not declared here is kept as a string.
+GTFS_SCHEMAS = {
+    'agency': {'agency_id': pl.Categorical},
+    'calendar': {
+        'service_id': pl.Categorical,
+        'monday': pl.Int8, 'tuesday': pl.Int8, 'wednesday': pl.Int8, 'thursday': pl.Int8, 'friday': pl.Int8,
+        'saturday': pl.Int8, 'sunday': pl.Int8,
+        'start_date': pl.Date, 'end_date': pl.Date,
+    },
+    'calendar_dates': {'service_id': pl.Categorical, 'date': pl.Date, 'exception_type': pl.Int8},
+    'feed_info': {'feed_start_date': pl.Date, 'feed_end_date': pl.Date},
+    'frequencies': {'trip_id': pl.Int64, 'start_time': pl.Int32, 'end_time': pl.Int32, 'headway_secs': pl.Int32,
+                    'exact_times': pl.Int8},
+    'routes': {'route_id': pl.Int64, 'agency_id': pl.Categorical, 'route_type': pl.Int16,
+               'route_color': pl.Categorical, 'route_text_color': pl.Categorical},
+    'shapes': {'shape_id': pl.Int64, 'shape_pt_lat': pl.Float64, 'shape_pt_lon': pl.Float64,
+               'shape_pt_sequence': pl.Int32, 'shape_dist_traveled': pl.Float64},
+    'stop_times': {'trip_id': pl.Int64, 'arrival_time': pl.Int32, 'departure_time': pl.Int32, 'stop_id': pl.Int64,
+                   'stop_sequence': pl.Int64, 'pickup_type': pl.Int8, 'drop_off_type': pl.Int8,
+                   'timepoint': pl.Int8, 'shape_dist_traveled': pl.Float64},
+    'stops': {'stop_id': pl.Categorical, 'stop_lat': pl.Float64, 'stop_lon': pl.Float64, 'location_type': pl.Int8,
+              'parent_station': pl.Categorical, 'wheelchair_boarding': pl.Int8},
+    'trips': {'route_id': pl.Int64, 'service_id': pl.Categorical, 'trip_id': pl.Int64,
+              'trip_headsign': pl.Categorical, 'direction_id': pl.Int8, 'block_id': pl.Int64, 'shape_id': pl.Int64,
+              'wheelchair_accessible': pl.Int8, 'bikes_allowed': pl.Int8},
+}
+TIME_COLUMNS = {'arrival_time', 'departure_time', 'start_time', 'end_time'}
+# Tables written sorted: stop_times is clustered by trip_id, so a reader filtering on trip_id skips the row groups
+# with their statistics
+SORT_COLUMNS = {'stop_times': ['trip_id', 'stop_sequence']}
+# Tables derived from stop_times: each distinct stop pattern of the trips (stops, sequences and times relative to the
+# start of the trip) is stored once in stop_patterns, and trip_patterns gives the pattern and start time of each trip
+PATTERN_TABLES = ['stop_patterns', 'trip_patterns']
+PATTERN_COLUMNS = ['stop_sequence', 'stop_id', 'arrival_offset', 'departure_offset']
+# Seeds of the two 64-bit hashes identifying a pattern
+PATTERN_HASH_SEEDS = {'pattern_hash_1': 0, 'pattern_hash_2': 1}
+# Types given to the CSV reader, the other declared dtypes are read as strings then converted
+CSV_TYPES = {pl.Int8: pa.int8(), pl.Int16: pa.int16(), pl.Int32: pa.int32(), pl.Int64: pa.int64(),
+             pl.Float64: pa.float64()}
 
 
 def lambda_handler(event, context):
@@ -36,40 +96,502 @@ def lambda_handler(event, context):
         print("Last_modified.txt does not exist. Processing new file.")
 
     # Step 4: Si le fichier "Last_modified.txt" n'existe pas on télécharge les fichiers et upload dans S3
-    # Step 4: Download ZIP to /tmp directory
+    # Step 4: Download ZIP to /tmp directory, by large chunks. The ZIP needs random access (its directory is at the
+    # end), its members are not extracted.
     response = requests.get(url, stream=True)
+    response.raise_for_status()
     zip_tmp_path = '/tmp/tempfile.zip'
     with open(zip_tmp_path, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=128):
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
             f.write(chunk)
 
-    # Process files from /tmp
+    # Each table is stored under the hash of its content, so a table that did not change since a previous version
+    # (stops, routes, ...) is not written again. A new table is parsed by blocks straight from the ZIP, and its row
+    # groups are uploaded as they are written.
+    feed_index = load_feed_index(s3, bucket_name)
+    stored_keys = {key for feed in feed_index for key in feed['tables'].values()}
+    tables = {}
     with zipfile.ZipFile(zip_tmp_path) as z:
         for filename in z.namelist():
             if filename.endswith('.txt'):
-                # Extract file to /tmp
-                z.extract(filename, '/tmp')
-                txt_file_path = os.path.join('/tmp', filename)
+                table = filename.replace('.txt', '')
+                member_hash = hash_member(z, filename)
+                parquet_key = f'tables/{table}/{member_hash}/{table}.parquet'
+                tables[table] = parquet_key
+                if parquet_key in stored_keys:
+                    print(f'{table} did not change, {parquet_key} is kept.')
+                else:
+                    rows = convert_member_to_parquet(s3, bucket_name, parquet_key, z, filename, table)
+                    print(f'Successfully stored {parquet_key} in S3 ({rows} rows).')
 
-                # Read content into Polars DataFrame
-                df = pl.read_csv(txt_file_path)
+                if table == 'stop_times':
+                    # The stop patterns are derived from stop_times, and stored under its hash
+                    pattern_keys = {pattern_table: f'tables/{pattern_table}/{member_hash}/{pattern_table}.parquet'
+                                    for pattern_table in PATTERN_TABLES}
+                    tables.update(pattern_keys)
+                    if not set(pattern_keys.values()) <= stored_keys:
+                        convert_stop_patterns(s3, bucket_name, pattern_keys, z, filename)
+        start_date, end_date = get_service_date_range(z)
 
-                # Convert DataFrame to Parquet
-                parquet_buffer = BytesIO()
-                df.write_parquet(parquet_buffer)
+    # Clean up /tmp
+    os.remove(zip_tmp_path)
 
-                # Define key for S3 (change file extension to .parquet)
-                parquet_filename = filename.replace('.txt', '.parquet')
-                folder_name = filename.replace('.txt', '')
-                parquet_key = f'{folder_name}/{parquet_filename}'
+    register_feed_version(s3, bucket_name, feed_index, tables, last_modified_date, start_date, end_date)
 
-                # Upload Parquet file to S3
-                s3.put_object(Bucket=bucket_name, Key=parquet_key, Body=parquet_buffer.getvalue())
+    # Step 5: Mettre à jour le fichier "Last_modified.txt" avec la nouvelle date.
+    s3.put_object(Bucket=bucket_name, Key=LAST_MODIFIED_KEY, Body=last_modified)
+
+
+def hash_member(z, filename):
+    """
+    :return: hash of the content of a member of the ZIP (and of CONVERSION_VERSION), in HASH_LENGTH hex characters
+    """
+    digest = hashlib.sha256(CONVERSION_VERSION.encode())
+    with z.open(filename) as member:
+        while chunk := member.read(DOWNLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def get_service_date_range(z):
+    """
+    :return: first and last service dates of the feed (YYYYMMDD), from calendar and calendar_dates, None if the
+    feed has neither
+    """
+    dates = []
+    with pl.StringCache():
+        for table, columns in [('calendar', ['start_date', 'end_date']), ('calendar_dates', ['date'])]:
+            if f'{table}.txt' in z.namelist():
+                with z.open(f'{table}.txt') as member:
+                    df = pl.concat(list(read_gtfs_batches(member, GTFS_SCHEMAS[table])))
+                dates += [date for column in columns for date in (df[column].min(), df[column].max())
+                          if date is not None]
+    if not dates:
+        return None, None
+    return min(dates).strftime('%Y%m%d'), max(dates).strftime('%Y%m%d')
+
+
+def load_feed_index(s3, bucket_name):
+    """
+    :return: the versions of the static feed stored in the bucket, in the order they were published (empty before
+    the first version)
+    """
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=FEED_INDEX_KEY)
+        return json.loads(response['Body'].read())['versions']
+    except s3.exceptions.NoSuchKey:
+        return []
+
+
+def register_feed_version(s3, bucket_name, feed_index, tables, published, start_date, end_date):
+    """
+    Add a version of the static feed to the index. Its id is the hash of its tables, and its manifest is stored
+    under feeds/<version>/manifest.json. A feed identical to the last version is not added again.
+    :param tables: dict table name -> key of its Parquet file
+    :param published: Last-Modified of the ZIP (datetime)
+    :param start_date: first service date of the feed (YYYYMMDD), or None
+    :param end_date: last service date of the feed (YYYYMMDD), or None
+    :return: the entry of the version in the index
+    """
+    tables = dict(sorted(tables.items()))
+    version = hashlib.sha256(json.dumps(tables).encode()).hexdigest()[:HASH_LENGTH]
+    if feed_index and feed_index[-1]['version'] == version:
+        print(f'The tables did not change, the feed version {version} is kept.')
+        return feed_index[-1]
+
+    feed = {'version': version, 'published': published.strftime('%Y%m%d'), 'start_date': start_date,
+            'end_date': end_date, 'tables': tables}
+    s3.put_object(Bucket=bucket_name, Key=f'feeds/{version}/manifest.json', Body=json.dumps(feed, indent=2))
+    s3.put_object(Bucket=bucket_name, Key=FEED_INDEX_KEY, Body=json.dumps({'versions': feed_index + [feed]}))
+    print(f'Feed version {version} published on {feed["published"]}, service from {start_date} to {end_date}.')
+    return feed
+
+
+def convert_member_to_parquet(s3, bucket_name, key, z, filename, table):
+    """
+    Convert a GTFS table of the ZIP to a Parquet file on S3, with the dtypes of GTFS_SCHEMAS. The member is read by
+    blocks of CSV_BLOCK_SIZE bytes, and the Parquet file is uploaded by parts as its row groups are written, so the
+    memory used does not depend on the size of the table.
+    A table of SORT_COLUMNS is streamed as long as its rows come in order (the STM publishes stop_times sorted by
+    trip). Otherwise, the upload is aborted and the table is read again and sorted in memory.
+    :param s3: S3 client
+    :param bucket_name: Bucket name in S3
+    :param key: the key under which to store the file
+    :param z: the opened ZipFile
+    :param filename: name of the member (ex: stop_times.txt)
+    :param table: name of the GTFS table (ex: stop_times)
+    :return: number of rows written
+    """
+    schema = GTFS_SCHEMAS.get(table, {})
+    sort_columns = SORT_COLUMNS.get(table)
+    # The batches share the encoding of their Categorical columns, to be concatenated in row groups
+    with pl.StringCache():
+        return _convert_member_to_parquet(s3, bucket_name, key, z, filename, schema, sort_columns)
+
+
+def _convert_member_to_parquet(s3, bucket_name, key, z, filename, schema, sort_columns):
+    sink = S3MultipartUpload(s3, bucket_name, key)
+    try:
+        with z.open(filename) as member:
+            rows = write_parquet_batches(sink, read_gtfs_batches(member, schema), sort_columns)
+        sink.close()
+        return rows
+    except UnsortedTableError as e:
+        sink.abort()
+        print(f'{filename} is not sorted by {sort_columns} ({e}), sorting it in memory.')
+    except Exception:
+        sink.abort()
+        raise
+
+    with z.open(filename) as member:
+        df = pl.concat(list(read_gtfs_batches(member, schema))).sort(sort_columns)
+    sink = S3MultipartUpload(s3, bucket_name, key)
+    try:
+        rows = write_parquet_batches(sink, df.iter_slices(ROW_GROUP_SIZE))
+        sink.close()
+        return rows
+    except Exception:
+        sink.abort()
+        raise
+
+
+def read_gtfs_batches(member, schema):
+    """
+    Parse a GTFS CSV file by blocks.
+    :param member: binary file object of the CSV file
+    :param schema: dict column name -> Polars dtype of the declared columns, the others are read as strings
+    :return: generator of Polars DataFrames with the declared dtypes
+    """
+    # The header gives the columns, so the ones not declared are read as strings instead of being inferred from
+    # the first block
+    columns = next(csv.reader([member.readline().decode('utf-8-sig')]))
+    member.seek(0)
+    column_types = {column: pa.string() if column in TIME_COLUMNS else CSV_TYPES.get(schema.get(column), pa.string())
+                    for column in columns}
+    reader = pa_csv.open_csv(member, read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+                             convert_options=pa_csv.ConvertOptions(column_types=column_types, strings_can_be_null=True))
+    conversions = [gtfs_column(column, schema.get(column, pl.Utf8)) for column in columns]
+    empty = True
+    for batch in reader:
+        empty = False
+        yield pl.from_arrow(batch).select(conversions)
+    if empty:
+        # Header only, the table keeps its columns
+        yield pl.from_arrow(reader.schema.empty_table()).select(conversions)
+
+
+def gtfs_column(column, dtype):
+    """
+    :return: Polars expression converting a column of a GTFS file, read by the CSV reader, to its declared dtype
+    """
+    if column in TIME_COLUMNS and dtype == pl.Int32:
+        return gtfs_time_to_seconds(column)
+    if dtype == pl.Date:
+        # GTFS dates are YYYYMMDD
+        return pl.col(column).cast(pl.Utf8).str.strptime(pl.Date, '%Y%m%d')
+    return pl.col(column).cast(dtype)
+
+
+def gtfs_time_to_seconds(column):
+    """
+    :return: Polars expression converting GTFS times (HH:MM:SS, the hours can go past 24) to seconds from
+    "noon minus 12h" of the service day (Int32), null where the time is missing or invalid
+    """
+    # Padded to HH:MM:SS (the hour of a GTFS time can have one digit), then cut at fixed positions: faster than a
+    # split on ':'
+    time = pl.col(column).cast(pl.Utf8).str.zfill(8)
+    hours, minutes, seconds = (time.str.slice(offset, 2).cast(pl.Int32, strict=False) for offset in [0, 3, 6])
+    return (hours * 3600 + minutes * 60 + seconds).alias(column)
+
+
+class UnsortedTableError(Exception):
+    """
+    Raised by write_parquet_batches when the rows do not come in the order of the sort columns.
+    """
+
+
+def write_parquet_batches(sink, dataframes, sort_columns=None):
+    """
+    Write DataFrames in a single Parquet file, by row groups of ROW_GROUP_SIZE rows with min/max statistics.
+    :param sink: writable file object (ex: S3MultipartUpload)
+    :param dataframes: iterable of Polars DataFrames with the same schema
+    :param sort_columns: optional columns the rows must be sorted by, UnsortedTableError is raised otherwise
+    :return: number of rows written
+    """
+    writer = None
+    pending = []
+    pending_rows = 0
+    rows = 0
+    previous_last = None
+    try:
+        for df in dataframes:
+            if sort_columns:
+                check_sorted(df, sort_columns, previous_last)
+                previous_last = df.select(sort_columns).tail(1) if df.height else previous_last
+            if writer is None:
+                # Dictionary encoding for the strings, delta encoding for the integers (sorted ids, sequences and
+                # times of a trip): a dictionary makes the numbers larger
+                writer = pq.ParquetWriter(
+                    sink, df.to_arrow().schema, compression='zstd',
+                    use_dictionary=[column for column, dtype in df.schema.items() if dtype in (pl.Utf8, pl.Categorical)],
+                    column_encoding={column: 'DELTA_BINARY_PACKED' for column, dtype in df.schema.items()
+                                     if dtype in pl.INTEGER_DTYPES},
+                    write_statistics=True)
+            pending.append(df)
+            pending_rows += df.height
+            if pending_rows >= ROW_GROUP_SIZE:
+                # Only full row groups are written, the rest waits for the next DataFrames
+                df = pl.concat(pending)
+                full_rows = df.height - df.height % ROW_GROUP_SIZE
+                writer.write_table(df.slice(0, full_rows).to_arrow(), row_group_size=ROW_GROUP_SIZE)
+                rows += full_rows
+                pending = [df.slice(full_rows)]
+                pending_rows = df.height - full_rows
+        if pending_rows:
+            writer.write_table(pl.concat(pending).to_arrow(), row_group_size=pending_rows)
+            rows += pending_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def check_sorted(df, sort_columns, previous_last=None):
+    """
+    Raise UnsortedTableError if the rows of df, after the last row of the previous DataFrame, are not sorted by
+    sort_columns (lexicographic order, nulls not allowed).
+    """
+    if previous_last is not None:
+        df = pl.concat([previous_last, df.select(sort_columns)])
+    # Row i is in order if its first differing column is greater than in row i-1
+    in_order = pl.lit(True)
+    for column in reversed(sort_columns):
+        difference = pl.col(column).diff()
+        in_order = (difference > 0) | ((difference == 0) & in_order)
+    out_of_order = df.select((~in_order.fill_null(True)).sum() +
+                             pl.any_horizontal(pl.col(sort_columns).is_null()).sum()).item()
+    if out_of_order:
+        raise UnsortedTableError(f'{out_of_order} rows out of order')
+
+
+def convert_stop_patterns(s3, bucket_name, keys, z, filename):
+    """
+    Build the stop_patterns and trip_patterns tables from the stop_times member of the ZIP, and store them on S3.
+    stop_times is read by blocks like in convert_member_to_parquet, and the rows of the new patterns are uploaded as
+    they are found, so the memory used does not depend on the number of patterns. A stop_times not sorted by trip is
+    sorted in memory.
+    :param keys: dict table name (PATTERN_TABLES) -> the key under which to store it
+    :return: number of stop patterns and of trips
+    """
+    schema = GTFS_SCHEMAS['stop_times']
+    patterns = StopPatterns()
+    sink = S3MultipartUpload(s3, bucket_name, keys['stop_patterns'])
+    try:
+        with z.open(filename) as member:
+            write_parquet_batches(sink, patterns.build(read_gtfs_batches(member, schema)))
+        sink.close()
+    except UnsortedTableError:
+        sink.abort()
+        with z.open(filename) as member:
+            stop_times_df = pl.concat(list(read_gtfs_batches(member, schema))).sort(SORT_COLUMNS['stop_times'])
+        patterns = StopPatterns()
+        sink = S3MultipartUpload(s3, bucket_name, keys['stop_patterns'])
+        try:
+            write_parquet_batches(sink, patterns.build(stop_times_df.iter_slices(ROW_GROUP_SIZE)))
+            sink.close()
+        except Exception:
+            sink.abort()
+            raise
+    except Exception:
+        sink.abort()
+        raise
+
+    trip_patterns_df = patterns.trip_patterns_df()
+    sink = S3MultipartUpload(s3, bucket_name, keys['trip_patterns'])
+    try:
+        write_parquet_batches(sink, trip_patterns_df.iter_slices(ROW_GROUP_SIZE))
+        sink.close()
+    except Exception:
+        sink.abort()
+        raise
+    print(f'Successfully stored {patterns.count} stop patterns of {trip_patterns_df.height} trips in S3.')
+    return patterns.count, trip_patterns_df.height
+
+
+def build_stop_patterns(dataframes):
+    """
+    Compress stop_times into its stop patterns in memory, see StopPatterns.
+    :param dataframes: iterable of stop_times DataFrames (GTFS_SCHEMAS dtypes), sorted by trip_id and stop_sequence
+    :return: stop_patterns DataFrame (pattern_id, PATTERN_COLUMNS), sorted by pattern_id and stop_sequence, and
+    trip_patterns DataFrame (trip_id, pattern_id, start_time), sorted by trip_id
+    """
+    patterns = StopPatterns()
+    return pl.concat(list(patterns.build(dataframes))), patterns.trip_patterns_df()
+
+
+class StopPatterns:
+    """
+    Stop patterns of the trips of stop_times. The times of a trip are made relative to its start (the first time of
+    its first stop), and the trips with the same stops, sequences and relative times share a pattern.
+    A pattern is identified by the sums of two 64-bit hashes of its rows (lists with nulls can not be grouped or
+    hashed by this Polars version): the stop_sequence is in each row, so the order of the rows is part of the pattern.
+    """
+
+    STOP_PATTERNS_SCHEMA = {'pattern_id': pl.Int32, 'stop_sequence': pl.Int64, 'stop_id': pl.Int64,
+                            'arrival_offset': pl.Int32, 'departure_offset': pl.Int32}
+    TRIP_PATTERNS_SCHEMA = {'trip_id': pl.Int64, 'pattern_id': pl.Int32, 'start_time': pl.Int32}
+
+    def __init__(self):
+        self.known_df = pl.DataFrame(schema={**{column: pl.UInt64 for column in PATTERN_HASH_SEEDS},
+                                             'pattern_id': pl.Int32})
+        self.trip_patterns = [pl.DataFrame(schema=self.TRIP_PATTERNS_SCHEMA)]
+
+    @property
+    def count(self):
+        return self.known_df.height
+
+    def build(self, dataframes):
+        """
+        :param dataframes: iterable of stop_times DataFrames (GTFS_SCHEMAS dtypes), sorted by trip_id and
+        stop_sequence. The rows of a trip can span two DataFrames: the last trip of a DataFrame is completed with the
+        next one.
+        :return: generator of the rows of the new patterns (pattern_id, PATTERN_COLUMNS), sorted by pattern_id and
+        stop_sequence. UnsortedTableError is raised if the stop_times are not sorted.
+        """
+        yield pl.DataFrame(schema=self.STOP_PATTERNS_SCHEMA)
+        carry_df = None
+        previous_last = None
+        for df in dataframes:
+            check_sorted(df, SORT_COLUMNS['stop_times'], previous_last)
+            previous_last = df.select(SORT_COLUMNS['stop_times']).tail(1) if df.height else previous_last
+            df = df.select('trip_id', 'stop_sequence', 'stop_id', 'arrival_time', 'departure_time')
+            if carry_df is not None:
+                df = pl.concat([carry_df, df])
+            if not df.height:
+                continue
+            last_trip = df['trip_id'][-1]
+            carry_df = df.filter(pl.col('trip_id') == last_trip)
+            yield self._add(df.filter(pl.col('trip_id') != last_trip))
+        if carry_df is not None:
+            yield self._add(carry_df)
+
+    def trip_patterns_df(self):
+        """
+        :return: the trips added, their pattern_id and start_time, sorted by trip_id
+        """
+        return pl.concat(self.trip_patterns)
+
+    def _add(self, df):
+        """
+        Add complete trips to the patterns.
+        :return: the rows of the new patterns
+        """
+        # Start of each trip, from its first row (the rows are sorted by trip). A first stop without time (not valid
+        # GTFS) starts at 0.
+        first_row = pl.col('trip_id') != pl.col('trip_id').shift(1)
+        start = (pl.when(first_row.fill_null(True)).then(pl.coalesce('arrival_time', 'departure_time', 0))
+                 .forward_fill())
+        rows_df = df.select('trip_id', 'stop_sequence', 'stop_id', start.alias('start_time'),
+                            'arrival_time', 'departure_time').select(
+            'trip_id', 'stop_sequence', 'stop_id', 'start_time',
+            (pl.col('arrival_time') - pl.col('start_time')).alias('arrival_offset'),
+            (pl.col('departure_time') - pl.col('start_time')).alias('departure_offset'))
+        rows_df = rows_df.with_columns(pl.struct(PATTERN_COLUMNS).hash(seed).alias(column)
+                                       for column, seed in PATTERN_HASH_SEEDS.items())
+        hash_columns = list(PATTERN_HASH_SEEDS)
+        trips_df = rows_df.group_by('trip_id', maintain_order=True).agg(pl.col('start_time').first(),
+                                                                        pl.col(hash_columns).sum())
+
+        # The patterns of the batch already known, found with their first hash before joining on both: a join
+        # against all the known patterns would cost more as they grow
+        batch_df = trips_df.unique(subset=hash_columns, keep='first', maintain_order=True)
+        known_df = self.known_df.filter(pl.col(hash_columns[0]).is_in(batch_df[hash_columns[0]]))
+        # The first trip of each new pattern gives its rows
+        new_df = (batch_df.join(known_df, on=hash_columns, how='anti')
+                  .with_row_count('pattern_id', offset=self.known_df.height)
+                  .with_columns(pl.col('pattern_id').cast(pl.Int32)))
+        new_df = new_df.select(*self.known_df.columns, 'trip_id')
+        self.known_df = pl.concat([self.known_df, new_df.drop('trip_id')])
+        known_df = pl.concat([known_df, new_df.drop('trip_id')])
+        self.trip_patterns.append(trips_df.join(known_df, on=hash_columns, how='left')
+                                  .select('trip_id', 'pattern_id', 'start_time'))
+        return (rows_df.filter(pl.col('trip_id').is_in(new_df['trip_id']))
+                .join(new_df.select('trip_id', 'pattern_id'), on='trip_id')
+                .select('pattern_id', *PATTERN_COLUMNS))
+
+
+# Copy of S3MultipartUpload and _sha256 in STM_Merge_Daily_GTFS_VehiclePositions/main.py, keep them in sync
+class S3MultipartUpload:
+    """
+    Write-only file object that sends what is written to it as the parts of an S3 multipart upload, so the file is
+    never held entirely in memory or in /tmp. A file smaller than one part is stored with a single put_object.
+    """
+
+    def __init__(self, s3, bucket_name, key, part_size=None, metadata=None):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size or MULTIPART_PART_SIZE
+        self.metadata = metadata or {}
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Upload the last part and complete the upload.
+        """
+        if self.closed:
+            return
+        body = bytes(self.buffer)
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket_name, Key=self.key, Body=body, ChecksumSHA256=_sha256(body),
+                               Metadata=self.metadata)
+        else:
+            if body:
+                self._upload_part()
+            self.s3.complete_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+        self.closed = True
+
+    def abort(self):
+        """
+        Abort the upload so S3 does not keep the parts already uploaded.
+        """
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+        self.closed = True
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket_name, Key=self.key,
+                                                       ChecksumAlgorithm='SHA256', Metadata=self.metadata)
+            self.upload_id = response['UploadId']
+        body = bytes(self.buffer)
+        part_number = len(self.parts) + 1
+        checksum = _sha256(body)
+        response = self.s3.upload_part(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                       PartNumber=part_number, Body=body, ChecksumSHA256=checksum)
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag'], 'ChecksumSHA256': checksum})
+        self.buffer = bytearray()
 
-    # Clean up /tmp
-    os.remove(zip_tmp_path)
-    for filename in z.namelist():
-        os.remove(os.path.join('/tmp', filename))
 
-    # Step 5: Mettre à jour le fichier "Last_modified.txt" avec la nouvelle date. 
-    s3.put_object(Bucket=bucket_name, Key=LAST_MODIFIED_KEY, Body=last_modified)
\ No newline at end of file
+def _sha256(body):
+    return base64.b64encode(hashlib.sha256(body).digest()).decode('ascii')
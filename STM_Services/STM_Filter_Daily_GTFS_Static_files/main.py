@@ -1,9 +1,24 @@
 import polars as pl
 import boto3
+import io
+import json
 import os
 import pytz
-from datetime import datetime
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta
 
+# Versions of the static feed and their tables, written by STM_Fetch_Update_GTFS_Static_files
+FEED_INDEX_KEY = 'feed_index.json'
+# Version of the static feed stored before the feed index, with its tables at <table>/<table>.parquet
+LAST_MODIFIED_KEY = 'Last_modified.txt'
+# Service index of a version of the static feed, in the output bucket
+SERVICE_INDEX_KEY = 'service_index/service_index.parquet'
+VERSION_SERVICE_INDEX_KEY = 'service_index/{version}.parquet'
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+# Columns of stop_times used by the daily Lambdas, the other ones are not read
+STOP_TIMES_COLUMNS = ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence']
+# Stop patterns of the trips, derived from stop_times by STM_Fetch_Update_GTFS_Static_files
+PATTERN_TABLES = ['stop_patterns', 'trip_patterns']
 
 
 # Autodeploy
@@ -19,24 +34,16 @@ def lambda_handler(event, context):
     # Setup the timezone
     eastern = pytz.timezone(timezone)
 
-    # Extract the date from the event, or use the current date in the specified timezone
+    # Extract the date range from the event (YYYYMMDD), by default the passed date or the current date in the
+    # specified timezone. A range (ex: a backfill) loads the static files once per version of the feed.
     passed_date_str = event.get('date', datetime.now(eastern).strftime('%Y%m%d'))
+    start_date_str = event.get('start_date', passed_date_str)
+    end_date_str = event.get('end_date', start_date_str)
 
-    calendar_file_path = 'calendar/calendar.parquet'
-    trips_file_path = 'trips/trips.parquet'
-    stop_times_file_path = 'stop_times/stop_times.parquet'
-
-    # New: Parse the passed date instead of using datetime.now()
-    now = datetime.strptime(passed_date_str, '%Y%m%d').replace(tzinfo=eastern)
-
-    # Use the passed date and day of the week
-    current_date = now.strftime('%Y%m%d')
-    current_day_of_week = now.strftime('%A').lower()
-
-    # Define folder and file names for output
-    folder_name = now.strftime('%Y/%m/%d')
-    file_name = now.strftime('%Y-%m-%d')
-    output_base_path = f"{folder_name}/"
+    # New: Parse the passed dates instead of using datetime.now()
+    start_date = datetime.strptime(start_date_str, '%Y%m%d').date()
+    end_date = datetime.strptime(end_date_str, '%Y%m%d').date()
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
 
     def download_file_to_tmp(bucket, key):
         local_path = f"/tmp/{os.path.basename(key)}"
@@ -52,64 +59,257 @@ def lambda_handler(event, context):
     def write_df_to_parquet_to_tmp(df, local_path):
         df.write_parquet(local_path)
 
-    # Load calendar.csv from S3 into a DataFrame
-    local_calendar_file_path = download_file_to_tmp(input_bucket, calendar_file_path)
-    calendar_df = read_parquet_from_tmp(local_calendar_file_path)
+    # The days are grouped by the version of the static feed in effect on them, the tables of a version are loaded
+    # once for all its days
+    feed_index = load_feed_index(s3, input_bucket)
+    days_by_feed = {}
+    for day in days:
+        feed = resolve_feed_version(feed_index, day)
+        days_by_feed.setdefault(feed and feed['version'], (feed, []))[1].append(day)
+
+    for feed, feed_days in days_by_feed.values():
+        if feed is not None:
+            print(f"Static feed version {feed['version']} for {feed_days[0]} to {feed_days[-1]}")
+
+        # Dates where each service_id runs, built from calendar and calendar_dates once per version of the feed
+        service_index_df = load_service_index(s3, input_bucket, output_bucket, download_file_to_tmp,
+                                              read_parquet_from_tmp, feed)
+
+        # Load trips.csv from S3 into a DataFrame, and stop_times.csv as a lazy scan, once for all the days. Only
+        # the needed columns of stop_times are read, and as the file is clustered by trip_id, the row groups without
+        # a trip of the day are skipped with their trip_id statistics.
+        local_trips_file_path = download_file_to_tmp(input_bucket, table_key(feed, 'trips'))
+        # service_id is Categorical in the static files, joined here as a string with the service index
+        trips_df = read_parquet_from_tmp(local_trips_file_path).with_columns(pl.col('service_id').cast(pl.Utf8))
+        # A version with stop patterns gives the stop times of the day by expanding the patterns of its trips: a
+        # fraction of the size of stop_times to download and read. Otherwise, stop_times is scanned.
+        pattern_paths = []
+        if feed is not None and all(table in feed['tables'] for table in PATTERN_TABLES):
+            pattern_paths = [download_file_to_tmp(input_bucket, table_key(feed, table)) for table in PATTERN_TABLES]
+            stop_patterns_df, trip_patterns_df = (read_parquet_from_tmp(path) for path in pattern_paths)
+            stop_times_schema = trip_patterns_df.schema
+        else:
+            local_stop_times_file_path = download_file_to_tmp(input_bucket, table_key(feed, 'stop_times'))
+            stop_times_lf = pl.scan_parquet(local_stop_times_file_path)
+            stop_times_schema = stop_times_lf.schema
+            stop_times_lf = stop_times_lf.select([column for column in STOP_TIMES_COLUMNS
+                                                  if column in stop_times_schema])
+
+        for day in feed_days:
+            # Define folder and file names for output
+            folder_name = day.strftime('%Y/%m/%d')
+            file_name = day.strftime('%Y-%m-%d')
+            output_base_path = f"{folder_name}/"
+
+            # Keep only the 'service_id' values running this day
+            service_ids_df = (service_index_df.filter(pl.col('date') == day).select('service_id')
+                              .cast({'service_id': trips_df.schema['service_id']}))
+
+            # Merge DataFrames on service_id
+            filtered_trips_df = service_ids_df.join(trips_df, on='service_id')
+
+            # Write filtered_trips to /tmp and upload to S3
+            local_filtered_trips_path = f"/tmp/filtered_trips_{file_name}.parquet"
+            write_df_to_parquet_to_tmp(filtered_trips_df, local_filtered_trips_path)
+            upload_file_from_tmp(output_bucket,
+                                 f'{output_base_path}filtered_trips/filtered_trips_{file_name}.parquet',
+                                 local_filtered_trips_path)
+
+            # Semi-join of stop_times with the trips of the day. The trip_ids go in the scan as a predicate, so the
+            # reader skips row groups (a join is neither pushed down to the reader nor streamed by this Polars
+            # version).
+            day_trip_ids = filtered_trips_df['trip_id'].unique().cast(stop_times_schema['trip_id'])
+            local_filtered_stop_times_path = f"/tmp/filtered_stop_times_{file_name}.parquet"
+            if pattern_paths:
+                day_trip_patterns_df = trip_patterns_df.filter(pl.col('trip_id').is_in(day_trip_ids))
+                write_df_to_parquet_to_tmp(expand_stop_patterns(day_trip_patterns_df, stop_patterns_df),
+                                           local_filtered_stop_times_path)
+            else:
+                # Stream filtered_stop_times to /tmp
+                stop_times_lf.filter(pl.col('trip_id').is_in(day_trip_ids)).sink_parquet(local_filtered_stop_times_path)
+
+            # Upload filtered_stop_times to S3
+            upload_file_from_tmp(output_bucket,
+                                 f'{output_base_path}filtered_stop_times/filtered_stop_times_{file_name}.parquet',
+                                 local_filtered_stop_times_path)
+
+            os.remove(local_filtered_trips_path)
+            os.remove(local_filtered_stop_times_path)
+
+        # Clean up the /tmp directory
+        os.remove(local_trips_file_path)
+        for path in pattern_paths or [local_stop_times_file_path]:
+            os.remove(path)
+
+    return {
+        'statusCode': 200,
+        'body': f'Static files filtered from {start_date} to {end_date} ({len(days)} days).'
+    }
+
+
+def expand_stop_patterns(trip_patterns_df, stop_patterns_df):
+    """
+    Expand trips to their stop times: each trip gets the rows of its stop pattern, with the times of the pattern
+    shifted by the start time of the trip.
+    :param trip_patterns_df: trip_patterns table (trip_id, pattern_id, start_time), or the trips to expand
+    :param stop_patterns_df: stop_patterns table (pattern_id, stop_sequence, stop_id, arrival_offset,
+    departure_offset)
+    :return: Polars DataFrame with the STOP_TIMES_COLUMNS of stop_times, sorted by trip_id and stop_sequence
+    """
+    return (trip_patterns_df.join(stop_patterns_df, on='pattern_id')
+            .select('trip_id',
+                    (pl.col('start_time') + pl.col('arrival_offset')).alias('arrival_time'),
+                    (pl.col('start_time') + pl.col('departure_offset')).alias('departure_time'),
+                    'stop_id', 'stop_sequence')
+            .sort(['trip_id', 'stop_sequence']))
+
+
+def load_service_index(s3, static_bucket, index_bucket, download_file_to_tmp, read_parquet_from_tmp, feed=None):
+    """
+    Load the service index of a version of the static feed: one row per (service_id, date) where the service runs.
+    It is built from calendar and calendar_dates the first time the version is seen, and stored in the index bucket
+    with the version in its metadata.
+    :param s3: S3 client
+    :param static_bucket: Bucket of the static GTFS files
+    :param index_bucket: Bucket where the index is stored
+    :param feed: entry of the version in the feed index, None for the feed stored before the index (its version is
+    Last_modified.txt of the static bucket)
+    :return: Polars DataFrame with the columns 'service_id' (Utf8) and 'date' (Date)
+    """
+    if feed is not None:
+        feed_version = feed['version']
+        service_index_key = VERSION_SERVICE_INDEX_KEY.format(version=feed_version)
+    else:
+        feed_version = get_feed_version(s3, static_bucket)
+        service_index_key = SERVICE_INDEX_KEY
+    if feed_version is not None:
+        try:
+            response = s3.get_object(Bucket=index_bucket, Key=service_index_key)
+            if response.get('Metadata', {}).get('feed-version') == feed_version:
+                return pl.read_parquet(io.BytesIO(response['Body'].read()))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+
+    # calendar and calendar_dates are both optional in GTFS, as long as one of them is present
+    dfs = {}
+    for table in ['calendar', 'calendar_dates']:
+        key = table_key(feed, table)
+        dfs[table] = None
+        if key is None:
+            print(f'No {table} in the feed version {feed_version}')
+            continue
+        try:
+            local_path = download_file_to_tmp(static_bucket, key)
+        except ClientError as e:
+            print(f'No {table} in the static files: {e}')
+            continue
+        dfs[table] = read_parquet_from_tmp(local_path)
+        os.remove(local_path)
+
+    service_index_df = build_service_index(dfs['calendar'], dfs['calendar_dates'])
+    print(f'Service index built for the feed version {feed_version}: {service_index_df.height} service days')
+
+    buffer = io.BytesIO()
+    service_index_df.write_parquet(buffer)
+    s3.put_object(Bucket=index_bucket, Key=service_index_key, Body=buffer.getvalue(),
+                  Metadata={'feed-version': feed_version or ''})
+    return service_index_df
+
 
-    # Convert 'start_date' and 'end_date' to datetime format
-    # Check if they are not already in datetime format
-    if calendar_df['start_date'].dtype != pl.Date:
-        calendar_df = calendar_df.with_columns(pl.col('start_date').cast(pl.Utf8).str.strptime(pl.Date, "%Y%m%d"))
-    if calendar_df['end_date'].dtype != pl.Date:
-        calendar_df = calendar_df.with_columns(pl.col('end_date').cast(pl.Utf8).str.strptime(pl.Date, "%Y%m%d"))
+# Copy of load_feed_index, resolve_feed_version and table_key in STM_Create_Daily_Stops_Info/main.py, keep them in
+# sync (here the S3 client is a parameter and table_key returns None for a table missing from the version)
+def load_feed_index(s3, static_bucket):
+    """
+    :return: the versions of the static feed, in the order they were published, empty if the static bucket has no
+    feed index yet
+    """
+    try:
+        response = s3.get_object(Bucket=static_bucket, Key=FEED_INDEX_KEY)
+        return json.loads(response['Body'].read())['versions']
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return []
 
-    # Convert current_date to the same format for comparison
-    current_date = pl.lit(current_date).str.strptime(pl.Date, "%Y%m%d")
 
+def resolve_feed_version(feed_index, service_date):
+    """
+    Find the version of the static feed in effect on a service date: among the versions whose calendar covers the
+    date, the last one published on or before it. A date older than the publication of these versions (a backfill)
+    gets the first of them, and a date covered by no version the last version published.
+    :param feed_index: versions of the static feed, from load_feed_index
+    :param service_date: date of the service day
+    :return: entry of the version in the feed index, None if there is none
+    """
+    date_str = service_date.strftime('%Y%m%d')
+    covering = [feed for feed in feed_index
+                if feed['start_date'] is not None and feed['start_date'] <= date_str <= feed['end_date']]
+    published = [feed for feed in covering if feed['published'] <= date_str]
+    if published:
+        return published[-1]
+    if covering:
+        return covering[0]
+    return feed_index[-1] if feed_index else None
 
-    # Filter calendar DataFrame
-    calendar_df = calendar_df.filter((pl.col('start_date') <= current_date) & (pl.col('end_date') >= current_date))
-    calendar_df = calendar_df.filter(pl.col(current_day_of_week) == 1)
 
-    # Keep only the 'service_id' values
-    service_ids_df = calendar_df.select(['service_id'])
+def table_key(feed, table):
+    """
+    :return: key of a table of a version of the static feed, None if the version has no such table
+    """
+    if feed is None:
+        return f'{table}/{table}.parquet'
+    return feed['tables'].get(table)
 
-    # Write service_ids to /tmp and upload to S3
-    local_service_ids_path = f"/tmp/service_ids_{file_name}.parquet"
-    write_df_to_parquet_to_tmp(service_ids_df, local_service_ids_path)
-    #### ON N'UPLOAD PAS LE SERVICE ID finalement, il ne sert à rien par la suite. 
-    #upload_file_from_tmp(output_bucket, f'{output_base_path}service_ids/service_ids_{file_name}.parquet', local_service_ids_path)
 
-    # Load trips.csv from S3 into DataFrame
-    local_trips_file_path = download_file_to_tmp(input_bucket, trips_file_path)
-    trips_df = read_parquet_from_tmp(local_trips_file_path)
+def get_feed_version(s3, static_bucket):
+    """
+    :return: the Last-Modified of the static feed stored by STM_Fetch_Update_GTFS_Static_files, None if unknown
+    """
+    try:
+        response = s3.get_object(Bucket=static_bucket, Key=LAST_MODIFIED_KEY)
+        return response['Body'].read().decode('utf-8')
+    except ClientError as e:
+        print(f'Unknown version of the static feed: {e}')
+        return None
 
-    # Merge DataFrames on service_id
-    filtered_trips_df = service_ids_df.join(trips_df, on='service_id')
 
-    # Write filtered_trips to /tmp and upload to S3
-    local_filtered_trips_path = f"/tmp/filtered_trips_{file_name}.parquet"
-    write_df_to_parquet_to_tmp(filtered_trips_df, local_filtered_trips_path)
-    upload_file_from_tmp(output_bucket, f'{output_base_path}filtered_trips/filtered_trips_{file_name}.parquet', local_filtered_trips_path)
+def build_service_index(calendar_df, calendar_dates_df):
+    """
+    Expand the weekly patterns of calendar over their date range, then apply the exceptions of calendar_dates
+    (exception_type 1: service added on the date, 2: service removed on the date).
+    :param calendar_df: calendar table, or None
+    :param calendar_dates_df: calendar_dates table, or None
+    :return: Polars DataFrame with the columns 'service_id' (Utf8) and 'date' (Date), sorted by date
+    """
+    service_days = [pl.DataFrame(schema={'service_id': pl.Utf8, 'date': pl.Date})]
+    removed_days = service_days[0]
 
-    # Extract unique trip_ids from the filtered DataFrame
-    unique_trip_ids = filtered_trips_df.select('trip_id').unique().to_numpy().flatten()
+    if calendar_df is not None:
+        calendar_df = parse_gtfs_dates(calendar_df, ['start_date', 'end_date'])
+        runs_on_weekday = pl.lit(False)
+        for weekday_number, weekday in enumerate(WEEKDAYS, start=1):
+            runs_on_weekday = runs_on_weekday | ((pl.col('date').dt.weekday() == weekday_number) &
+                                                 (pl.col(weekday) == 1))
+        service_days.append(
+            calendar_df.select(pl.col('service_id').cast(pl.Utf8), pl.date_ranges('start_date', 'end_date').alias('date'),
+                               *WEEKDAYS)
+            .explode('date')
+            .filter(runs_on_weekday)
+            .select('service_id', 'date'))
 
-    # Load stop_times.csv from S3 into DataFrame
-    local_stop_times_file_path = download_file_to_tmp(input_bucket, stop_times_file_path)
-    stop_times_df = read_parquet_from_tmp(local_stop_times_file_path)
+    if calendar_dates_df is not None:
+        calendar_dates_df = parse_gtfs_dates(calendar_dates_df, ['date']).with_columns(pl.col('service_id').cast(pl.Utf8))
+        service_days.append(calendar_dates_df.filter(pl.col('exception_type') == 1).select('service_id', 'date'))
+        removed_days = calendar_dates_df.filter(pl.col('exception_type') == 2).select('service_id', 'date')
 
-    # Filter stop_times DataFrame based on trip_id
-    filtered_stop_times_df = stop_times_df.filter(pl.col('trip_id').is_in(unique_trip_ids))
+    return (pl.concat(service_days)
+            .join(removed_days, on=['service_id', 'date'], how='anti')
+            .unique()
+            .sort(['date', 'service_id']))
 
-    # Write filtered_stop_times to /tmp and upload to S3
-    local_filtered_stop_times_path = f"/tmp/filtered_stop_times_{file_name}.parquet"
-    write_df_to_parquet_to_tmp(filtered_stop_times_df, local_filtered_stop_times_path)
-    upload_file_from_tmp(output_bucket, f'{output_base_path}filtered_stop_times/filtered_stop_times_{file_name}.parquet', local_filtered_stop_times_path)
 
-    # Clean up the /tmp directory 
-    os.remove(local_calendar_file_path)
-    os.remove(local_service_ids_path)
-    os.remove(local_trips_file_path)
-    os.remove(local_filtered_trips_path)
-    os.remove(local_stop_times_file_path)
\ No newline at end of file
+def parse_gtfs_dates(df, columns):
+    # GTFS dates are YYYYMMDD, read as integers or strings depending on the file
+    return df.with_columns([pl.col(column).cast(pl.Utf8).str.strptime(pl.Date, '%Y%m%d')
+                            for column in columns if df[column].dtype != pl.Date])
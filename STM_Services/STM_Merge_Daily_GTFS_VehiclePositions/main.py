@@ -1,22 +1,133 @@
 import boto3
-import os
+import base64
+import hashlib
 import io
 import polars as pl
+import pyarrow.parquet as pq
+import os
+import re
+import shutil
+import tempfile
+import collections
 import concurrent.futures
+import threading
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from datetime import datetime, timedelta
 import pytz
 
+# Registry of the schemas of the VehiclePositions snapshots written by STM_Fetch_GTFS_VehiclePositions, by version.
+# The fetcher puts the version in the file name (..._<timefetch>.v<version>.parquet). The files written before the
+# registry (version 1, columns and dtypes inferred by pd.json_normalize) have no version and are resolved from
+# their Parquet footer.
+_VEHICLE_POSITIONS_SCHEMA_V2 = {
+    'id': pl.Utf8,
+    'vehicle_congestionLevel': pl.Utf8,
+    'vehicle_currentStatus': pl.Utf8,
+    'vehicle_currentStopSequence': pl.Int64,
+    'vehicle_occupancyPercentage': pl.Int64,
+    'vehicle_occupancyStatus': pl.Utf8,
+    'vehicle_position_bearing': pl.Float64,
+    'vehicle_position_latitude': pl.Float64,
+    'vehicle_position_longitude': pl.Float64,
+    'vehicle_position_odometer': pl.Float64,
+    'vehicle_position_speed': pl.Float64,
+    'vehicle_stopId': pl.Utf8,
+    'vehicle_timestamp': pl.Int64,
+    'vehicle_trip_directionId': pl.Int64,
+    'vehicle_trip_routeId': pl.Utf8,
+    'vehicle_trip_scheduleRelationship': pl.Utf8,
+    'vehicle_trip_startDate': pl.Utf8,
+    'vehicle_trip_startTime': pl.Utf8,
+    'vehicle_trip_tripId': pl.Utf8,
+    'vehicle_vehicle_id': pl.Utf8,
+    'vehicle_vehicle_label': pl.Utf8,
+    'vehicle_vehicle_licensePlate': pl.Utf8,
+}
+
+VEHICLE_POSITIONS_SCHEMAS = {
+    2: _VEHICLE_POSITIONS_SCHEMA_V2,
+    # Micro-batch file: several snapshots, each one with its own 'timefetch'
+    3: {**_VEHICLE_POSITIONS_SCHEMA_V2, 'timefetch': pl.Int64},
+}
+
+SCHEMA_VERSION_PATTERN = re.compile(r'\.v(\d+)\.parquet$')
+
+# Bytes read at the end of a file to get its Parquet footer in one request (a snapshot footer is a few KB)
+PARQUET_FOOTER_READ_SIZE = 64 * 1024
+
+# Dtypes of the hourly parts and of the daily file that differ from the snapshots, the ones used by the analysis
+DAILY_DTYPES = {
+    'id': pl.Int32,
+    'vehicle_trip_routeId': pl.Int64,
+    'vehicle_trip_tripId': pl.Int64,
+}
+
+# Order of the rows of the hourly parts and of the daily file, so the row groups are clustered by trip
+SORT_COLUMNS = ['vehicle_trip_tripId', 'vehicle_currentStopSequence', 'timefetch']
+# Columns with min/max statistics, in the row groups and in the page index, used by the readers to skip data
+STATISTICS_COLUMNS = ['timefetch', 'vehicle_currentStopSequence', 'vehicle_trip_routeId', 'vehicle_trip_tripId']
+
+# The rows of a day fetched before <day> HEAD_HOURS:00 are also written in the head file of the day. The analysis of
+# the day before reads it instead of the whole daily file: it only matches the positions of its trips running after
+# midnight, up to its latest arrival plus the tolerance of the match. Copied in STM_Analyse_Daily_Stops_Data/main.py,
+# keep them in sync
+HEAD_HOURS = 6
+
+# An observation is identified by its vehicle and the timestamp reported by the vehicle: the snapshots taken before
+# the vehicle reports again (parked vehicle, feed not refreshed) repeat it and are suppressed
+OBSERVATION_COLUMNS = ['vehicle_vehicle_id', 'vehicle_timestamp']
+
+# The daily file is streamed to S3: rows are buffered up to a row group, and bytes up to a part of the multipart upload
+ROW_GROUP_SIZE = 128 * 1024
+# Smaller row groups in the hourly parts, the daily file is merged from one row group of each part at a time
+PART_ROW_GROUP_SIZE = 4 * 1024
+# Rows of a sorted run of the hourly compaction: the snapshots of an hour are sorted by runs spilled to /tmp, then the
+# runs are merged one row group of each at a time. Single snapshots would make an hour of thousands of runs, and the
+# merge holds a row group of each one.
+RUN_SIZE = 64 * PART_ROW_GROUP_SIZE
+# Rows of the snapshots concatenated before the suppression of the repeated observations (a snapshot is about a
+# thousand rows, the cost of the suppression is mostly per DataFrame)
+SNAPSHOT_BATCH_SIZE = 8 * PART_ROW_GROUP_SIZE
+MULTIPART_PART_SIZE = 8 * 1024 * 1024  # S3 minimum is 5 MiB, except for the last part
+
+# Upper bound of the GETs in flight, the actual limit adapts to the throughput and the throttling of S3
+MAX_CONCURRENCY = 32
+THROTTLING_ERROR_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', '503'}
+MAX_THROTTLED_ATTEMPTS = 5
+
+# Set up S3, one client (thread-safe, with its connection pool) shared by the threads and reused between the
+# invocations of a warm container
+s3 = boto3.client('s3', config=Config(max_pool_connections=MAX_CONCURRENCY))
+
 
 def lambda_handler(event, context):
-    s3 = boto3.client('s3')
     input_bucket = event['input_bucket'] 
     output_bucket = event['output_bucket']
     timezone = event.get('timezone', 'America/Montreal')  # Default to 'America/Montreal' if not specified
-    workers = event.get('workers', 1) # Default 1
+    workers = event.get('workers', 1) # Default 1, GETs in flight at the start, adapted up to MAX_CONCURRENCY
+    mode = event.get('mode', 'daily')  # 'hourly' compacts one hour, 'daily' concatenates the hours of a day
 
     # Initialize the timezone
     eastern = pytz.timezone(timezone)
 
+    if mode == 'hourly':
+        # Extract the hour (YYYYMMDDHH) from the event, or use the previous hour in the specified timezone
+        hour_str = event.get('hour', (datetime.now(eastern) - timedelta(hours=1)).strftime('%Y%m%d%H'))
+        hour_start = eastern.localize(datetime.strptime(hour_str, '%Y%m%d%H'))
+
+        # We use "Bucket/YYYY/MM/DD/... as a folder structure, the snapshots of the hour are in the folder of its day
+        prefix = f"{hour_start.strftime('%Y/%m/%d')}/"
+        file_keys = get_hour_keys(list_parquet_keys(input_bucket, prefix), int(hour_start.timestamp()))
+        rows = compact_hour(input_bucket, output_bucket, hour_start, file_keys, workers)
+
+        return {
+            'statusCode': 200,
+            'body': f'Hour {hour_str} compacted successfully.',
+            'rows': rows
+        }
+
     # Extract the date from the event, or use the current date in the specified timezone
     date_str = event.get('date', datetime.now(eastern).strftime('%Y%m%d'))
 
@@ -30,110 +141,707 @@ def lambda_handler(event, context):
     folder_structure = date_obj.strftime('%Y/%m/%d')
     prefix = f"{folder_structure}/"
 
-    all_columns = set()
+    # Hourly parts of the day. The hours that were not compacted (ex: failed hourly run) are compacted now.
+    hour_starts = get_day_hour_starts(eastern.localize(date_obj))
+    part_keys = set(list_parquet_keys(output_bucket, f'{folder_structure}/hourly/'))
+    missing_hours = [hour_start for hour_start in hour_starts if get_hour_part_key(hour_start) not in part_keys]
+    if missing_hours:
+        # Paginate through files in the S3 bucket
+        file_keys = list_parquet_keys(input_bucket, prefix)
+        for hour_start in missing_hours:
+            hour_keys = get_hour_keys(file_keys, int(hour_start.timestamp()))
+            if compact_hour(input_bucket, output_bucket, hour_start, hour_keys, workers):
+                part_keys.add(get_hour_part_key(hour_start))
+
+    # Merge the sorted parts, one row group of each part at a time. The observations repeated from one hour to the
+    # next are suppressed on the way.
+    part_keys = [get_hour_part_key(hour_start) for hour_start in hour_starts
+                 if get_hour_part_key(hour_start) in part_keys]
+    schema = resolve_schema(output_bucket, part_keys)
+    output_file_key = f'{folder_structure}/Daily_GTFS_VehiclePosition_{formatted_date}.parquet'
+    head_file_key = f'{folder_structure}/Daily_GTFS_VehiclePosition_{formatted_date}_head.parquet'
+    head_end = int(eastern.localize(date_obj + timedelta(hours=HEAD_HOURS)).timestamp())
+    parts = [read_row_groups(output_bucket, part_key, schema) for part_key in part_keys]
+    counts = {'observations': 0, 'suppressed_rows': 0}
+    dfs = drop_repeated_observations(merge_sorted(parts, get_sort_columns(schema)), counts)
+    with tempfile.TemporaryDirectory() as head_dir:
+        # The head is written to /tmp while the daily file is uploaded, then uploaded from there
+        head_path = os.path.join(head_dir, os.path.basename(head_file_key))
+        upload_to_s3(output_bucket, output_file_key, write_day_head(dfs, head_path, head_end, schema), schema)
+        upload_to_s3(output_bucket, head_file_key, read_local_row_groups(head_path), schema)
+
+    # The observations suppressed when the hours were compacted are not in the parts anymore
+    hourly_suppressed_rows = sum(get_suppressed_rows(output_bucket, part_key) for part_key in part_keys)
+    observations = counts['observations'] + hourly_suppressed_rows
+    suppressed_rows = counts['suppressed_rows'] + hourly_suppressed_rows
+    dedup_ratio = suppressed_rows / observations if observations else 0.0
+    print(f'{formatted_date}: {suppressed_rows} repeated observations suppressed out of {observations} '
+          f'(dedup ratio {dedup_ratio:.1%})')
 
-    # Paginate through files in the S3 bucket
+    return {
+        'statusCode': 200,
+        'body': 'Data processing and upload completed successfully.',
+        'observations': observations,
+        'suppressed_rows': suppressed_rows,
+        'dedup_ratio': dedup_ratio
+    }
+
+
+def list_parquet_keys(bucket_name, prefix):
+    """
+    :return: the keys of the Parquet files under the prefix, in the order of S3 (the order of timefetch)
+    """
     paginator = s3.get_paginator('list_objects_v2')
     file_keys = []
-    for page in paginator.paginate(Bucket=input_bucket, Prefix=prefix):
-        for content in page['Contents']:
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for content in page.get('Contents', []):
             file_key = content['Key']
             if file_key.endswith('.parquet'):
                 file_keys.append(file_key)
-                try:
-                    df = download_from_s3(input_bucket, file_key)
-                    all_columns.update(df.columns)
-                except Exception as e:
-                    print(f"Error processing file: {file_key}")
-                    print(e)
-                    continue
-
-    all_columns.add('timefetch')
-    all_columns = sorted(all_columns)  # Convert to a sorted list for consistent order
-
-    # Process files
-    processed_dfs = process_files(file_keys, all_columns, input_bucket, workers)
-    merged_df = pl.concat(processed_dfs)
-
-    # Upload merged DataFrame to S3
-    output_file_key = f'{folder_structure}/Daily_GTFS_VehiclePosition_{formatted_date}.parquet'
-    upload_to_s3(output_bucket, output_file_key, merged_df)
+    return file_keys
+
+
+def get_timefetch(file_key):
+    # The UNIX timestamp is located before the '.parquet' (or '.v<version>.parquet') in the file name
+    return int(file_key.split('_')[-1].split('.')[0])
 
-    return {
-        'statusCode': 200,
-        'body': 'Data processing and upload completed successfully.'
-    }
 
+def get_hour_keys(file_keys, hour_start_unix):
+    """
+    :return: the keys of the snapshots fetched during the hour starting at hour_start_unix
+    """
+    hour_keys = []
+    for file_key in file_keys:
+        try:
+            timefetch = get_timefetch(file_key)
+        except ValueError:
+            print(f"Error extracting UNIX timestamp from file name: {file_key}")
+            continue
+        if hour_start_unix <= timefetch < hour_start_unix + 3600:
+            hour_keys.append(file_key)
+    return hour_keys
+
+
+def get_day_hour_starts(day_start):
+    """
+    :param day_start: midnight of the day, localized in the timezone of the fetchers
+    :return: the starts of the hours of the day (23 or 25 hours on the days of a DST change), localized
+    """
+    next_day_start = day_start.tzinfo.localize(day_start.replace(tzinfo=None) + timedelta(days=1))
+    return [datetime.fromtimestamp(unix, day_start.tzinfo)
+            for unix in range(int(day_start.timestamp()), int(next_day_start.timestamp()), 3600)]
+
+
+def get_hour_part_key(hour_start):
+    # The UNIX time of the start of the hour keeps the key unique when the clock goes back at the end of the DST
+    return f"{hour_start.strftime('%Y/%m/%d')}/hourly/Hourly_GTFS_VehiclePosition_{int(hour_start.timestamp())}.parquet"
+
+
+def compact_hour(input_bucket, output_bucket, hour_start, file_keys, workers):
+    """
+    Compact the snapshots of an hour in one Parquet part, sorted by trip, stop sequence and timefetch. Only the first
+    snapshot of each observation is kept, the number of suppressed rows is stored in the 'suppressed-rows' metadata
+    of the part. The key of the part only depends on the hour, so running it again replaces the part and the other
+    hours are not affected.
+    :param input_bucket: Bucket of the snapshots
+    :param output_bucket: Bucket of the hourly parts
+    :param hour_start: start of the hour, localized
+    :param file_keys: keys of the snapshots of the hour
+    :param workers: number of threads downloading the snapshots
+    :return: number of rows of the part, 0 if the hour has no snapshots (no part is written)
+    """
+    part_key = get_hour_part_key(hour_start)
+    if not file_keys:
+        print(f'No snapshots for the hour of {part_key}')
+        return 0
+
+    # Columns and dtypes of the hour, without downloading the snapshots
+    schema = resolve_schema(input_bucket, file_keys)
+    sort_columns = get_sort_columns(schema)
+
+    # The snapshots come in the order of timefetch, so the repeated observations are suppressed as they are read. The
+    # hour is then sorted by runs of RUN_SIZE rows written to /tmp, and the runs are merged: the memory used depends
+    # on the size of a run, not on the size of the hour.
+    counts = {'observations': 0, 'suppressed_rows': 0}
+    snapshots = concat_batches(process_files(file_keys, schema, input_bucket, workers), SNAPSHOT_BATCH_SIZE)
+    dfs = drop_repeated_observations(snapshots, counts)
+    with tempfile.TemporaryDirectory() as run_dir:
+        run_paths = write_sorted_runs(dfs, schema, sort_columns, run_dir)
+        if not run_paths:
+            return 0
+        dfs = merge_sorted([read_local_row_groups(path) for path in run_paths], sort_columns)
+        return upload_to_s3(output_bucket, part_key, dfs, schema, row_group_size=PART_ROW_GROUP_SIZE,
+                            metadata={'suppressed-rows': str(counts['suppressed_rows'])})
+
+
+def write_sorted_runs(dataframes, schema, sort_columns, run_dir):
+    """
+    Sort a stream of DataFrames by runs of about RUN_SIZE rows, each run written to its own Parquet file.
+    :param dataframes: iterable of Polars DataFrames following the schema
+    :param schema: dict column name -> Polars dtype, from resolve_schema
+    :param sort_columns: the columns of the sort
+    :param run_dir: local directory of the runs
+    :return: paths of the runs, each one sorted by sort_columns with the nulls first
+    """
+    arrow_schema = pl.DataFrame(schema=dict(sorted(schema.items()))).to_arrow().schema
+    run_paths = []
+    for run in concat_batches(dataframes, RUN_SIZE):
+        path = os.path.join(run_dir, f'run_{len(run_paths)}.parquet')
+        with pq.ParquetWriter(path, arrow_schema) as writer:
+            writer.write_table(run.sort(sort_columns).to_arrow(), row_group_size=PART_ROW_GROUP_SIZE)
+        run_paths.append(path)
+    return run_paths
+
+
+def concat_batches(dataframes, batch_rows):
+    """
+    Concatenate a stream of DataFrames in batches of at least batch_rows rows (the last one can be smaller), in the
+    order of the stream. The empty DataFrames are dropped.
+    """
+    pending = []
+    pending_rows = 0
+    for df in dataframes:
+        if df.is_empty():
+            continue
+        pending.append(df)
+        pending_rows += df.height
+        if pending_rows >= batch_rows:
+            yield pl.concat(pending)
+            pending = []
+            pending_rows = 0
+    if pending:
+        yield pl.concat(pending)
+
+
+def read_local_row_groups(path):
+    """
+    Yield the row groups of a local Parquet file (ex: a sorted run) one at a time. The file is memory-mapped, only
+    the row group being decoded is read.
+    """
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    for i in range(parquet_file.num_row_groups):
+        yield pl.from_arrow(parquet_file.read_row_group(i))
+
+
+def get_suppressed_rows(bucket_name, part_key):
+    """
+    :return: number of repeated observations suppressed when the hourly part was compacted (0 for the parts
+    compacted before the suppression)
+    """
+    response = s3.head_object(Bucket=bucket_name, Key=part_key)
+    return int(response.get('Metadata', {}).get('suppressed-rows', 0))
+
+
+def drop_repeated_observations(dataframes, counts):
+    """
+    Drop the rows repeating the last observation (vehicle, vehicle timestamp) of their vehicle in a stream. The last
+    observation of each vehicle is carried from one DataFrame to the next, so the repetitions are found across the
+    DataFrames of the stream (ex: a vehicle parked from one hour to the next), and also when the rows of the vehicles
+    are interleaved (ex: the vehicles without a trip, sorted by timefetch).
+    :param dataframes: iterable of Polars DataFrames, with the rows of each vehicle in the order of timefetch (ex: the
+    snapshots of an hour, or the stream sorted by SORT_COLUMNS)
+    :param counts: dict updated with the number of 'observations' read and of 'suppressed_rows'
+    :return: generator of the Polars DataFrames without the repeated rows
+    """
+    vehicle, timestamp = OBSERVATION_COLUMNS
+    last_observations = None
+    repeated = (pl.col(vehicle).is_not_null() &
+                (pl.col(timestamp) == pl.col(timestamp).shift(1).over(vehicle))).fill_null(False)
+    for df in dataframes:
+        counts['observations'] += df.height
+        if df.is_empty() or not all(col in df.columns for col in OBSERVATION_COLUMNS):
+            yield df
+            continue
+        keys = df.select(OBSERVATION_COLUMNS)
+        if last_observations is not None:
+            keys = pl.concat([last_observations, keys])
+        mask = keys.select(repeated)[:, 0].slice(keys.height - df.height)
+        # One row per vehicle, the memory does not depend on the length of the stream
+        last_observations = keys.group_by(vehicle).last()
+        counts['suppressed_rows'] += mask.sum()
+        yield df.filter(~mask)
+
+
+def select_day_head(df, head_end, sort_columns):
+    """
+    Select the rows of the head of a day in a DataFrame of the sorted daily stream: the rows fetched before head_end,
+    and for each (trip, stop sequence) of the rows fetched after it, its last row with only the sort columns. The
+    analysis compares each position to the stop sequence of the row before it in the sort (the last position of the
+    previous trip for the first position of a trip): with these rows, each position of the head has the same stop
+    sequence before it as in the daily file. Their status is null, the analysis drops them.
+    :param df: Polars DataFrame of the stream, sorted by sort_columns
+    :param head_end: UNIX time of the end of the head
+    :param sort_columns: the columns of the sort, timefetch last
+    :return: Polars DataFrame with the columns of df, in the same order
+    """
+    columns = df.columns
+    df = df.with_row_count('row')
+    fetched = pl.col('timefetch') < head_end
+    # The last row of each stop sequence keeps its place in the stream
+    ends = df.filter(~fetched).group_by(sort_columns[:-1]).agg(pl.col('timefetch', 'row').last())
+    return pl.concat([df.filter(fetched), ends], how='diagonal').sort('row').select(columns)
+
+
+def write_day_head(dataframes, path, head_end, schema):
+    """
+    Yield the DataFrames of the sorted daily stream, and write the head of the day (see select_day_head) in a local
+    Parquet file as they go through.
+    :param dataframes: iterable of Polars DataFrames following the schema, sorted by SORT_COLUMNS
+    :param path: local path of the Parquet file of the head
+    :param head_end: UNIX time of the end of the head
+    :param schema: dict column name -> Polars dtype, from resolve_schema
+    """
+    sort_columns = get_sort_columns(schema)
+    arrow_schema = pl.DataFrame(schema=dict(sorted(schema.items()))).to_arrow().schema
+    with pq.ParquetWriter(path, arrow_schema) as writer:
+        for df in dataframes:
+            df_head = select_day_head(df, head_end, sort_columns)
+            if not df_head.is_empty():
+                writer.write_table(df_head.to_arrow())
+            yield df
 
-def download_from_s3(bucket_name, file_key):
-    s3 = boto3.client('s3')
+
+def get_sort_columns(schema):
+    return [col for col in SORT_COLUMNS if col in schema]
+
+
+def merge_sorted(sources, sort_columns):
+    """
+    Merge sorted streams of DataFrames into one sorted stream, holding about one chunk of each source in memory. The
+    rows are emitted up to the watermark, the smallest of the last values of the first sort column in the buffers:
+    no source can have rows below it anymore. The rows where the first sort column is null (sorted first in each
+    source) are emitted as soon as they are read.
+    :param sources: list of iterables of Polars DataFrames, each one sorted by sort_columns with the nulls first
+    :param sort_columns: the columns of the sort
+    :return: generator of Polars DataFrames, sorted by sort_columns once concatenated
+    """
+    key = sort_columns[0]
+    sources = [iter(source) for source in sources]
+    buffers = [None] * len(sources)
+    open_sources = set(range(len(sources)))
+    nulls = []
+
+    def load(i):
+        # Append the next chunk of the source to its buffer
+        chunk = next(sources[i], None)
+        if chunk is None:
+            open_sources.discard(i)
+            return
+        nulls.append(chunk.filter(pl.col(key).is_null()))
+        chunk = chunk.filter(pl.col(key).is_not_null())
+        buffers[i] = chunk if buffers[i] is None else pl.concat([buffers[i], chunk])
+
+    while True:
+        # Each open source needs rows in its buffer to know up to which value it has been read
+        for i in list(open_sources):
+            while i in open_sources and (buffers[i] is None or buffers[i].is_empty()):
+                load(i)
+        if any(df.height for df in nulls):
+            yield pl.concat(nulls).sort(sort_columns)
+        nulls = []
+
+        live = [i for i in range(len(buffers)) if buffers[i] is not None and not buffers[i].is_empty()]
+        if not open_sources:
+            # All sources are read, the rest of the buffers goes out
+            if live:
+                yield pl.concat([buffers[i] for i in live]).sort(sort_columns)
+            return
+
+        watermark = min(buffers[i][key][-1] for i in open_sources)
+        ready = []
+        for i in live:
+            position = buffers[i][key].search_sorted(watermark, side='left')
+            if position:
+                ready.append(buffers[i].slice(0, position))
+                buffers[i] = buffers[i].slice(position)
+        if ready:
+            yield pl.concat(ready).sort(sort_columns)
+        else:
+            # The sources at the watermark hold nothing else, they need their next chunk
+            for i in [i for i in open_sources if buffers[i][key][-1] == watermark]:
+                load(i)
+
+
+def download_from_s3(bucket_name, file_key, concurrency=None):
+    """
+    Download and decode a Parquet file. A GET throttled by S3 is retried with a backoff, and its outcome is reported
+    to the concurrency controller of the engine.
+    :param bucket_name: Bucket name in S3
+    :param file_key: key of the Parquet file
+    :param concurrency: AdaptiveConcurrency of process_files, if any
+    :return: Polars DataFrame, or None if the file can't be downloaded
+    """
+    for attempt in range(MAX_THROTTLED_ATTEMPTS):
+        try:
+            response = s3.get_object(Bucket=bucket_name, Key=file_key)
+            body = response['Body'].read()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES and attempt + 1 < MAX_THROTTLED_ATTEMPTS:
+                if concurrency is not None:
+                    concurrency.on_throttle()
+                time.sleep(0.1 * 2 ** attempt)
+                continue
+            print(f"Error downloading file {file_key} from S3: {e}")
+            return None
+        except Exception as e:
+            print(f"Error downloading file {file_key} from S3: {e}")
+            return None
+
+        if concurrency is not None:
+            # The SDK retried the request: S3 is slowing us down even if the GET succeeded in the end
+            if response.get('ResponseMetadata', {}).get('RetryAttempts'):
+                concurrency.on_throttle()
+            else:
+                concurrency.on_success(len(body))
+
+        try:
+            return pl.read_parquet(io.BytesIO(body))
+        except Exception as e:
+            print(f"Error decoding file {file_key}: {e}")
+            return None
+
+
+class AdaptiveConcurrency:
+    """
+    Limit of the GETs in flight, adapted to what S3 delivers. The limit doubles while the throughput of a window of
+    requests improves (slow start), then grows by one; it goes down by one when the throughput drops and by a quarter
+    when S3 throttles.
+    """
+
+    def __init__(self, initial, maximum=None):
+        self.maximum = max(maximum or MAX_CONCURRENCY, 1)
+        self.limit = min(max(initial, 1), self.maximum)
+        self.slow_start = True
+        self.throttled = 0
+        self.last_throughput = 0.0
+        self._lock = threading.Lock()
+        self._backed_off = False
+        self._reset_window()
+
+    def on_success(self, size):
+        with self._lock:
+            self._backed_off = False
+            self.window_bytes += size
+            self.window_requests += 1
+            if self.window_requests < self.limit:
+                return
+            elapsed = time.perf_counter() - self.window_start
+            throughput = self.window_bytes / elapsed if elapsed > 0 else 0.0
+            if throughput >= self.last_throughput * 0.95:
+                self.limit = min(self.limit * 2 if self.slow_start else self.limit + 1, self.maximum)
+            else:
+                self.slow_start = False
+                self.limit = max(self.limit - 1, 1)
+            self.last_throughput = throughput
+            self._reset_window()
+
+    def on_throttle(self):
+        with self._lock:
+            self.throttled += 1
+            # The GETs in flight are often throttled together, the limit is only cut once for them
+            if self._backed_off:
+                return
+            self._backed_off = True
+            self.slow_start = False
+            self.limit = max(self.limit * 3 // 4, 1)
+            # The throughput before the cut is not a reference for the new limit
+            self.last_throughput = 0.0
+            self._reset_window()
+
+    def _reset_window(self):
+        self.window_start = time.perf_counter()
+        self.window_bytes = 0
+        self.window_requests = 0
+
+
+def get_schema_version(file_key):
+    """
+    :param file_key: key of a snapshot file
+    :return: the version of the schema of the file in VEHICLE_POSITIONS_SCHEMAS, or None if the file name has none
+    """
+    match = SCHEMA_VERSION_PATTERN.search(file_key)
+    return int(match.group(1)) if match else None
+
+
+def read_parquet_schema(bucket_name, file_key):
+    """
+    Read the schema of a Parquet file on S3 from its footer only, with ranged GETs: the data is never downloaded.
+    A Parquet file ends with <footer><footer length (4 bytes, little-endian)>PAR1.
+    :param bucket_name: Bucket name in S3
+    :param file_key: key of the Parquet file
+    :return: dict column name -> Polars dtype, or None if the footer can't be read
+    """
     try:
-        response = s3.get_object(Bucket=bucket_name, Key=file_key)
-        return pl.read_parquet(io.BytesIO(response['Body'].read()))
+        response = s3.get_object(Bucket=bucket_name, Key=file_key, Range=f'bytes=-{PARQUET_FOOTER_READ_SIZE}')
+        tail = response['Body'].read()
+        footer_length = int.from_bytes(tail[-8:-4], 'little')
+        if footer_length + 8 > len(tail):
+            # Footer larger than the first read, get it entirely
+            response = s3.get_object(Bucket=bucket_name, Key=file_key, Range=f'bytes=-{footer_length + 8}')
+            tail = response['Body'].read()
+        # Only the footer is parsed, so the column chunks in front of it don't need to be there
+        footer = b'PAR1' + tail[-(footer_length + 8):]
+        return dict(pl.read_parquet_schema(io.BytesIO(footer)))
     except Exception as e:
-        print(f"Error downloading file {file_key} from S3: {e}")
+        print(f"Error reading the schema of file {file_key} from S3: {e}")
         return None
 
 
-def upload_to_s3(bucket_name, key, dataframe):
-    s3 = boto3.client('s3')
-    temp_file_path = '/tmp/file.parquet'
+def resolve_schema(bucket_name, file_keys):
+    """
+    Resolve the columns of the daily file from the schema registry, and from the Parquet footers of the files
+    without a known version. When a column is in the registry, its dtype is the one of the latest version (or the
+    one of DAILY_DTYPES), so the snapshots written before the registry are cast to the typed columns.
+    :param bucket_name: Bucket name in S3
+    :param file_keys: keys of the snapshot files of the day
+    :return: dict column name -> Polars dtype, sorted by column name, including 'timefetch'
+    """
+    registry_dtypes = {}
+    for version in sorted(VEHICLE_POSITIONS_SCHEMAS):
+        registry_dtypes.update(VEHICLE_POSITIONS_SCHEMAS[version])
+    registry_dtypes.update(DAILY_DTYPES)
+
+    schema = {'timefetch': pl.Int64}
+    unknown_files = 0
+    for file_key in file_keys:
+        version = get_schema_version(file_key)
+        if version in VEHICLE_POSITIONS_SCHEMAS:
+            file_schema = VEHICLE_POSITIONS_SCHEMAS[version]
+        else:
+            unknown_files += 1
+            file_schema = read_parquet_schema(bucket_name, file_key)
+            if file_schema is None:
+                continue
+        for col, dtype in file_schema.items():
+            # A column that is null in all the rows of a file has no dtype (ex: an hour without congestion level)
+            if schema.get(col, pl.Null) == pl.Null:
+                schema[col] = registry_dtypes.get(col, dtype)
+
+    print(f'Schema resolved for {len(file_keys)} files, {unknown_files} from their Parquet footer')
+    return dict(sorted(schema.items()))
+
+
+# S3MultipartUpload and _sha256 are copied in STM_Fetch_Update_GTFS_Static_files/main.py (each Lambda is packaged
+# alone): keep them in sync
+class S3MultipartUpload:
+    """
+    Write-only file object that sends what is written to it as the parts of an S3 multipart upload, so the file is
+    never held entirely in memory or in /tmp. A file smaller than one part is stored with a single put_object.
+    """
+
+    def __init__(self, s3, bucket_name, key, part_size=None, metadata=None):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size or MULTIPART_PART_SIZE
+        self.metadata = metadata or {}
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Upload the last part and complete the upload.
+        """
+        if self.closed:
+            return
+        body = bytes(self.buffer)
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket_name, Key=self.key, Body=body, ChecksumSHA256=_sha256(body),
+                               Metadata=self.metadata)
+        else:
+            if body:
+                self._upload_part()
+            self.s3.complete_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+        self.closed = True
+
+    def abort(self):
+        """
+        Abort the upload so S3 does not keep the parts already uploaded.
+        """
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+        self.closed = True
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket_name, Key=self.key,
+                                                       ChecksumAlgorithm='SHA256', Metadata=self.metadata)
+            self.upload_id = response['UploadId']
+        body = bytes(self.buffer)
+        part_number = len(self.parts) + 1
+        checksum = _sha256(body)
+        response = self.s3.upload_part(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                       PartNumber=part_number, Body=body, ChecksumSHA256=checksum)
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag'], 'ChecksumSHA256': checksum})
+        self.buffer = bytearray()
+
+
+def _sha256(body):
+    return base64.b64encode(hashlib.sha256(body).digest()).decode('ascii')
 
-    try:
-        # Save DataFrame to Parquet file in /tmp with gzip compression
-        dataframe.write_parquet(temp_file_path, compression="gzip")
 
-        # Upload the file to S3
-        s3.upload_file(temp_file_path, bucket_name, key)
-        print(f'Successfully stored {key} in S3.')
+def upload_to_s3(bucket_name, key, dataframes, schema, row_group_size=ROW_GROUP_SIZE, metadata=None):
+    """
+    Stream DataFrames in a single Parquet file on S3. The rows are written by row groups of row_group_size rows, with
+    min/max statistics on STATISTICS_COLUMNS, and the bytes are uploaded by parts as they are written, so the memory
+    used does not depend on the size of the file.
+    :param bucket_name: Bucket name in S3
+    :param key: the key under which to store the file
+    :param dataframes: iterable of Polars DataFrames following the schema
+    :param schema: dict column name -> Polars dtype, from resolve_schema
+    :param row_group_size: number of rows of a row group
+    :param metadata: optional user metadata of the object
+    :return: number of rows written
+    """
+    sink = S3MultipartUpload(s3, bucket_name, key, metadata=metadata)
+    arrow_schema = pl.DataFrame(schema=dict(sorted(schema.items()))).to_arrow().schema
+
+    rows = 0
+    try:
+        statistics = [col for col in STATISTICS_COLUMNS if col in schema]
+        with pq.ParquetWriter(sink, arrow_schema, compression='gzip', write_statistics=statistics,
+                              write_page_index=True) as writer:
+            pending = []
+            pending_rows = 0
+            for df in dataframes:
+                pending.append(df)
+                pending_rows += df.height
+                if pending_rows >= row_group_size:
+                    # Only full row groups are written, the rest waits for the next DataFrames
+                    df = pl.concat(pending)
+                    full_rows = df.height - df.height % row_group_size
+                    writer.write_table(df.slice(0, full_rows).to_arrow(), row_group_size=row_group_size)
+                    rows += full_rows
+                    pending = [df.slice(full_rows)]
+                    pending_rows = df.height - full_rows
+            if pending_rows:
+                writer.write_table(pl.concat(pending).to_arrow(), row_group_size=max(pending_rows, 1))
+                rows += pending_rows
+        sink.close()
+        print(f'Successfully stored {key} in S3 ({rows} rows).')
     except Exception as e:
         print(f"Failed to upload to S3: {e}")
-    finally:
-        # Remove the file from /tmp
-        try:
-            os.remove(temp_file_path)
-        except Exception as e:
-            print(f"Failed to delete temporary file: {e}")
+        sink.abort()
+        raise
+    return rows
 
 
-def process_file(file_key, all_columns, source_bucket_name):
+def process_file(file_key, schema, source_bucket_name, concurrency=None):
+    """
+    Download a snapshot file and align it on the schema of the daily file.
+    :param file_key: key of the snapshot file
+    :param schema: dict column name -> Polars dtype, from resolve_schema
+    :param source_bucket_name: Bucket name in S3
+    :param concurrency: AdaptiveConcurrency of process_files, if any
+    :return: Polars DataFrame with the columns of the schema, or None if the file can't be read
+    """
 
-    df = download_from_s3(source_bucket_name, file_key)
+    df = download_from_s3(source_bucket_name, file_key, concurrency)
     if df is None:
         return None
 
     # Extract the UNIX timestamp from the file name
     try:
-        # The UNIX timestamp is located before the '.parquet' in the file name
-        unix_timefetch = int(file_key.split('_')[-1].split('.')[0])
+        unix_timefetch = get_timefetch(file_key)
     except Exception as e:
         print(f"Error extracting UNIX timestamp from file name: {file_key}")
         print(e)
         return None
 
-    # Add missing columns with default values (in case there is missing columns)
-    for col in all_columns:
+    return align_to_schema(df, schema, unix_timefetch)
+
+
+def align_to_schema(df, schema, unix_timefetch=None):
+    """
+    :param df: Polars DataFrame of a snapshot or of a part
+    :param schema: dict column name -> Polars dtype, from resolve_schema
+    :param unix_timefetch: 'timefetch' of the rows when df has no such column
+    :return: df with the columns of the schema, sorted by name
+    """
+    # Add missing columns with default values (in case there is missing columns) and cast to the dtypes of the schema,
+    # with the columns sorted
+    columns = []
+    for col, dtype in sorted(schema.items()):
         if col not in df.columns:
             if col == 'timefetch':
-                df = df.with_columns(pl.lit(unix_timefetch).alias(col))
+                columns.append(pl.lit(unix_timefetch, dtype=dtype).alias(col))
             else:
-                df = df.with_columns(pl.lit(None).alias(col))
+                columns.append(pl.lit(None, dtype=dtype).alias(col))
+        else:
+            columns.append(pl.col(col).cast(dtype, strict=False))
 
-    # Sort the columns
-    df = df.select(sorted(all_columns))
+    return df.select(columns)
 
-    return df
+
+def read_row_groups(bucket_name, file_key, schema):
+    """
+    Download a Parquet file (ex: an hourly part) to /tmp and yield its row groups one at a time, aligned on the schema.
+    The body is streamed to disk, so neither the file nor the hour is held in memory: merging the 24 parts of a day
+    only keeps one row group of each part.
+    :param bucket_name: Bucket name in S3
+    :param file_key: key of the Parquet file
+    :param schema: dict column name -> Polars dtype, from resolve_schema
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, os.path.basename(file_key))
+        response = s3.get_object(Bucket=bucket_name, Key=file_key)
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(response['Body'], f)
+        for df in read_local_row_groups(path):
+            yield align_to_schema(df, schema)
 
 
-def process_files(file_keys, all_columns, source_bucket_name, workers):
+def process_files(file_keys, schema, source_bucket_name, workers):
     """
-    Process multiple files using multithreading.(not sure that it makes a difference in Lambda...)
+    Download and process multiple files with a bounded number of GETs in flight, starting at workers and adapted to
+    the throughput and the throttling of S3 (AdaptiveConcurrency). The files are decoded in the threads, while the
+    next ones are downloaded. They are yielded in the order of file_keys (the order of timefetch), and at most
+    2 * MAX_CONCURRENCY files are held ahead of the consumer, so the memory used does not depend on the number of
+    files.
     """
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        futures = [executor.submit(process_file, file_key, all_columns, source_bucket_name) for file_key in file_keys]
-        dfs = []
-        for future in concurrent.futures.as_completed(futures):
-            df = future.result()
-            if df is not None:
-                dfs.append(df)
-        return dfs
\ No newline at end of file
+    concurrency = AdaptiveConcurrency(workers)
+    keys = iter(file_keys)
+    pending = collections.deque()
+    exhausted = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency.maximum) as executor:
+        while True:
+            in_flight = [future for future in pending if not future.done()]
+            while not exhausted and len(in_flight) < concurrency.limit and len(pending) < 2 * concurrency.maximum:
+                file_key = next(keys, None)
+                if file_key is None:
+                    exhausted = True
+                    break
+                future = executor.submit(process_file, file_key, schema, source_bucket_name, concurrency)
+                pending.append(future)
+                in_flight.append(future)
+            if not pending:
+                break
+
+            if not pending[0].done():
+                concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            while pending and pending[0].done():
+                df = pending.popleft().result()
+                if df is not None:
+                    yield df
+
+    print(f'Processed {len(file_keys)} files, {concurrency.limit} GETs in flight at the end, '
+          f'{concurrency.throttled} throttled')
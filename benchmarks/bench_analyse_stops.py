@@ -0,0 +1,273 @@
+"""
+Benchmark of the analysis of STM_Analyse_Daily_Stops_Data on a weekday: the previous path (the files read in memory,
+the positions sorted again by each step, two group_bys joined back for the arrival and departure offsets, a final
+join with the stop_times) against the lazy query (the columns it uses scanned from the files, a single sort, window
+expressions).
+
+Usage (from the root of the repository):
+    python -m benchmarks.bench_analyse_stops
+    python -m benchmarks.bench_analyse_stops --trips 20000 --stops-per-trip 40 --poll-interval 30 --repeat 3
+
+The generated day has --trips trips of --stops-per-trip stops. Each trip is followed by a vehicle polled every
+--poll-interval seconds, late or early by a few minutes, stopped at the stops for 0 to 2 polls. The next day runs the
+same trips (same trip ids, as the STM does) and its positions are in the second daily file with the trips of the day
+that end after midnight, like STM_Merge_Daily_GTFS_VehiclePositions writes them with their heads (the handler reads
+the head of the next day, the previous path its whole daily file). Each run is done in a fresh process so its peak RSS
+is not shared with the other runs, and the two outputs are compared.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+import pytz
+
+TIMEZONE = 'America/Montreal'
+SERVICE_DATE = datetime(2023, 11, 14)  # A Tuesday
+
+
+def generate_days(directory, trips, stops_per_trip, poll_interval, days=1, seed=0):
+    """
+    Write the files downloaded by the handler for the days from SERVICE_DATE: filtered_stop_times_<day>.parquet of
+    each day (the same trips every day), and Daily_merge_<day>.parquet and its head Daily_merge_<day>_head.parquet of
+    each day and of the day after the last one.
+    """
+    from STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main import HEAD_HOURS, SORT_COLUMNS, select_day_head
+
+    rng = np.random.default_rng(seed)
+    trip_ids = np.arange(260000000, 260000000 + trips)
+    starts = rng.integers(5 * 3600, 25 * 3600, trips)
+    scheduled = starts[:, None] + np.cumsum(rng.integers(45, 150, (trips, stops_per_trip)), axis=1) - 45
+    stop_ids = rng.integers(50000, 59000, (trips, stops_per_trip))
+    stop_times_df = pl.DataFrame({
+        'trip_id': np.repeat(trip_ids, stops_per_trip),
+        'arrival_time': scheduled.ravel().astype(np.int32),
+        'departure_time': scheduled.ravel().astype(np.int32),
+        'stop_id': stop_ids.ravel(),
+        'stop_sequence': np.tile(np.arange(1, stops_per_trip + 1), trips),
+    })
+    for day in range(days):
+        stop_times_df.write_parquet(
+            os.path.join(directory, f'filtered_stop_times_{SERVICE_DATE + timedelta(days=day):%Y-%m-%d}.parquet'))
+
+    timezone = pytz.timezone(TIMEZONE)
+    # Positions of the previous service day fetched after midnight, in the daily file of the next date
+    carried_df = None
+    for day in range(days + 1):
+        reference = int(timezone.localize(SERVICE_DATE + timedelta(days=day)).timestamp())
+        vp_df = generate_positions(rng, trip_ids, stop_ids, reference + scheduled, poll_interval)
+        # The daily files split the positions by the local date of the fetch
+        dates = vp_df.select(pl.from_epoch('timefetch').dt.replace_time_zone('UTC').dt.convert_time_zone(TIMEZONE)
+                             .dt.date()).to_series()
+        date = SERVICE_DATE + timedelta(days=day)
+        day_df = vp_df.filter(dates == date.date())
+        if carried_df is not None:
+            day_df = pl.concat([carried_df, day_df])
+        carried_df = vp_df.filter(dates == (date + timedelta(days=1)).date())
+        # Written with the row groups and the statistics of STM_Merge_Daily_GTFS_VehiclePositions
+        day_df = day_df.sort(SORT_COLUMNS)
+        pq.write_table(day_df.to_arrow(), os.path.join(directory, f'Daily_merge_{date:%Y-%m-%d}.parquet'),
+                       row_group_size=128 * 1024)
+        head_df = select_day_head(day_df, int(timezone.localize(date + timedelta(hours=HEAD_HOURS)).timestamp()),
+                                  SORT_COLUMNS)
+        pq.write_table(head_df.to_arrow(), os.path.join(directory, f'Daily_merge_{date:%Y-%m-%d}_head.parquet'),
+                       row_group_size=128 * 1024)
+
+
+def generate_positions(rng, trip_ids, stop_ids, scheduled_unix, poll_interval):
+    """
+    :return: the positions of the vehicles of the trips of a service day (scheduled_unix: UNIX time of the scheduled
+    arrivals, by trip and stop)
+    """
+    trips, stops_per_trip = scheduled_unix.shape
+    # Actual times at the stops: a delay for the trip, and a drift along the trip
+    delays = rng.integers(-180, 600, (trips, 1)) + np.cumsum(rng.integers(-20, 30, (trips, stops_per_trip)), axis=1)
+    arrivals = scheduled_unix + delays
+    dwells = rng.integers(0, 3, (trips, stops_per_trip)) * poll_interval
+    columns = {name: [] for name in ['timefetch', 'trip', 'sequence', 'stopped']}
+    for trip in range(trips):
+        polls = np.arange(arrivals[trip, 0] - 2 * poll_interval, arrivals[trip, -1] + dwells[trip, -1], poll_interval)
+        # Next stop of the vehicle at each poll, stopped at it between its arrival and its departure
+        sequence = np.minimum(np.searchsorted(arrivals[trip], polls), stops_per_trip - 1)
+        previous = np.maximum(sequence - 1, 0)
+        stopped = (polls >= arrivals[trip, previous]) & (polls < arrivals[trip, previous] + dwells[trip, previous])
+        sequence = np.where(stopped, previous, sequence)
+        columns['timefetch'].append(polls)
+        columns['trip'].append(np.full(len(polls), trip))
+        columns['sequence'].append(sequence + 1)
+        columns['stopped'].append(stopped)
+    timefetch, trip, sequence, stopped = (np.concatenate(columns[name]) for name in columns)
+
+    rows = len(timefetch)
+    vehicle_ids = trip % 1800 + 40000
+    return pl.DataFrame({
+        'id': vehicle_ids.astype(np.int32),
+        'vehicle_congestionLevel': [None] * rows,
+        'vehicle_currentStatus': np.where(stopped, 'STOPPED_AT', 'IN_TRANSIT_TO'),
+        'vehicle_currentStopSequence': sequence,
+        'vehicle_occupancyPercentage': np.zeros(rows, dtype=np.int64),
+        'vehicle_occupancyStatus': rng.choice(['MANY_SEATS_AVAILABLE', 'FEW_SEATS_AVAILABLE', 'STANDING_ROOM_ONLY'],
+                                              rows),
+        'vehicle_position_bearing': rng.integers(0, 360, rows).astype(np.int32),
+        'vehicle_position_latitude': 45.5 + rng.random(rows) / 10,
+        'vehicle_position_longitude': -73.6 + rng.random(rows) / 10,
+        'vehicle_position_odometer': np.zeros(rows),
+        'vehicle_position_speed': rng.random(rows) * 15,
+        'vehicle_stopId': stop_ids[trip, sequence - 1].astype(str),
+        'vehicle_timestamp': timefetch - rng.integers(0, 15, rows),
+        'vehicle_trip_directionId': trip % 2,
+        'vehicle_trip_routeId': trip % 220 + 1,
+        'vehicle_trip_scheduleRelationship': ['SCHEDULED'] * rows,
+        'vehicle_trip_startDate': [None] * rows,
+        'vehicle_trip_startTime': [None] * rows,
+        'vehicle_trip_tripId': trip_ids[trip],
+        'vehicle_vehicle_id': vehicle_ids.astype(str),
+        'vehicle_vehicle_label': vehicle_ids.astype(str),
+        'vehicle_vehicle_licensePlate': [None] * rows,
+        'timefetch': timefetch,
+    })
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_previous(directory, queue):
+    # Previous path of the handler, its steps in order
+    from STM_Services.STM_Analyse_Daily_Stops_Data.main import gtfs_time_to_unix, seconds_to_gtfs_time
+
+    start_rss = peak_rss_mib()
+    start = time.perf_counter()
+    date_obj = pytz.timezone(TIMEZONE).localize(SERVICE_DATE)
+    df = pl.read_parquet(os.path.join(directory, f'Daily_merge_{SERVICE_DATE:%Y-%m-%d}.parquet'))
+    df_next_day = pl.read_parquet(os.path.join(directory, f'Daily_merge_{SERVICE_DATE + timedelta(days=1):%Y-%m-%d}.parquet'))
+    df_stop_times = pl.read_parquet(os.path.join(directory, f'filtered_stop_times_{SERVICE_DATE:%Y-%m-%d}.parquet'))
+    df_stop_times = df_stop_times.drop({'departure_time'})
+    df_stop_times = df_stop_times.with_columns(
+        gtfs_time_to_unix('arrival_time', date_obj, TIMEZONE, pl.Int32).alias('arrival_time_unix'))
+    df_stops_unix = df_stop_times.with_columns(seconds_to_gtfs_time('arrival_time')).select(
+        'trip_id', 'arrival_time', 'stop_id', 'stop_sequence', 'arrival_time_unix').sort(['trip_id', 'stop_sequence'])
+
+    df = pl.concat([df, df_next_day], rechunk=True).rename({'vehicle_trip_tripId': 'trip_id'})
+    df = df.cast({'id': pl.Int32, 'timefetch': pl.Int64, 'vehicle_position_bearing': pl.Int32,
+                  'vehicle_position_latitude': pl.Float64, 'vehicle_position_longitude': pl.Float64,
+                  'vehicle_position_speed': pl.Float64, 'vehicle_timestamp': pl.Int64, 'trip_id': pl.Int64})
+    df = df.sort(['trip_id', 'vehicle_currentStopSequence', 'timefetch'])
+    df = df.filter((pl.col('vehicle_currentStopSequence').diff().ne(0) &
+                    (pl.col('vehicle_currentStatus') == 'IN_TRANSIT_TO')) |
+                   (pl.col('vehicle_currentStatus') == 'STOPPED_AT'))
+    df = df.join(df_stops_unix, how='outer', left_on=['trip_id', 'vehicle_currentStopSequence'],
+                 right_on=['trip_id', 'stop_sequence'])
+    df = df.filter(pl.col('arrival_time_unix').is_not_null()).filter(pl.col('vehicle_timestamp').is_not_null())
+    df = df.filter((pl.col('timefetch') - pl.col('arrival_time_unix')).abs() <= 7200)
+    df = df.with_columns(pl.when(pl.col('vehicle_currentStatus') == 'STOPPED_AT')
+                         .then(pl.col('vehicle_timestamp') - pl.col('arrival_time_unix')).otherwise(None).alias('offset'))
+    df = df.sort(['trip_id', 'vehicle_currentStopSequence'])
+    df = df.with_columns(pl.col('vehicle_timestamp').shift(-1).over('trip_id').alias('next_vehicle_timestamp'))
+    df = df.with_columns(pl.when((pl.col('vehicle_currentStatus') == 'IN_TRANSIT_TO') &
+                                 (pl.col('trip_id') == pl.col('trip_id').shift(-1)))
+                         .then(pl.col('next_vehicle_timestamp') - pl.col('arrival_time_unix'))
+                         .otherwise(pl.col('offset')).alias('offset'))
+    df = df.sort(['trip_id', 'vehicle_currentStopSequence'])
+    same_vehicle = pl.col('vehicle_vehicle_id') == pl.col('vehicle_vehicle_id').shift(-1)
+    df = df.with_columns(pl.when(same_vehicle).then(pl.col('vehicle_timestamp').shift(-1)).otherwise(pl.lit(None))
+                         .alias('next_vehicle_timestamp'))
+    df = df.with_columns(pl.when((pl.col('vehicle_currentStatus') != 'STOPPED_AT') & same_vehicle &
+                                 (pl.col('vehicle_currentStopSequence') ==
+                                  pl.col('vehicle_currentStopSequence').max().over('trip_id')))
+                         .then(pl.col('next_vehicle_timestamp') - pl.col('arrival_time_unix'))
+                         .otherwise(pl.col('offset')).alias('offset'))
+    df = df.sort(['trip_id', 'vehicle_currentStopSequence'])
+    stop = ['trip_id', 'vehicle_currentStopSequence']
+    first_offset = df.group_by(stop).agg(pl.first('offset').alias('arrival_time_offset'))
+    last_offset = df.group_by(stop).agg(pl.last('offset').alias('departure_time_offset'))
+    df = df.join(first_offset, on=stop, how='left').join(last_offset, on=stop, how='left')
+    df = df.filter(pl.col('offset').abs() <= 1800).sort(['trip_id', 'vehicle_currentStopSequence', 'timefetch'])
+
+    df = df.unique(subset=stop).sort(['trip_id', 'vehicle_currentStopSequence', 'timefetch'])
+    df = df.with_columns(((pl.col('arrival_time_offset') + pl.col('departure_time_offset')) / 2).alias('offset'))
+    df = df.select(['trip_id', 'vehicle_currentStopSequence', 'id', 'vehicle_occupancyStatus', 'offset',
+                    'vehicle_trip_routeId', 'arrival_time_offset', 'departure_time_offset'])
+    df_final = df_stops_unix.join(df, how='inner', left_on=['trip_id', 'stop_sequence'], right_on=stop)
+    df_final = df_final.rename({'id': 'vehicleID', 'vehicle_occupancyStatus': 'Current_Occupancy',
+                                'vehicle_trip_routeId': 'routeId'}).cast({'routeId': pl.Int64})
+    df_final.write_parquet(os.path.join(directory, 'previous.parquet'))
+    queue.put((time.perf_counter() - start, start_rss, peak_rss_mib()))
+
+
+def run_lazy(directory, queue):
+    from unittest.mock import patch
+
+    from STM_Services.STM_Analyse_Daily_Stops_Data import main
+
+    def download(bucket, key, local_file_name):
+        return os.path.join(directory, os.path.basename(local_file_name))
+
+    def upload(local_file_name, bucket, key):
+        os.replace(local_file_name, os.path.join(directory, 'lazy.parquet'))
+
+    start_rss = peak_rss_mib()
+    start = time.perf_counter()
+    # The handler analyses the day before yesterday
+    event = {'daily_static_bucket': 'static', 'bucket_vehicle_positions_daily_merge': 'merge', 'output_bucket': 'output',
+             'timezone': TIMEZONE, 'date': f'{SERVICE_DATE + timedelta(days=2):%Y%m%d}'}
+    with patch.object(main, 'download_file_to_tmp', download), patch.object(main, 'upload_file_from_tmp', upload), \
+            patch.object(main, 'clean_tmp_folder'):
+        main.lambda_handler(event, None)
+    queue.put((time.perf_counter() - start, start_rss, peak_rss_mib()))
+
+
+def measure(target, *args):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=target, args=(*args, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        # Typically killed by the OOM killer
+        return None
+    return queue.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trips', type=int, default=20000)
+    parser.add_argument('--stops-per-trip', type=int, default=40)
+    parser.add_argument('--poll-interval', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Generated in another process: the peak RSS of a process is inherited by the processes it starts
+        process = multiprocessing.get_context('spawn').Process(target=generate_days, args=(
+            directory, args.trips, args.stops_per_trip, args.poll_interval))
+        process.start()
+        process.join()
+        positions = sum(pl.scan_parquet(os.path.join(directory, f'Daily_merge_{SERVICE_DATE + timedelta(days=day):%Y-%m-%d}'
+                                                                '.parquet')).select(pl.count()).collect().item()
+                        for day in range(2))
+
+        print(f'{positions:,} positions, {args.trips * args.stops_per_trip:,} stop times '
+              f'(median of {args.repeat} runs)')
+        print(f'{"path":10} {"seconds":>8} {"peak RSS MiB":>12} {"above start":>11}')
+        for name, target in [('previous', run_previous), ('lazy', run_lazy)]:
+            results = [measure(target, directory) for _ in range(args.repeat)]
+            if None in results:
+                print(f'{name:10} failed (out of memory?)')
+                continue
+            seconds, start_rss, peak_rss = sorted(results)[len(results) // 2]
+            print(f'{name:10} {seconds:>8.2f} {peak_rss:>12.0f} {peak_rss - start_rss:>11.0f}')
+
+        previous_df = pl.read_parquet(os.path.join(directory, 'previous.parquet'))
+        assert pl.read_parquet(os.path.join(directory, 'lazy.parquet')).equals(previous_df), 'the outputs differ'
+
+
+if __name__ == '__main__':
+    main()
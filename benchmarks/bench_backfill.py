@@ -0,0 +1,131 @@
+"""
+Benchmark of a backfill of STM_Analyse_Daily_Stops_Data over a range of days: one invocation of the handler per day
+(each one downloads the daily files of VehiclePositions of its day and of the next day) against the backfill mode (each
+daily file downloaded once, the days analysed by a pool of processes).
+
+Usage (from the root of the repository):
+    python -m benchmarks.bench_backfill
+    python -m benchmarks.bench_backfill --days 7 --trips 20000 --workers 4
+
+The days are generated by bench_analyse_stops.generate_days. S3 is replaced by local stand-ins: the downloads are
+copies from the directory of the generated files (their bytes are counted), the uploaded files are kept in another
+directory and the two runs are compared. The throughput depends on the cores (--workers, default all of them) and on
+the memory: each worker analyses a day at a time.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from unittest.mock import patch
+
+import polars as pl
+
+from benchmarks.bench_analyse_stops import SERVICE_DATE, TIMEZONE, generate_days
+from STM_Services.STM_Analyse_Daily_Stops_Data import main
+
+
+class LocalS3:
+    """
+    Stand-ins for download_file_to_tmp and upload_file_from_tmp, on local directories.
+    """
+
+    def __init__(self, source_directory, output_directory):
+        self.source_directory = source_directory
+        self.output_directory = output_directory
+        self.downloads = 0
+        self.downloaded_bytes = 0
+
+    def download(self, bucket, key, local_file_name):
+        path = os.path.join(self.source_directory, os.path.basename(local_file_name))
+        if not os.path.exists(path):
+            return False
+        self.downloads += 1
+        self.downloaded_bytes += os.path.getsize(path)
+        return shutil.copy(path, local_file_name)
+
+    def upload(self, local_file_name, bucket, key):
+        shutil.copy(local_file_name, os.path.join(self.output_directory, key.replace('/', '_')))
+        return True
+
+
+def event(**kwargs):
+    return {'daily_static_bucket': 'static', 'bucket_vehicle_positions_daily_merge': 'merge', 'output_bucket': 'output',
+            'timezone': TIMEZONE, **kwargs}
+
+
+def run_daily(s3, days):
+    downloaded = []
+
+    def download(bucket, key, local_file_name):
+        downloaded.append(local_file_name)
+        return s3.download(bucket, key, local_file_name)
+
+    def clean_tmp_folder():
+        # Only the files of the invocation, not the whole /tmp
+        for path in downloaded + [f for f in os.listdir('/tmp') if f.startswith('data_stops_')]:
+            path = os.path.join('/tmp', path)
+            if os.path.exists(path):
+                os.remove(path)
+        downloaded.clear()
+
+    with patch.object(main, 'download_file_to_tmp', download), patch.object(main, 'upload_file_from_tmp', s3.upload), \
+            patch.object(main, 'clean_tmp_folder', clean_tmp_folder):
+        for day in range(days):
+            # The handler analyses the day before yesterday
+            main.lambda_handler(event(date=f'{SERVICE_DATE + timedelta(days=day + 2):%Y%m%d}'), None)
+
+
+def run_backfill(s3, days, workers):
+    end_date = SERVICE_DATE + timedelta(days=days - 1)
+    with patch.object(main, 'download_file_to_tmp', s3.download), patch.object(main, 'upload_file_from_tmp', s3.upload):
+        result = main.lambda_handler(event(mode='backfill', start_date=f'{SERVICE_DATE:%Y%m%d}',
+                                           end_date=f'{end_date:%Y%m%d}', workers=workers), None)
+    assert len(result['days']) == days, result
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--trips', type=int, default=20000)
+    parser.add_argument('--stops-per-trip', type=int, default=40)
+    parser.add_argument('--poll-interval', type=int, default=30)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        source_directory = os.path.join(directory, 'source')
+        os.mkdir(source_directory)
+        # Generated in another process, it keeps its memory
+        process = multiprocessing.get_context('spawn').Process(target=generate_days, args=(
+            source_directory, args.trips, args.stops_per_trip, args.poll_interval, args.days))
+        process.start()
+        process.join()
+
+        print(f'{args.days} days of {args.trips:,} trips, {args.workers} workers on {os.cpu_count()} cores')
+        print(f'{"run":10} {"seconds":>8} {"days/hour":>10} {"downloads":>10} {"MiB downloaded":>15}')
+        outputs = {}
+        for name in ['daily', 'backfill']:
+            output_directory = os.path.join(directory, name)
+            os.mkdir(output_directory)
+            s3 = LocalS3(source_directory, output_directory)
+            start = time.perf_counter()
+            if name == 'daily':
+                run_daily(s3, args.days)
+            else:
+                run_backfill(s3, args.days, args.workers)
+            seconds = time.perf_counter() - start
+            print(f'{name:10} {seconds:>8.1f} {args.days * 3600 / seconds:>10.0f} {s3.downloads:>10} '
+                  f'{s3.downloaded_bytes / 2 ** 20:>15.0f}')
+            outputs[name] = {file_name: pl.read_parquet(os.path.join(output_directory, file_name))
+                             for file_name in sorted(os.listdir(output_directory))}
+
+        assert outputs['daily'].keys() == outputs['backfill'].keys(), 'the outputs differ'
+        assert all(outputs['daily'][file_name].equals(outputs['backfill'][file_name]) for file_name in outputs['daily']), \
+            'the outputs differ'
+
+
+if __name__ == '__main__':
+    main_benchmark()
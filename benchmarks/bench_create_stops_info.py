@@ -0,0 +1,175 @@
+"""
+Benchmark of the assembly of the daily stops info by STM_Create_Daily_Stops_Info, on a weekday: the previous path
+(the daily files read in memory, three eager joins, the direction of route_info mapped by a Python call per stop time)
+against build_daily_stops_info (one lazy query, route_info built per route and headsign, streamed to the output file).
+
+Usage (from the root of the repository):
+    python -m benchmarks.bench_create_stops_info
+    python -m benchmarks.bench_create_stops_info --trips 45000 --stops-per-trip 40 --repeat 3
+
+The generated day has --trips trips of --stops-per-trip stops on 220 routes, 9000 stops, with the dtypes written by
+STM_Fetch_Update_GTFS_Static_files and STM_Filter_Daily_GTFS_Static_files (times in seconds, Categorical headsigns
+and stop ids). Each run is done in a fresh process so its peak RSS is not shared with the other runs, and the two
+outputs are compared.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import polars as pl
+
+from STM_Services.STM_Create_Daily_Stops_Info.main import build_daily_stops_info, gtfs_time_to_unix
+
+TIMEZONE = 'America/Montreal'
+SERVICE_DATE = datetime(2023, 11, 14)  # A Tuesday
+
+
+def generate_day(directory, trips, stops_per_trip, seed=0):
+    rng = np.random.default_rng(seed)
+    stops = 9000
+    routes = 220
+    trip_ids = np.arange(260000000, 260000000 + trips)
+    route_ids = rng.integers(1, routes + 1, trips)
+    directions = rng.integers(0, 2, trips)
+    headsigns = np.array([['Nord', 'Sud'], ['Est', 'Ouest']])[route_ids % 2, directions]
+    with pl.StringCache():
+        tables = {
+            'filtered_stop_times': pl.DataFrame({
+                'trip_id': np.repeat(trip_ids, stops_per_trip),
+                'arrival_time': (np.repeat(rng.integers(5 * 3600, 25 * 3600, trips), stops_per_trip) +
+                                 np.tile(np.arange(stops_per_trip) * 90, trips)).astype(np.int32),
+                'stop_id': rng.integers(50000, 50000 + stops, trips * stops_per_trip),
+                'stop_sequence': np.tile(np.arange(1, stops_per_trip + 1), trips),
+            }).with_columns(pl.col('arrival_time').alias('departure_time')),
+            'filtered_trips': pl.DataFrame({
+                'service_id': ['23N-H50N000S-80-S'] * trips,
+                'route_id': route_ids,
+                'trip_id': trip_ids,
+                'trip_headsign': headsigns,
+                'direction_id': directions.astype(np.int8),
+                'shape_id': route_ids * 10 + directions,
+                'wheelchair_accessible': np.ones(trips, dtype=np.int8),
+            }).with_columns(pl.col('service_id', 'trip_headsign').cast(pl.Categorical)),
+            'stops': pl.DataFrame({
+                'stop_id': np.arange(50000, 50000 + stops).astype(str),
+                'stop_code': np.arange(50000, 50000 + stops).astype(str),
+                'stop_name': [f'Station {i} / Rue {i % 300}' for i in range(stops)],
+                'stop_lat': 45.5 + rng.random(stops) / 10,
+                'stop_lon': -73.6 + rng.random(stops) / 10,
+                'location_type': np.zeros(stops, dtype=np.int8),
+                'wheelchair_boarding': rng.integers(0, 3, stops).astype(np.int8),
+            }).with_columns(pl.col('stop_id').cast(pl.Categorical)),
+            'routes': pl.DataFrame({
+                'route_id': np.arange(1, routes + 1),
+                'route_short_name': np.arange(1, routes + 1).astype(str),
+                'route_long_name': [f'Boulevard {i}' for i in range(routes)],
+                'route_type': np.full(routes, 3, dtype=np.int16),
+            }),
+        }
+    for table, df in tables.items():
+        df.write_parquet(os.path.join(directory, f'{table}.parquet'))
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def previous_route_info(route_id, route_long_name, trip_headsign):
+    direction_mapping = {'E': 'EST', 'O': 'OUEST', 'S': 'SUD', 'N': 'NORD'}
+    direction = pl.col('trip_headsign').cast(pl.Utf8).str.slice(-1)
+    translated_direction = direction.map_elements(lambda x: direction_mapping.get(x, x))
+    return route_id + " " + route_long_name + " dir. " + translated_direction
+
+
+def run_previous(directory, queue):
+    # Previous path of the handler
+    start_rss = peak_rss_mib()
+    start = time.perf_counter()
+    stops_df = pl.read_parquet(os.path.join(directory, 'stops.parquet'))
+    filtered_trips_df = pl.read_parquet(os.path.join(directory, 'filtered_trips.parquet'))
+    filtered_stop_times_df = pl.read_parquet(os.path.join(directory, 'filtered_stop_times.parquet'))
+    routes_df = pl.read_parquet(os.path.join(directory, 'routes.parquet'))
+    filtered_stop_times_df = filtered_stop_times_df.with_columns(
+        gtfs_time_to_unix('arrival_time', SERVICE_DATE, TIMEZONE,
+                          filtered_stop_times_df.schema['arrival_time']).alias('arrival_time_unix'))
+    stops_df = stops_df.with_columns(stops_df['stop_id'].cast(pl.Utf8))
+    filtered_stop_times_df = filtered_stop_times_df.with_columns(filtered_stop_times_df['stop_id'].cast(pl.Utf8))
+    merged_df = filtered_stop_times_df.join(
+        filtered_trips_df[['trip_id', 'route_id', 'trip_headsign', 'direction_id', 'shape_id', 'wheelchair_accessible']],
+        on='trip_id', how='left')
+    merged_df = merged_df.join(stops_df[['stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'wheelchair_boarding']],
+                               on='stop_id', how='left')
+    merged_df = merged_df.join(routes_df[['route_id', 'route_long_name']], on='route_id', how='left')
+    merged_df = merged_df.with_columns([
+        previous_route_info(merged_df['route_id'], merged_df['route_long_name'],
+                            merged_df['trip_headsign']).alias('route_info')])
+    final_df = merged_df[['route_id', 'route_info', 'trip_id', 'shape_id', 'wheelchair_accessible',
+                          'arrival_time_unix', 'stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'wheelchair_boarding']]
+    final_df.write_parquet(os.path.join(directory, 'previous.parquet'))
+    queue.put((time.perf_counter() - start, start_rss, peak_rss_mib()))
+
+
+def run_lazy(directory, queue):
+    start_rss = peak_rss_mib()
+    start = time.perf_counter()
+    # stops and routes come from the dimension cache in the handler, decoded in memory
+    stops_df = pl.read_parquet(os.path.join(directory, 'stops.parquet'))
+    routes_df = pl.read_parquet(os.path.join(directory, 'routes.parquet'))
+    build_daily_stops_info(pl.scan_parquet(os.path.join(directory, 'filtered_stop_times.parquet')),
+                           pl.scan_parquet(os.path.join(directory, 'filtered_trips.parquet')), stops_df.lazy(),
+                           routes_df.lazy(), SERVICE_DATE, TIMEZONE).sink_parquet(
+        os.path.join(directory, 'lazy.parquet'))
+    queue.put((time.perf_counter() - start, start_rss, peak_rss_mib()))
+
+
+def measure(target, *args):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=target, args=(*args, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        # Typically killed by the OOM killer
+        return None
+    return queue.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trips', type=int, default=45000)
+    parser.add_argument('--stops-per-trip', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Generated in another process: the peak RSS of a process is inherited by the processes it starts
+        process = multiprocessing.get_context('spawn').Process(target=generate_day, args=(
+            directory, args.trips, args.stops_per_trip))
+        process.start()
+        process.join()
+
+        print(f'{args.trips * args.stops_per_trip:,} stop times, {args.trips:,} trips (median of {args.repeat} runs)')
+        print(f'{"path":10} {"seconds":>8} {"peak RSS MiB":>12} {"above start":>11}')
+        for name, target in [('previous', run_previous), ('lazy', run_lazy)]:
+            results = [measure(target, directory) for _ in range(args.repeat)]
+            if None in results:
+                print(f'{name:10} failed (out of memory?)')
+                continue
+            seconds, start_rss, peak_rss = sorted(results)[len(results) // 2]
+            print(f'{name:10} {seconds:>8.2f} {peak_rss:>12.0f} {peak_rss - start_rss:>11.0f}')
+
+        # Same rows, the streaming engine does not keep the order of the stop times
+        sort_columns = ['trip_id', 'arrival_time_unix', 'stop_id']
+        previous_df = pl.read_parquet(os.path.join(directory, 'previous.parquet')).sort(sort_columns)
+        lazy_df = pl.read_parquet(os.path.join(directory, 'lazy.parquet')).sort(sort_columns)
+        assert lazy_df.equals(previous_df), 'the outputs differ'
+
+
+if __name__ == '__main__':
+    main()
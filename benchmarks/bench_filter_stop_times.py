@@ -0,0 +1,114 @@
+"""
+Benchmark of the filtering of stop_times by STM_Filter_Daily_GTFS_Static_files: the previous path (the whole file
+read in memory, then filtered with is_in) against the lazy scan, which reads only the needed columns, skips the row
+groups without a trip of the day and streams the result to its file.
+
+Usage (from the root of the repository):
+    python -m benchmarks.bench_filter_stop_times
+    python -m benchmarks.bench_filter_stop_times --trips 250000 --stops-per-trip 40 --services 4
+
+The generated stop_times has --trips trips of --stops-per-trip stops, split in --services services of consecutive
+trip_ids (a day runs one of them), written like STM_Fetch_Update_GTFS_Static_files does: clustered by trip_id, with
+row groups and statistics. Each run is done in a fresh process so its peak RSS is not shared with the other runs.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+import polars as pl
+
+from STM_Services.STM_Fetch_Update_GTFS_Static_files.main import ROW_GROUP_SIZE
+from STM_Services.STM_Filter_Daily_GTFS_Static_files.main import STOP_TIMES_COLUMNS
+
+
+def generate_stop_times(path, trips, stops_per_trip, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = trips * stops_per_trip
+    trip_ids = np.repeat(np.arange(260000000, 260000000 + trips), stops_per_trip)
+    seconds = np.repeat(rng.integers(5 * 3600, 24 * 3600, trips), stops_per_trip) + np.tile(
+        np.arange(stops_per_trip) * 90, trips)
+    s = pl.col('seconds')
+    times = pl.DataFrame({'seconds': seconds}).select(pl.format(
+        '{}:{}:{}', *[part.cast(pl.Utf8).str.zfill(2) for part in [s // 3600, s // 60 % 60, s % 60]])).to_series()
+    df = pl.DataFrame({
+        'trip_id': trip_ids,
+        'arrival_time': times,
+        'stop_id': rng.integers(50000, 62000, rows),
+        'stop_sequence': np.tile(np.arange(1, stops_per_trip + 1), trips),
+        'pickup_type': np.zeros(rows, dtype=np.int64),
+        'drop_off_type': np.zeros(rows, dtype=np.int64),
+        'shape_dist_traveled': rng.random(rows) * 20,
+    }).with_columns(pl.col('arrival_time').alias('departure_time'))
+    df.write_parquet(path, statistics=True, row_group_size=ROW_GROUP_SIZE)
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_eager(path, trip_ids, output_path, queue):
+    # Previous path: the whole file is read, then filtered
+    start_rss = peak_rss_mib()
+    start = time.perf_counter()
+    stop_times_df = pl.read_parquet(path)
+    stop_times_df.filter(pl.col('trip_id').is_in(trip_ids)).write_parquet(output_path)
+    queue.put((time.perf_counter() - start, start_rss, peak_rss_mib()))
+
+
+def run_lazy(path, trip_ids, output_path, queue):
+    start_rss = peak_rss_mib()
+    start = time.perf_counter()
+    stop_times_lf = pl.scan_parquet(path)
+    columns = [column for column in STOP_TIMES_COLUMNS if column in stop_times_lf.schema]
+    stop_times_lf.select(columns).filter(pl.col('trip_id').is_in(trip_ids)).sink_parquet(output_path)
+    queue.put((time.perf_counter() - start, start_rss, peak_rss_mib()))
+
+
+def measure(target, *args):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=target, args=(*args, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        # Typically killed by the OOM killer
+        return None
+    return queue.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trips', type=int, default=250000)
+    parser.add_argument('--stops-per-trip', type=int, default=40)
+    parser.add_argument('--services', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'stop_times.parquet')
+        # Generated in another process: the peak RSS of a process is inherited by the processes it starts
+        process = multiprocessing.get_context('spawn').Process(target=generate_stop_times,
+                                                               args=(path, args.trips, args.stops_per_trip))
+        process.start()
+        process.join()
+        trips_per_service = args.trips // args.services
+        trip_ids = pl.Series('trip_id', np.arange(260000000, 260000000 + trips_per_service))
+
+        print(f'{args.trips * args.stops_per_trip:,} stop times ({os.path.getsize(path) / 2 ** 20:.0f} MiB), '
+              f'{len(trip_ids):,} trips in the day')
+        print(f'{"path":10} {"seconds":>8} {"peak RSS MiB":>12} {"above start":>11}')
+        for name, target in [('eager', run_eager), ('lazy', run_lazy)]:
+            result = measure(target, path, trip_ids, os.path.join(directory, f'{name}.parquet'))
+            if result is None:
+                print(f'{name:10} failed (out of memory?)')
+                continue
+            seconds, start_rss, peak_rss = result
+            print(f'{name:10} {seconds:>8.2f} {peak_rss:>12.0f} {peak_rss - start_rss:>11.0f}')
+
+
+if __name__ == '__main__':
+    main()
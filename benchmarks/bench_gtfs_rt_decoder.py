@@ -0,0 +1,134 @@
+"""
+Benchmark of the GTFS-RT decoding used by the fetch Lambdas: the previous MessageToDict + pd.json_normalize path
+against the direct protobuf to column buffers decoders.
+
+Usage (from the root of the repository):
+    python -m benchmarks.bench_gtfs_rt_decoder
+    python -m benchmarks.bench_gtfs_rt_decoder --feed recorded_vehicle_positions.pb --repeat 50
+
+Without --feed, a VehiclePositions and a TripUpdates feed are generated with --vehicles entities.
+"""
+import argparse
+import random
+import time
+
+import pandas as pd
+from google.protobuf.json_format import MessageToDict
+from google.transit import gtfs_realtime_pb2
+
+from STM_Services.STM_Fetch_GTFS_TripUpdates.main import decode_trip_updates
+from STM_Services.STM_Fetch_GTFS_VehiclePositions.main import decode_vehicle_positions
+
+
+def generate_vehicle_positions_feed(vehicles, seed=0):
+    rng = random.Random(seed)
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    feed.header.timestamp = 1700000000
+    for i in range(vehicles):
+        entity = feed.entity.add()
+        entity.id = str(i)
+        vehicle = entity.vehicle
+        vehicle.trip.trip_id = str(260000000 + i)
+        vehicle.trip.route_id = str(rng.randint(1, 470))
+        vehicle.trip.start_time = '08:15:00'
+        vehicle.trip.start_date = '20231114'
+        vehicle.trip.schedule_relationship = gtfs_realtime_pb2.TripDescriptor.SCHEDULED
+        vehicle.position.latitude = 45.5 + rng.random() / 10
+        vehicle.position.longitude = -73.6 + rng.random() / 10
+        vehicle.position.bearing = rng.randint(0, 359)
+        vehicle.position.speed = rng.random() * 15
+        vehicle.current_stop_sequence = rng.randint(1, 60)
+        vehicle.current_status = rng.choice([gtfs_realtime_pb2.VehiclePosition.STOPPED_AT,
+                                             gtfs_realtime_pb2.VehiclePosition.IN_TRANSIT_TO])
+        vehicle.timestamp = 1700000000 - rng.randint(0, 60)
+        vehicle.vehicle.id = str(40000 + i)
+        vehicle.occupancy_status = gtfs_realtime_pb2.VehiclePosition.MANY_SEATS_AVAILABLE
+    return feed
+
+
+def generate_trip_updates_feed(trips, stops_per_trip=30, seed=0):
+    rng = random.Random(seed)
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    feed.header.timestamp = 1700000000
+    for i in range(trips):
+        entity = feed.entity.add()
+        entity.id = str(i)
+        trip_update = entity.trip_update
+        trip_update.trip.trip_id = str(260000000 + i)
+        trip_update.trip.route_id = str(rng.randint(1, 470))
+        trip_update.trip.start_date = '20231114'
+        trip_update.timestamp = 1700000000
+        for sequence in range(1, stops_per_trip + 1):
+            stop_time_update = trip_update.stop_time_update.add()
+            stop_time_update.stop_sequence = sequence
+            stop_time_update.stop_id = str(50000 + sequence)
+            stop_time_update.arrival.time = 1700000000 + sequence * 60
+            stop_time_update.departure.time = 1700000000 + sequence * 60 + 10
+    return feed
+
+
+def decode_with_json_normalize(feed):
+    json_data_dict = MessageToDict(feed)
+    if 'entity' in json_data_dict:
+        df = pd.json_normalize(json_data_dict['entity'], sep='_')
+    else:
+        df = pd.DataFrame()
+    return df.sort_index(axis=1)
+
+
+def timeit(function, payload, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(payload)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def report(name, feed, decoder, repeat):
+    # Parsing is shared by both paths, the benchmark starts from the serialized payload like the Lambda
+    payload = feed.SerializeToString()
+
+    def parse(data):
+        message = gtfs_realtime_pb2.FeedMessage()
+        message.ParseFromString(data)
+        return message
+
+    baseline = timeit(lambda data: decode_with_json_normalize(parse(data)), payload, repeat)
+    direct = timeit(lambda data: decoder(parse(data)), payload, repeat)
+    print(f'{name}: {len(feed.entity)} entities, {len(payload) / 1024:.0f} KiB')
+    print(f'  MessageToDict + json_normalize: {baseline * 1000:8.1f} ms')
+    print(f'  direct decoder:                 {direct * 1000:8.1f} ms  ({baseline / direct:.1f}x)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--feed', help='Recorded VehiclePositions FeedMessage (.pb)')
+    parser.add_argument('--trip-updates-feed', help='Recorded TripUpdates FeedMessage (.pb)')
+    parser.add_argument('--vehicles', type=int, default=1500)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.feed:
+        vehicle_feed = gtfs_realtime_pb2.FeedMessage()
+        with open(args.feed, 'rb') as f:
+            vehicle_feed.ParseFromString(f.read())
+    else:
+        vehicle_feed = generate_vehicle_positions_feed(args.vehicles)
+
+    if args.trip_updates_feed:
+        trip_feed = gtfs_realtime_pb2.FeedMessage()
+        with open(args.trip_updates_feed, 'rb') as f:
+            trip_feed.ParseFromString(f.read())
+    else:
+        trip_feed = generate_trip_updates_feed(args.vehicles)
+
+    report('VehiclePositions', vehicle_feed, decode_vehicle_positions, args.repeat)
+    report('TripUpdates', trip_feed, lambda feed: decode_trip_updates(feed, feed.header.timestamp), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
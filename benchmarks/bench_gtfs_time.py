@@ -0,0 +1,76 @@
+"""
+Benchmark of the conversion of the GTFS stop times (HH:MM:SS) to UNIX time: the previous path of
+STM_Create_Daily_Stops_Info (a pytz localize per row through map_elements) against the gtfs_time_to_unix expression.
+
+Usage (from the root of the repository):
+    python -m benchmarks.bench_gtfs_time
+    python -m benchmarks.bench_gtfs_time --stop-times 2000000 --repeat 3
+
+The stop times are generated between 04:00:00 and 27:59:59 (a service day of the STM). The results of both paths are
+compared on a day without DST change, where they must be equal.
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+import polars as pl
+import pytz
+
+from STM_Services.STM_Create_Daily_Stops_Info.main import gtfs_time_to_unix
+
+TIMEZONE = 'America/Montreal'
+
+
+def convert_to_unix(time_str, base_date, timezone_str):
+    # Previous path, called on each row
+    time_parts = [int(part) for part in time_str.split(':')]
+    days_to_add = 0
+    if time_parts[0] >= 24:
+        time_parts[0] -= 24
+        days_to_add = 1
+    naive_base_date = base_date.replace(tzinfo=None)
+    time_obj = naive_base_date.replace(hour=time_parts[0], minute=time_parts[1], second=time_parts[2])
+    time_obj += timedelta(days=days_to_add)
+    local_timezone = pytz.timezone(timezone_str)
+    local_dt = local_timezone.localize(time_obj, is_dst=None)
+    return int(local_dt.timestamp())
+
+
+def generate_stop_times(stop_times, seed=0):
+    rng = random.Random(seed)
+    seconds = [rng.randint(4 * 3600, 28 * 3600 - 1) for _ in range(stop_times)]
+    return pl.DataFrame({'arrival_time': [f'{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}' for s in seconds]})
+
+
+def timeit(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2], result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stop-times', type=int, default=500000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = generate_stop_times(args.stop_times)
+    date_obj = pytz.timezone(TIMEZONE).localize(datetime(2023, 11, 14))
+
+    baseline, expected = timeit(lambda: df.select(
+        pl.col('arrival_time').map_elements(lambda x: convert_to_unix(x, date_obj, TIMEZONE))), args.repeat)
+    kernel, result = timeit(lambda: df.select(gtfs_time_to_unix('arrival_time', date_obj, TIMEZONE)), args.repeat)
+    assert result.to_series().to_list() == expected.to_series().to_list()
+
+    print(f'{args.stop_times} stop times')
+    print(f'  map_elements + pytz: {baseline * 1000:8.1f} ms')
+    print(f'  gtfs_time_to_unix:   {kernel * 1000:8.1f} ms  ({baseline / kernel:.0f}x)')
+
+
+if __name__ == '__main__':
+    main()
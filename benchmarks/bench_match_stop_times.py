@@ -0,0 +1,111 @@
+"""
+Benchmark of the matching of the positions to the stop_times in STM_Analyse_Daily_Stops_Data, on the two daily files
+of VehiclePositions of a weekday: the outer join of the first versions, the left join followed by the filters on
+arrival_time_unix and on the offset of 7200 seconds, and match_stop_times (as-of join grouped by trip_id and stop
+sequence, within MATCH_TOLERANCE).
+
+Usage (from the root of the repository):
+    python -m benchmarks.bench_match_stop_times
+    python -m benchmarks.bench_match_stop_times --trips 20000 --stops-per-trip 40 --poll-interval 30 --repeat 3
+
+The two days are generated by bench_analyse_stops.generate_days. Each run is done in a fresh process: the positions
+are read (the columns used by the handler), sorted and filtered like the handler does, then the matching alone is
+timed. The peak RSS of a run is the one of the sort of the positions, so the size of the matching is given by the rows
+produced by its join, before the filters. The matched positions of the three paths are compared.
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from datetime import timedelta
+
+import polars as pl
+import pytz
+
+from benchmarks.bench_analyse_stops import SERVICE_DATE, TIMEZONE, generate_days
+from STM_Services.STM_Analyse_Daily_Stops_Data.main import adding_arrival_time_unix, filter_daily_vehicle_position, \
+    match_stop_times, rename_and_convert_columns
+
+ANALYSIS_COLUMNS = ['trip_id', 'vehicle_currentStopSequence', 'timefetch', 'vehicle_timestamp', 'vehicle_currentStatus',
+                    'vehicle_vehicle_id', 'id', 'vehicle_occupancyStatus', 'vehicle_trip_routeId']
+
+
+def match_join(how):
+    def match(df, df_stops_unix):
+        df = df.join(df_stops_unix, how=how, left_on=['trip_id', 'vehicle_currentStopSequence'],
+                     right_on=['trip_id', 'stop_sequence'])
+        joined = len(df)
+        df = df.filter(pl.col('arrival_time_unix').is_not_null()).filter(pl.col('vehicle_timestamp').is_not_null())
+        return joined, df.filter((pl.col('timefetch') - pl.col('arrival_time_unix')).abs() <= 7200)
+    return match
+
+
+def match_asof(df, df_stops_unix):
+    # The rows of the as-of join are the positions
+    return len(df), match_stop_times(df, df_stops_unix).filter(pl.col('vehicle_timestamp').is_not_null())
+
+
+def run(directory, name, queue):
+    date_obj = pytz.timezone(TIMEZONE).localize(SERVICE_DATE)
+    days = [pl.scan_parquet(os.path.join(directory, f'Daily_merge_{SERVICE_DATE + timedelta(days=day):%Y-%m-%d}.parquet'))
+            for day in range(2)]
+    # The columns read by the handler
+    df = filter_daily_vehicle_position(rename_and_convert_columns(pl.concat(days))).select(ANALYSIS_COLUMNS).collect()
+    df_stops_unix = adding_arrival_time_unix(
+        pl.read_parquet(os.path.join(directory, f'filtered_stop_times_{SERVICE_DATE:%Y-%m-%d}.parquet')), date_obj,
+        TIMEZONE)
+    start = time.perf_counter()
+    joined, matched_df = {'outer': match_join('outer'), 'left': match_join('left'), 'as-of': match_asof}[name](
+        df, df_stops_unix)
+    seconds = time.perf_counter() - start
+    matched_df.select(sorted(matched_df.columns)).write_parquet(os.path.join(directory, f'{name}.parquet'))
+    queue.put((seconds, len(df), joined, len(matched_df)))
+
+
+def measure(target, *args):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=target, args=(*args, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        # Typically killed by the OOM killer
+        return None
+    return queue.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trips', type=int, default=20000)
+    parser.add_argument('--stops-per-trip', type=int, default=40)
+    parser.add_argument('--poll-interval', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Generated in another process: the peak RSS of a process is inherited by the processes it starts
+        process = multiprocessing.get_context('spawn').Process(target=generate_days, args=(
+            directory, args.trips, args.stops_per_trip, args.poll_interval))
+        process.start()
+        process.join()
+
+        print(f'{args.trips * args.stops_per_trip:,} stop times (median of {args.repeat} runs)')
+        print(f'{"matching":10} {"seconds":>8} {"positions":>10} {"joined":>10} {"matched":>10}')
+        for name in ['outer', 'left', 'as-of']:
+            results = [measure(run, directory, name) for _ in range(args.repeat)]
+            if None in results:
+                print(f'{name:10} failed (out of memory?)')
+                continue
+            seconds, positions, joined, matched = sorted(results)[len(results) // 2]
+            print(f'{name:10} {seconds:>8.2f} {positions:>10,} {joined:>10,} {matched:>10,}')
+
+        # The outer join does not keep the order of the positions
+        sort_columns = ['trip_id', 'vehicle_currentStopSequence', 'timefetch']
+        matched_dfs = [pl.read_parquet(os.path.join(directory, f'{name}.parquet')).sort(sort_columns)
+                       for name in ['outer', 'left', 'as-of']]
+        assert all(df.equals(matched_dfs[0]) for df in matched_dfs[1:]), 'the matched positions differ'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark of the S3 fetch engine of STM_Merge_Daily_GTFS_VehiclePositions (process_files): wall time to download
+and decode a day of snapshots against the number of GETs in flight, and the limit reached by the adaptive controller
+when S3 throttles.
+
+Usage (from the root of the repository):
+    python -m benchmarks.bench_merge_fetch
+    python -m benchmarks.bench_merge_fetch --snapshots 1440 --latency 0.03 --capacity 12
+
+S3 is replaced by a local stand-in that serves the same snapshot for every key after --latency seconds (plus the
+transfer time at --bandwidth MiB/s per connection), and answers SlowDown when more than --capacity GETs are in
+flight (0 disables the throttling).
+"""
+import argparse
+import io
+import threading
+import time
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError
+
+from benchmarks.bench_merge_memory import make_keys, make_snapshot
+from STM_Services.STM_Merge_Daily_GTFS_VehiclePositions import main as merge
+
+
+class LatencyS3:
+    """
+    Stand-in for the GETs of the S3 client, with a fixed latency and a limit of requests in flight.
+    """
+
+    def __init__(self, snapshot, latency, bandwidth, capacity):
+        self.snapshot = snapshot
+        self.delay = latency + len(snapshot) / (bandwidth * 2 ** 20)
+        self.capacity = capacity
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def get_object(self, Bucket, Key):
+        with self._lock:
+            if self.capacity and self.in_flight >= self.capacity:
+                self.throttled += 1
+                raise ClientError({'Error': {'Code': 'SlowDown', 'Message': 'Please reduce your request rate.'}},
+                                  'GetObject')
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            return {'Body': io.BytesIO(self.snapshot), 'ResponseMetadata': {'RetryAttempts': 0}}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def run(s3, keys, schema, workers, maximum):
+    start = time.perf_counter()
+    with patch.object(merge, 's3', s3), patch.object(merge, 'MAX_CONCURRENCY', maximum):
+        rows = sum(df.height for df in merge.process_files(keys, schema, 'input', workers))
+    return time.perf_counter() - start, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--snapshots', type=int, default=1440)
+    parser.add_argument('--vehicles', type=int, default=1500)
+    parser.add_argument('--latency', type=float, default=0.03, help='Seconds of first byte latency of a GET')
+    parser.add_argument('--bandwidth', type=float, default=50, help='MiB/s of one connection')
+    parser.add_argument('--capacity', type=int, default=12, help='GETs in flight before S3 throttles (0: never)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    snapshot = make_snapshot(args.vehicles)
+    keys = make_keys(args.snapshots)
+    schema = merge.resolve_schema('input', keys)
+    print(f'{args.snapshots} snapshots of {len(snapshot) / 1024:.0f} KiB, {args.latency * 1000:.0f} ms latency, '
+          f'throttling above {args.capacity or "no"} GETs in flight')
+    print(f'{"engine":24} {"seconds":>8} {"files/s":>8} {"peak in flight":>14} {"throttled":>9}')
+
+    runs = [(f'fixed {n}', n, n, 0) for n in args.concurrency]
+    runs += [(f'fixed {n} (throttling)', n, n, args.capacity) for n in args.concurrency if n > args.capacity]
+    runs += [('adaptive 1..32', 1, 32, 0), ('adaptive 1..32 (throttling)', 1, 32, args.capacity)]
+    for name, workers, maximum, capacity in runs:
+        s3 = LatencyS3(snapshot, args.latency, args.bandwidth, capacity)
+        seconds, rows = run(s3, keys, schema, workers, maximum)
+        print(f'{name:24} {seconds:>8.2f} {args.snapshots / seconds:>8.0f} {s3.peak_in_flight:>14} '
+              f'{s3.throttled:>9}')
+
+
+if __name__ == '__main__':
+    main()
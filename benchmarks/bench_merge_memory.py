@@ -0,0 +1,208 @@
+"""
+Benchmark of the peak memory of STM_Merge_Daily_GTFS_VehiclePositions against the volume of a day: the streaming
+merge (row groups written to a multipart upload as the snapshots are processed) against the previous path, which
+concatenated the whole day in memory before writing it.
+
+Usage (from the root of the repository):
+    python -m benchmarks.bench_merge_memory
+    python -m benchmarks.bench_merge_memory --scales 1 5 20 --vehicles 1500 --baseline-scales 1 2
+
+A scale of 1 is a day of 1440 snapshots of --vehicles vehicles. S3 is replaced by a local stand-in that serves the
+same snapshot for every key, with the vehicle timestamps moved to the minute of the key, and writes the uploaded
+objects on disk. Above 1x, the vehicles report once a minute, so the snapshots of the same minute repeat their
+observations and are suppressed by the merge. The seconds include the encoding of the snapshots by the stand-in. The
+streaming run starts without hourly parts, so it compacts the 24 hours before merging them. An hour is sorted by runs
+spilled to disk then merged, and the parts are streamed to disk before the merge of the day, so the peak of the
+streaming run follows the size of a run (RUN_SIZE rows), not the volume of an hour or of the day. Each run is done in a
+fresh process so its peak RSS is not shared with the other runs.
+"""
+import argparse
+import functools
+import io
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from unittest.mock import patch
+
+import polars as pl
+
+SNAPSHOTS_PER_DAY = 1440
+DATE = '20231115'  # The merge processes the day before
+PREFIX = '2023/11/14/'
+
+
+class LocalS3:
+    """
+    Stand-in for the S3 client used by the merge. Every snapshot key of the input bucket returns the same Parquet
+    file. The uploaded objects (hourly parts, daily file) are written in a temporary directory, not kept in memory.
+    """
+
+    def __init__(self, snapshot, keys, directory):
+        self.snapshot = snapshot
+        self.snapshot_df = pl.read_parquet(io.BytesIO(snapshot))
+        self.keys = keys
+        self.directory = directory
+        self.objects = {}
+        self.metadata = {}
+        self.uploaded_bytes = 0
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        keys = self.keys if Bucket == 'input' else sorted(key for key in self.objects if key.startswith(Prefix))
+        for start in range(0, len(keys), 1000):
+            yield {'Contents': [{'Key': key} for key in keys[start:start + 1000]]}
+
+    def get_object(self, Bucket, Key, Range=None):
+        if Bucket == 'input' and Range is None:
+            body = self._minute_snapshot(int(Key.split('_')[-1].split('.')[0]) // 60)
+        elif Bucket == 'input':
+            body = self.snapshot
+        elif Range is None:
+            # Streamed like the body of a real response, the reader decides how much is held in memory
+            return {'Body': open(self.objects[Key], 'rb')}
+        else:
+            with open(self.objects[Key], 'rb') as f:
+                body = f.read()
+        if Range is not None:
+            body = body[-int(Range.split('=-')[1]):]
+        return {'Body': io.BytesIO(body)}
+
+    @functools.lru_cache(maxsize=8)
+    def _minute_snapshot(self, minute):
+        # The keys are read in order, the snapshots of a minute are encoded once
+        df = self.snapshot_df.with_columns(pl.col('vehicle_timestamp') - self.snapshot_df['vehicle_timestamp'].max() +
+                                           minute * 60)
+        buffer = io.BytesIO()
+        df.write_parquet(buffer, compression='uncompressed')  # Faster to encode, the download is not measured
+        return buffer.getvalue()
+
+    def head_object(self, Bucket, Key):
+        return {'Metadata': self.metadata[Key]}
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, **kwargs):
+        self._path(Key, truncate=True)
+        self._append(Key, Body)
+        self.metadata[Key] = Metadata or {}
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None, **kwargs):
+        self._path(Key, truncate=True)
+        self.metadata[Key] = Metadata or {}
+        return {'UploadId': Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._append(Key, Body)
+        return {'ETag': f'etag-{PartNumber}'}
+
+    def complete_multipart_upload(self, **kwargs):
+        pass
+
+    def abort_multipart_upload(self, **kwargs):
+        pass
+
+    def _path(self, key, truncate=False):
+        path = os.path.join(self.directory, key.replace('/', '_'))
+        if truncate:
+            open(path, 'wb').close()
+        self.objects[key] = path
+        return path
+
+    def _append(self, key, body):
+        with open(self.objects[key], 'ab') as f:
+            f.write(body)
+        self.uploaded_bytes += len(body)
+
+
+def make_snapshot(vehicles):
+    from benchmarks.bench_gtfs_rt_decoder import generate_vehicle_positions_feed
+    from STM_Services.STM_Fetch_GTFS_VehiclePositions.main import decode_vehicle_positions
+
+    buffer = io.BytesIO()
+    decode_vehicle_positions(generate_vehicle_positions_feed(vehicles)).write_parquet(buffer, compression='gzip')
+    return buffer.getvalue()
+
+
+def make_keys(snapshots):
+    return [f'{PREFIX}STM_GTFS_VehiclePositions_{1699938000 + i * 60 // (snapshots // SNAPSHOTS_PER_DAY)}.v2.parquet'
+            for i in range(snapshots)]
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_streaming(scale, vehicles, workers, queue):
+    from STM_Services.STM_Merge_Daily_GTFS_VehiclePositions import main
+
+    with tempfile.TemporaryDirectory() as directory:
+        s3 = LocalS3(make_snapshot(vehicles), make_keys(SNAPSHOTS_PER_DAY * scale), directory)
+        start_rss = peak_rss_mib()
+        start = time.perf_counter()
+        with patch.object(main, 's3', s3):
+            # No hourly part yet, the daily run compacts the 24 hours then concatenates them
+            main.lambda_handler({'input_bucket': 'input', 'output_bucket': 'output', 'date': DATE,
+                                 'workers': workers}, None)
+        daily_bytes = os.path.getsize(s3.objects[f'{PREFIX}Daily_GTFS_VehiclePosition_2023-11-14.parquet'])
+    queue.put((time.perf_counter() - start, start_rss, peak_rss_mib(), daily_bytes))
+
+
+def run_in_memory(scale, vehicles, workers, queue):
+    # Previous path: every processed snapshot is kept, concatenated, then written in one go
+    from STM_Services.STM_Merge_Daily_GTFS_VehiclePositions import main
+
+    with tempfile.TemporaryDirectory() as directory:
+        s3 = LocalS3(make_snapshot(vehicles), make_keys(SNAPSHOTS_PER_DAY * scale), directory)
+        start_rss = peak_rss_mib()
+        start = time.perf_counter()
+        with patch.object(main, 's3', s3):
+            schema = main.resolve_schema('input', s3.keys)
+            merged_df = pl.concat(list(main.process_files(s3.keys, schema, 'input', workers)))
+            buffer = io.BytesIO()
+            merged_df.write_parquet(buffer, compression='gzip')
+            s3.put_object(Bucket='output', Key='daily.parquet', Body=buffer.getvalue())
+    queue.put((time.perf_counter() - start, start_rss, peak_rss_mib(), s3.uploaded_bytes))
+
+
+def measure(target, scale, vehicles, workers):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=target, args=(scale, vehicles, workers, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        # Typically killed by the OOM killer
+        return None
+    return queue.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 5, 20])
+    parser.add_argument('--baseline-scales', type=int, nargs='*', default=[1],
+                        help='Scales also run with the previous in-memory merge (it needs RAM proportional to the day)')
+    parser.add_argument('--vehicles', type=int, default=1500)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    print(f'{SNAPSHOTS_PER_DAY} snapshots of {args.vehicles} vehicles per 1x day')
+    print(f'{"merge":10} {"scale":>5} {"rows":>12} {"output MiB":>10} {"seconds":>8} {"peak RSS MiB":>12} '
+          f'{"above start":>11}')
+    runs = [('streaming', run_streaming, scale) for scale in args.scales]
+    runs += [('in-memory', run_in_memory, scale) for scale in args.baseline_scales]
+    for name, target, scale in runs:
+        rows = SNAPSHOTS_PER_DAY * scale * args.vehicles
+        result = measure(target, scale, args.vehicles, args.workers)
+        if result is None:
+            print(f'{name:10} {scale:>4}x {rows:>12,} failed (out of memory?)')
+            continue
+        seconds, start_rss, peak_rss, uploaded = result
+        print(f'{name:10} {scale:>4}x {rows:>12,} {uploaded / 2 ** 20:>10.1f} {seconds:>8.1f} {peak_rss:>12.0f} '
+              f'{peak_rss - start_rss:>11.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark of the sharded analysis of STM_Analyse_Daily_Stops_Data on a weekday: the handler run with the trips split
+in --shards ranges of trip_id, analysed one after the other.
+
+Usage (from the root of the repository):
+    python -m benchmarks.bench_shard_stops
+    python -m benchmarks.bench_shard_stops --trips 20000 --shards 1 4 16 --repeat 3
+
+The two days are generated by bench_analyse_stops.generate_days. Each run is done in a fresh process so its peak RSS
+is not shared with the other runs. The outputs of all the runs are compared to the one of the first --shards value.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from datetime import timedelta
+
+import polars as pl
+
+from benchmarks.bench_analyse_stops import SERVICE_DATE, TIMEZONE, generate_days, measure
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(directory, shards, queue):
+    from unittest.mock import patch
+
+    from STM_Services.STM_Analyse_Daily_Stops_Data import main
+
+    def download(bucket, key, local_file_name):
+        return os.path.join(directory, os.path.basename(local_file_name))
+
+    def upload(local_file_name, bucket, key):
+        os.replace(local_file_name, os.path.join(directory, f'shards_{shards}.parquet'))
+
+    start_rss = peak_rss_mib()
+    start = time.perf_counter()
+    # The handler analyses the day before yesterday
+    event = {'daily_static_bucket': 'static', 'bucket_vehicle_positions_daily_merge': 'merge', 'output_bucket': 'output',
+             'timezone': TIMEZONE, 'date': f'{SERVICE_DATE + timedelta(days=2):%Y%m%d}', 'shards': shards}
+    with patch.object(main, 'download_file_to_tmp', download), patch.object(main, 'upload_file_from_tmp', upload), \
+            patch.object(main, 'clean_tmp_folder'):
+        main.lambda_handler(event, None)
+    queue.put((time.perf_counter() - start, start_rss, peak_rss_mib()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trips', type=int, default=20000)
+    parser.add_argument('--stops-per-trip', type=int, default=40)
+    parser.add_argument('--poll-interval', type=int, default=30)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Generated in another process: the peak RSS of a process is inherited by the processes it starts
+        process = multiprocessing.get_context('spawn').Process(target=generate_days, args=(
+            directory, args.trips, args.stops_per_trip, args.poll_interval))
+        process.start()
+        process.join()
+
+        print(f'{args.trips:,} trips, {args.trips * args.stops_per_trip:,} stop times (median of {args.repeat} runs)')
+        print(f'{"shards":>6} {"seconds":>8} {"peak RSS MiB":>12} {"above start":>11}')
+        outputs = []
+        for shards in args.shards:
+            results = [measure(run, directory, shards) for _ in range(args.repeat)]
+            if None in results:
+                print(f'{shards:>6} failed (out of memory?)')
+                continue
+            seconds, start_rss, peak_rss = sorted(results)[len(results) // 2]
+            print(f'{shards:>6} {seconds:>8.2f} {peak_rss:>12.0f} {peak_rss - start_rss:>11.0f}')
+            outputs.append(pl.read_parquet(os.path.join(directory, f'shards_{shards}.parquet')))
+
+        assert all(df.equals(outputs[0]) for df in outputs[1:]), 'the outputs differ'
+
+
+if __name__ == '__main__':
+    main()
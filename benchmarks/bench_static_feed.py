@@ -0,0 +1,249 @@
+"""
+Benchmark of the conversion of the static GTFS feed by STM_Fetch_Update_GTFS_Static_files: the previous path (the ZIP
+downloaded by 128-byte chunks, every member extracted to disk, read with schema inference and written in a buffer
+before put_object) against the streaming conversion (members parsed from the ZIP by blocks with the declared
+schemas, row groups uploaded by parts as they are written).
+
+Usage (from the root of the repository):
+    python -m benchmarks.bench_static_feed
+    python -m benchmarks.bench_static_feed --trips 180000 --stops-per-trip 40 --shapes 1500
+
+The generated feed has the size of the feed of the STM (--trips trips of --stops-per-trip stops, stop_times sorted by
+trip, --shapes shapes of 500 points). The HTTP download and S3 are replaced by local stand-ins: the response is read
+from the ZIP on disk, and the uploaded objects are written in a temporary directory. Each run is done in a fresh
+process so its peak RSS is not shared with the other runs. The streaming run also builds the stop patterns: the trips
+of the generated feed have random stops, so each one is its own pattern (the worst case, see bench_stop_patterns).
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import zipfile
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import polars as pl
+
+LAST_MODIFIED = 'Wed, 15 Nov 2023 07:28:00 GMT'
+
+
+def generate_feed(path, trips, stops_per_trip, shapes, seed=0):
+    rng = np.random.default_rng(seed)
+    stops = 9000
+    routes = 220
+    service_ids = [f'23N-H{i:02d}N000S-8{i % 10}-S' for i in range(40)]
+    trip_ids = np.arange(260000000, 260000000 + trips)
+
+    rows = trips * stops_per_trip
+    seconds = np.repeat(rng.integers(5 * 3600, 25 * 3600, trips), stops_per_trip) + np.tile(
+        np.arange(stops_per_trip) * 90, trips)
+    s = pl.col('seconds')
+    times = pl.DataFrame({'seconds': seconds}).select(pl.format(
+        '{}:{}:{}', *[part.cast(pl.Utf8).str.zfill(2) for part in [s // 3600, s // 60 % 60, s % 60]])).to_series()
+    tables = {
+        'stop_times': pl.DataFrame({
+            'trip_id': np.repeat(trip_ids, stops_per_trip),
+            'arrival_time': times,
+            'departure_time': times,
+            'stop_id': rng.integers(50000, 50000 + stops, rows),
+            'stop_sequence': np.tile(np.arange(1, stops_per_trip + 1), trips),
+        }),
+        'trips': pl.DataFrame({
+            'route_id': rng.integers(1, routes + 1, trips),
+            'service_id': rng.choice(service_ids, trips),
+            'trip_id': trip_ids,
+            'trip_headsign': rng.choice(['Nord', 'Sud', 'Est', 'Ouest'], trips),
+            'direction_id': rng.integers(0, 2, trips),
+            'shape_id': rng.integers(0, shapes, trips),
+            'wheelchair_accessible': np.ones(trips, dtype=np.int64),
+            'note_fr': [None] * trips,
+            'note_en': [None] * trips,
+        }),
+        'shapes': pl.DataFrame({
+            'shape_id': np.repeat(np.arange(shapes), 500),
+            'shape_pt_lat': 45.5 + rng.random(shapes * 500) / 10,
+            'shape_pt_lon': -73.6 + rng.random(shapes * 500) / 10,
+            'shape_pt_sequence': np.tile(np.arange(1, 501), shapes),
+        }),
+        'stops': pl.DataFrame({
+            'stop_id': np.arange(50000, 50000 + stops).astype(str),
+            'stop_code': np.arange(50000, 50000 + stops),
+            'stop_name': [f'Station {i} / Rue {i % 300}' for i in range(stops)],
+            'stop_lat': 45.5 + rng.random(stops) / 10,
+            'stop_lon': -73.6 + rng.random(stops) / 10,
+            'stop_url': ['https://www.stm.info/fr/infos/reseaux/bus'] * stops,
+            'location_type': np.zeros(stops, dtype=np.int64),
+            'parent_station': [None] * stops,
+            'wheelchair_boarding': rng.integers(0, 3, stops),
+        }),
+        'routes': pl.DataFrame({
+            'route_id': np.arange(1, routes + 1),
+            'agency_id': ['STM'] * routes,
+            'route_short_name': np.arange(1, routes + 1),
+            'route_long_name': [f'Boulevard {i}' for i in range(routes)],
+            'route_type': np.full(routes, 3),
+            'route_url': ['https://www.stm.info/fr/infos/reseaux/bus'] * routes,
+            'route_color': ['009EE0'] * routes,
+            'route_text_color': ['FFFFFF'] * routes,
+        }),
+        'calendar_dates': pl.DataFrame({
+            'service_id': np.repeat(service_ids, 8),
+            'date': np.tile(np.arange(20231101, 20231109), len(service_ids)),
+            'exception_type': np.ones(len(service_ids) * 8, dtype=np.int64),
+        }),
+        'agency': pl.DataFrame({'agency_id': ['STM'], 'agency_name': ['Société de transport de Montréal'],
+                                'agency_url': ['http://www.stm.info'], 'agency_timezone': ['America/Montreal']}),
+    }
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        for table, df in tables.items():
+            buffer = io.BytesIO()
+            df.write_csv(buffer)
+            z.writestr(f'{table}.txt', buffer.getvalue())
+
+
+class LocalS3:
+    """
+    Stand-in for the S3 client of the updater. The uploaded objects are written in a temporary directory.
+    """
+
+    class exceptions:
+        NoSuchKey = KeyError
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.uploaded_bytes = 0
+        self.requests = 0
+
+    def get_object(self, Bucket, Key):
+        raise KeyError(Key)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._write(Key, Body, 'wb')
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._write(Key, b'', 'wb')
+        return {'UploadId': Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._write(Key, Body, 'ab')
+        return {'ETag': f'etag-{PartNumber}'}
+
+    def complete_multipart_upload(self, **kwargs):
+        pass
+
+    def abort_multipart_upload(self, **kwargs):
+        pass
+
+    def _write(self, key, body, mode):
+        with open(os.path.join(self.directory, key.replace('/', '_')), mode) as f:
+            f.write(body.encode() if isinstance(body, str) else body)
+        self.uploaded_bytes += len(body)
+        self.requests += 1
+
+
+def http_stand_in(path):
+    """
+    :return: the patched requests.head and requests.get, serving the ZIP on disk
+    """
+    def iter_content(chunk_size):
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+    head = MagicMock(return_value=MagicMock(headers={'Last-Modified': LAST_MODIFIED}))
+    response = MagicMock()
+    response.iter_content.side_effect = iter_content
+    return head, MagicMock(return_value=response)
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_previous(path, directory, queue):
+    # Previous path of the updater
+    s3 = LocalS3(directory)
+    head, get = http_stand_in(path)
+    start_rss = peak_rss_mib()
+    start = time.perf_counter()
+    response = get(path, stream=True)
+    zip_tmp_path = os.path.join(directory, 'tempfile.zip')
+    with open(zip_tmp_path, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=128):
+            f.write(chunk)
+    with zipfile.ZipFile(zip_tmp_path) as z:
+        for filename in z.namelist():
+            z.extract(filename, directory)
+            df = pl.read_csv(os.path.join(directory, filename))
+            folder_name = filename.replace('.txt', '')
+            if folder_name == 'stop_times':
+                df = df.sort(['trip_id', 'stop_sequence'])
+            parquet_buffer = io.BytesIO()
+            df.write_parquet(parquet_buffer, statistics=True, row_group_size=64 * 1024)
+            s3.put_object(Bucket='static', Key=f'{folder_name}/{folder_name}.parquet', Body=parquet_buffer.getvalue())
+    queue.put((time.perf_counter() - start, start_rss, peak_rss_mib(), s3.uploaded_bytes, s3.requests))
+
+
+def run_streaming(path, directory, queue):
+    from STM_Services.STM_Fetch_Update_GTFS_Static_files import main
+
+    s3 = LocalS3(directory)
+    head, get = http_stand_in(path)
+    start_rss = peak_rss_mib()
+    start = time.perf_counter()
+    # The handler downloads the ZIP to /tmp/tempfile.zip
+    with patch.object(main.boto3, 'client', return_value=s3), patch.object(main.requests, 'head', head), \
+            patch.object(main.requests, 'get', get):
+        main.lambda_handler({'bucket_name': 'static', 'url': path}, None)
+    queue.put((time.perf_counter() - start, start_rss, peak_rss_mib(), s3.uploaded_bytes, s3.requests))
+
+
+def measure(target, *args):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=target, args=(*args, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        # Typically killed by the OOM killer
+        return None
+    return queue.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trips', type=int, default=180000)
+    parser.add_argument('--stops-per-trip', type=int, default=40)
+    parser.add_argument('--shapes', type=int, default=1500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'gtfs_stm.zip')
+        # Generated in another process: the peak RSS of a process is inherited by the processes it starts
+        process = multiprocessing.get_context('spawn').Process(target=generate_feed, args=(
+            path, args.trips, args.stops_per_trip, args.shapes))
+        process.start()
+        process.join()
+        with zipfile.ZipFile(path) as z:
+            text_bytes = sum(info.file_size for info in z.infolist())
+        print(f'ZIP of {os.path.getsize(path) / 2 ** 20:.0f} MiB ({text_bytes / 2 ** 20:.0f} MiB of text), '
+              f'{args.trips * args.stops_per_trip:,} stop times')
+        print(f'{"path":10} {"seconds":>8} {"peak RSS MiB":>12} {"above start":>11} {"output MiB":>10} '
+              f'{"S3 requests":>11}')
+        for name, target in [('previous', run_previous), ('streaming', run_streaming)]:
+            with tempfile.TemporaryDirectory() as run_directory:
+                result = measure(target, path, run_directory)
+            if result is None:
+                print(f'{name:10} failed (out of memory?)')
+                continue
+            seconds, start_rss, peak_rss, uploaded, requests = result
+            print(f'{name:10} {seconds:>8.2f} {peak_rss:>12.0f} {peak_rss - start_rss:>11.0f} '
+                  f'{uploaded / 2 ** 20:>10.1f} {requests:>11}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Benchmark of the stop patterns of STM_Fetch_Update_GTFS_Static_files: the size of stop_times against the size of
+stop_patterns and trip_patterns, and the daily filtering of STM_Filter_Daily_GTFS_Static_files from each of them (the
+lazy scan of stop_times against the expansion of the patterns of the trips of the day).
+
+Usage (from the root of the repository):
+    python -m benchmarks.bench_stop_patterns
+    python -m benchmarks.bench_stop_patterns --trips 180000 --stops-per-trip 40 --patterns 3000 --services 4
+
+The generated stop_times has --trips trips of --stops-per-trip stops, each trip running one of --patterns stop
+patterns (stops and running times) at its own start time, split in --services services of consecutive trip_ids (a
+day runs one of them). The files are written like STM_Fetch_Update_GTFS_Static_files does. Each run is done in a
+fresh process so its peak RSS is not shared with the other runs.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+
+from STM_Services.STM_Fetch_Update_GTFS_Static_files.main import ROW_GROUP_SIZE, build_stop_patterns, \
+    write_parquet_batches
+from STM_Services.STM_Filter_Daily_GTFS_Static_files.main import STOP_TIMES_COLUMNS, expand_stop_patterns
+
+
+def generate_stop_times(path, trips, stops_per_trip, patterns, seed=0):
+    rng = np.random.default_rng(seed)
+    pattern_stops = rng.integers(50000, 62000, (patterns, stops_per_trip))
+    pattern_offsets = np.cumsum(rng.integers(45, 150, (patterns, stops_per_trip)), axis=1) - 45
+    trip_patterns = rng.integers(0, patterns, trips)
+    starts = rng.integers(5 * 3600, 25 * 3600, trips)
+    times = (np.repeat(starts, stops_per_trip) + pattern_offsets[trip_patterns].ravel()).astype(np.int32)
+    df = pl.DataFrame({
+        'trip_id': np.repeat(np.arange(260000000, 260000000 + trips), stops_per_trip),
+        'arrival_time': times,
+        'departure_time': times,
+        'stop_id': pattern_stops[trip_patterns].ravel(),
+        'stop_sequence': np.tile(np.arange(1, stops_per_trip + 1), trips),
+    })
+    with open(path, 'wb') as f:
+        write_parquet_batches(f, df.iter_slices(ROW_GROUP_SIZE))
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_build(directory, queue):
+    # Run by the updater on a new stop_times, read here by row groups instead of CSV blocks
+    start_rss = peak_rss_mib()
+    start = time.perf_counter()
+    parquet_file = pq.ParquetFile(os.path.join(directory, 'stop_times.parquet'))
+    batches = (pl.from_arrow(batch) for batch in parquet_file.iter_batches(batch_size=ROW_GROUP_SIZE))
+    stop_patterns_df, trip_patterns_df = build_stop_patterns(batches)
+    for table, df in [('stop_patterns', stop_patterns_df), ('trip_patterns', trip_patterns_df)]:
+        with open(os.path.join(directory, f'{table}.parquet'), 'wb') as f:
+            write_parquet_batches(f, df.iter_slices(ROW_GROUP_SIZE))
+    queue.put((time.perf_counter() - start, start_rss, peak_rss_mib()))
+
+
+def run_scan(directory, trip_ids, queue):
+    # Filter from stop_times: lazy scan, only the needed columns, skipped row groups
+    start_rss = peak_rss_mib()
+    start = time.perf_counter()
+    stop_times_lf = pl.scan_parquet(os.path.join(directory, 'stop_times.parquet'))
+    stop_times_lf.select(STOP_TIMES_COLUMNS).filter(pl.col('trip_id').is_in(trip_ids)).sink_parquet(
+        os.path.join(directory, 'scan.parquet'))
+    queue.put((time.perf_counter() - start, start_rss, peak_rss_mib()))
+
+
+def run_patterns(directory, trip_ids, queue):
+    # Filter from the patterns: the trips of the day expanded to their stop times
+    start_rss = peak_rss_mib()
+    start = time.perf_counter()
+    stop_patterns_df = pl.read_parquet(os.path.join(directory, 'stop_patterns.parquet'))
+    trip_patterns_df = pl.read_parquet(os.path.join(directory, 'trip_patterns.parquet'))
+    day_trip_patterns_df = trip_patterns_df.filter(pl.col('trip_id').is_in(trip_ids))
+    expand_stop_patterns(day_trip_patterns_df, stop_patterns_df).write_parquet(
+        os.path.join(directory, 'patterns.parquet'))
+    queue.put((time.perf_counter() - start, start_rss, peak_rss_mib()))
+
+
+def measure(target, *args):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=target, args=(*args, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        # Typically killed by the OOM killer
+        return None
+    return queue.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trips', type=int, default=180000)
+    parser.add_argument('--stops-per-trip', type=int, default=40)
+    parser.add_argument('--patterns', type=int, default=3000)
+    parser.add_argument('--services', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Generated in another process: the peak RSS of a process is inherited by the processes it starts
+        process = multiprocessing.get_context('spawn').Process(target=generate_stop_times, args=(
+            os.path.join(directory, 'stop_times.parquet'), args.trips, args.stops_per_trip, args.patterns))
+        process.start()
+        process.join()
+        trips_per_service = args.trips // args.services
+        trip_ids = pl.Series('trip_id', np.arange(260000000, 260000000 + trips_per_service))
+
+        print(f'{args.trips * args.stops_per_trip:,} stop times, {args.patterns:,} patterns, '
+              f'{len(trip_ids):,} trips in the day')
+        print(f'{"step":18} {"seconds":>8} {"peak RSS MiB":>12} {"above start":>11}')
+        for name, target, target_args in [('build patterns', run_build, ()), ('filter stop_times', run_scan, (trip_ids,)),
+                                          ('filter patterns', run_patterns, (trip_ids,))]:
+            result = measure(target, directory, *target_args)
+            if result is None:
+                print(f'{name:18} failed (out of memory?)')
+                continue
+            seconds, start_rss, peak_rss = result
+            print(f'{name:18} {seconds:>8.2f} {peak_rss:>12.0f} {peak_rss - start_rss:>11.0f}')
+
+        scan_df = pl.read_parquet(os.path.join(directory, 'scan.parquet'))
+        assert pl.read_parquet(os.path.join(directory, 'patterns.parquet')).equals(scan_df)
+        print()
+        for table in ['stop_times', 'stop_patterns', 'trip_patterns']:
+            path = os.path.join(directory, f'{table}.parquet')
+            print(f'{table:14} {pl.scan_parquet(path).select(pl.count()).collect().item():>10,} rows '
+                  f'{os.path.getsize(path) / 2 ** 20:>8.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,34 @@
 from datetime import datetime, timezone
+import os
+import shutil
+import tempfile
 import unittest
 import polars as pl
+import pyarrow.parquet as pq
 import pytz
 from unittest.mock import patch
-from STM_Services.STM_Analyse_Daily_Stops_Data.main import download_file_to_tmp, upload_file_from_tmp, lambda_handler, adding_arrival_time_unix
+from STM_Services.STM_Analyse_Daily_Stops_Data.main import download_file_to_tmp, upload_file_from_tmp, lambda_handler, adding_arrival_time_unix, match_stop_times, analyse_daily_stops, write_intraday_partitions
+from STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main import select_day_head, SORT_COLUMNS
+
+# Files of 2023-11-14 generated by benchmarks.bench_analyse_stops.generate_days (12 trips of 40 stops), and the expected
+# output data_stops_2023-11-14.parquet, written by the handler before the analysis was a lazy query
+TEST_FILES = os.path.join(os.path.dirname(__file__), 'test_files', 'STM_Analyse_Daily_Stops_Data')
+
+
+def write_head_file(daily_path, head_path, head_end):
+    # Head of a day, as written by STM_Merge_Daily_GTFS_VehiclePositions from its sorted daily file
+    df = pl.read_parquet(daily_path).sort(SORT_COLUMNS)
+    select_day_head(df, head_end, SORT_COLUMNS).write_parquet(head_path)
+    return head_path
+
 
 class TestLambdaFunction(unittest.TestCase):
     
     @patch('STM_Services.STM_Analyse_Daily_Stops_Data.main.upload_file_from_tmp', return_value=True)
     @patch('STM_Services.STM_Analyse_Daily_Stops_Data.main.download_file_to_tmp')
-    @patch('STM_Services.STM_Analyse_Daily_Stops_Data.main.pl.read_parquet')
     @patch('STM_Services.STM_Analyse_Daily_Stops_Data.main.pl.DataFrame.write_parquet')
     @patch('STM_Services.STM_Analyse_Daily_Stops_Data.main.clean_tmp_folder')
-    def test_lambda_handler_success(self, mock_clean, mock_write_parquet, mock_read_parquet, mock_download, mock_upload):
+    def test_lambda_handler_success(self, mock_clean, mock_write_parquet, mock_download, mock_upload):
         
         timestamp1 = int(datetime(2023, 1, 1, 12, 0, 0, tzinfo=timezone.utc).timestamp())
         timestamp2 = int(datetime(2023, 1, 1, 13, 0, 0, tzinfo=timezone.utc).timestamp())
@@ -60,7 +76,16 @@ class TestLambdaFunction(unittest.TestCase):
             'stop_sequence': [1, 2]
         })
 
-        mock_read_parquet.side_effect = [mock_df_daily_merge, mock_df_next_day, mock_df_static_file]
+        # The handler scans the downloaded files (written with pyarrow, DataFrame.write_parquet is patched)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        for df, file_name in [(mock_df_daily_merge, 'Daily_merge_2022-12-30.parquet'),
+                              (mock_df_next_day, 'Daily_merge_2022-12-31.parquet'),
+                              (mock_df_next_day, 'Daily_merge_2022-12-31_head.parquet'),
+                              (mock_df_static_file, 'filtered_stop_times_2022-12-30.parquet')]:
+            pq.write_table(df.to_arrow(), os.path.join(tmp_dir.name, file_name))
+        mock_download.side_effect = lambda bucket, key, local_file_name: os.path.join(
+            tmp_dir.name, os.path.basename(local_file_name))
         mock_write_parquet.return_value = None
 
         event = {
@@ -77,12 +102,282 @@ class TestLambdaFunction(unittest.TestCase):
         mock_download.assert_called()
         mock_upload.assert_called_with('/tmp/data_stops_2022-12-30.parquet', 'output-bucket', '2022/12/30/data_stops_2022-12-30.parquet')
         mock_clean.assert_called()
-        mock_read_parquet.assert_called()
         mock_write_parquet.assert_called_once()
         call_args, call_kwargs = mock_write_parquet.call_args
         expected_path = f'/tmp/data_stops_2022-12-30.parquet'
         self.assertIn(expected_path, call_args[0])
 
+    @patch('STM_Services.STM_Analyse_Daily_Stops_Data.main.upload_file_from_tmp', return_value=True)
+    @patch('STM_Services.STM_Analyse_Daily_Stops_Data.main.download_file_to_tmp')
+    @patch('STM_Services.STM_Analyse_Daily_Stops_Data.main.clean_tmp_folder')
+    def test_lambda_handler_golden_output(self, mock_clean, mock_download, mock_upload):
+        # The head of 2023-11-15 ends at 06:00, after the last arrival of 2023-11-14 (00:19) plus the tolerance
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        head_end = int(pytz.timezone('America/Montreal').localize(datetime(2023, 11, 15, 6)).timestamp())
+        head_files = {'2023/11/15/Daily_GTFS_VehiclePosition_2023-11-15_head.parquet': write_head_file(
+            os.path.join(TEST_FILES, 'Daily_merge_2023-11-15.parquet'),
+            os.path.join(directory.name, 'Daily_merge_2023-11-15_head.parquet'), head_end)}
+        mock_download.side_effect = lambda bucket, key, local_file_name: head_files.get(key, os.path.join(
+            TEST_FILES, os.path.basename(local_file_name)))
+        output_path = '/tmp/data_stops_2023-11-14.parquet'
+        self.addCleanup(lambda: os.path.exists(output_path) and os.remove(output_path))
+
+        event = {
+            'daily_static_bucket': 'test-bucket',
+            'bucket_vehicle_positions_daily_merge': 'vehicle-positions-bucket',
+            'output_bucket': 'output-bucket',
+            'timezone': 'America/Montreal',
+            'date': '20231116',
+        }
+        expected_df = pl.read_parquet(os.path.join(TEST_FILES, 'data_stops_2023-11-14.parquet'))
+
+        # The 12 trips analysed at once, and in ranges of trip_id (one of them with a single trip), with the head of the
+        # next day, or its daily file for the days merged before the head files
+        for shards, head in [(1, True), (5, True), (12, True), (1, False)]:
+            with self.subTest(shards=shards, head=head):
+                if not head:
+                    head_files = {key: False for key in head_files}
+                mock_download.reset_mock()
+                lambda_handler({**event, 'shards': shards}, None)
+
+                next_day_keys = [args[1] for args, _ in mock_download.call_args_list if '2023/11/15/' in args[1]]
+                self.assertEqual(next_day_keys, ['2023/11/15/Daily_GTFS_VehiclePosition_2023-11-15_head.parquet'] +
+                                 ([] if head else ['2023/11/15/Daily_GTFS_VehiclePosition_2023-11-15.parquet']))
+
+                mock_upload.assert_called_with(output_path, 'output-bucket', '2023/11/14/data_stops_2023-11-14.parquet')
+                result_df = pl.read_parquet(output_path)
+                self.assertEqual(result_df.schema, expected_df.schema)
+                self.assertTrue(result_df.equals(expected_df))
+                self.assertFalse(os.path.exists('/tmp/data_stops_2023-11-14_shard_0.parquet'))
+
+
+    def test_analyse_daily_stops_shards(self):
+        # The golden days with a vehicle serving three trips: 260000003, then 260000004 without matched position (its
+        # stop_times are missing), then 260000005 moved right after 260000003. The last position of 260000003 is
+        # compared to the first matched one of 260000005. There are also positions without trip.
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        trip_id, vehicle_id = pl.col('vehicle_trip_tripId'), pl.col('vehicle_vehicle_id')
+        shift = 41500 - 21018  # From the first arrival of 260000005 to the one after the last arrival of 260000003
+        paths = {}
+        for day in ['2023-11-14', '2023-11-15']:
+            df = pl.read_parquet(os.path.join(TEST_FILES, f'Daily_merge_{day}.parquet'))
+            df = df.with_columns(
+                pl.when(trip_id.is_between(260000003, 260000005)).then(pl.lit('40004')).otherwise(vehicle_id)
+                .alias('vehicle_vehicle_id'),
+                *[pl.when(trip_id == 260000005).then(pl.col(column) + shift).otherwise(pl.col(column)).alias(column)
+                  for column in ['timefetch', 'vehicle_timestamp']])
+            parked = df.filter(trip_id == 260000000).head(5).with_columns(
+                pl.lit(None, dtype=pl.Int64).alias('vehicle_trip_tripId'), pl.lit('49999').alias('vehicle_vehicle_id'),
+                pl.lit(99, dtype=pl.Int64).alias('vehicle_currentStopSequence'))
+            paths[day] = os.path.join(directory.name, f'Daily_merge_{day}.parquet')
+            pl.concat([parked, df]).sort(['vehicle_trip_tripId', 'vehicle_currentStopSequence', 'timefetch']
+                                         ).write_parquet(paths[day], row_group_size=64)
+        static_path = os.path.join(directory.name, 'filtered_stop_times_2023-11-14.parquet')
+        df_stop_times = pl.read_parquet(os.path.join(TEST_FILES, 'filtered_stop_times_2023-11-14.parquet'))
+        df_stop_times.filter(pl.col('trip_id') != 260000004).with_columns(
+            *[pl.when(pl.col('trip_id') == 260000005).then(pl.col(column) + shift).otherwise(pl.col(column))
+              .cast(df_stop_times[column].dtype).alias(column) for column in ['arrival_time', 'departure_time']]
+        ).write_parquet(static_path)
+        date_obj = pytz.timezone('America/Montreal').localize(datetime(2023, 11, 14))
+
+        outputs = {}
+        # With a lookahead of one trip, the next matched trip after 260000003 is found by the second pass
+        for lookahead in [16, 1]:
+            for shards in range(1, 13):
+                output_path = os.path.join(directory.name, f'data_stops_{shards}_{lookahead}.parquet')
+                with patch('STM_Services.STM_Analyse_Daily_Stops_Data.main.MATCH_LOOKAHEAD_TRIPS', lookahead):
+                    analyse_daily_stops(date_obj, 'America/Montreal', static_path, paths['2023-11-14'],
+                                        paths['2023-11-15'], output_path, shards)
+                outputs[shards, lookahead] = pl.read_parquet(output_path)
+
+        # The stops do not depend on where the ranges of trip_id end
+        self.assertGreater(outputs[1, 16].height, 0)
+        for (shards, lookahead), df in outputs.items():
+            with self.subTest(shards=shards, lookahead=lookahead):
+                self.assertTrue(df.equals(outputs[1, 16]))
+
+    def test_analyse_daily_stops_next_day_head(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        trip_id, sequence = pl.col('vehicle_trip_tripId'), pl.col('vehicle_currentStopSequence')
+        # 260000003 only sends its first stop on 2023-11-14: its last position before the first one of 260000004 (in
+        # transit to stop 1) is fetched on 2023-11-15 after the head, at stop 40
+        day_path = os.path.join(directory.name, 'Daily_merge_2023-11-14.parquet')
+        pl.read_parquet(os.path.join(TEST_FILES, 'Daily_merge_2023-11-14.parquet')).filter(
+            (trip_id != 260000003) | (sequence == 1)).write_parquet(day_path)
+        next_day_path = os.path.join(TEST_FILES, 'Daily_merge_2023-11-15.parquet')
+        head_end = int(pytz.timezone('America/Montreal').localize(datetime(2023, 11, 15, 6)).timestamp())
+        head_path = write_head_file(next_day_path, os.path.join(directory.name, 'Daily_merge_2023-11-15_head.parquet'),
+                                    head_end)
+        self.assertLess(pl.read_parquet(head_path).height, pl.read_parquet(next_day_path).height)
+        static_path = os.path.join(TEST_FILES, 'filtered_stop_times_2023-11-14.parquet')
+        date_obj = pytz.timezone('America/Montreal').localize(datetime(2023, 11, 14))
+
+        outputs = {}
+        for name, path in [('daily', next_day_path), ('head', head_path)]:
+            output_path = os.path.join(directory.name, f'data_stops_{name}.parquet')
+            analyse_daily_stops(date_obj, 'America/Montreal', static_path, day_path, path, output_path)
+            outputs[name] = pl.read_parquet(output_path)
+
+        # The stops are the ones found with the whole next day, the first one of 260000004 included
+        self.assertTrue(outputs['head'].equals(outputs['daily']))
+        self.assertGreater(outputs['daily'].filter((pl.col('trip_id') == 260000004) & (pl.col('stop_sequence') == 1)).height, 0)
+
+    def run_backfill(self, workers):
+        downloaded_keys = []
+        uploaded = {}
+
+        def download(bucket, key, local_file_name):
+            # The backfill deletes its files, the fixtures are copied
+            downloaded_keys.append(key)
+            if not os.path.exists(os.path.join(TEST_FILES, os.path.basename(local_file_name))):
+                return False
+            return shutil.copy(os.path.join(TEST_FILES, os.path.basename(local_file_name)), local_file_name)
+
+        def upload(local_file_name, bucket, key):
+            uploaded[key] = pl.read_parquet(local_file_name)
+            return True
+
+        event = {
+            'daily_static_bucket': 'test-bucket',
+            'bucket_vehicle_positions_daily_merge': 'vehicle-positions-bucket',
+            'output_bucket': 'output-bucket',
+            'timezone': 'America/Montreal',
+            'mode': 'backfill',
+            'start_date': '20231114',
+            'end_date': '20231115',
+            'workers': workers,
+        }
+        with patch('STM_Services.STM_Analyse_Daily_Stops_Data.main.download_file_to_tmp', side_effect=download), \
+                patch('STM_Services.STM_Analyse_Daily_Stops_Data.main.upload_file_from_tmp', side_effect=upload):
+            result = lambda_handler(event, None)
+
+        # Each daily file of VehiclePositions is downloaded once, the 2023-11-15 one is used by both days
+        self.assertEqual(sorted(downloaded_keys), [
+            '2023/11/14/Daily_GTFS_VehiclePosition_2023-11-14.parquet',
+            '2023/11/14/filtered_stop_times/filtered_stop_times_2023-11-14.parquet',
+            '2023/11/15/Daily_GTFS_VehiclePosition_2023-11-15.parquet',
+            '2023/11/15/filtered_stop_times/filtered_stop_times_2023-11-15.parquet',
+            '2023/11/16/Daily_GTFS_VehiclePosition_2023-11-16.parquet',
+        ])
+        # 2023-11-15 has no files in the fixtures, it is skipped
+        self.assertEqual(result['days'], ['2023-11-14'])
+        self.assertEqual(list(uploaded), ['2023/11/14/data_stops_2023-11-14.parquet'])
+        expected_df = pl.read_parquet(os.path.join(TEST_FILES, 'data_stops_2023-11-14.parquet'))
+        self.assertTrue(uploaded['2023/11/14/data_stops_2023-11-14.parquet'].equals(expected_df))
+        # The downloaded and written files are deleted
+        for file_name in ['Daily_merge_2023-11-14.parquet', 'Daily_merge_2023-11-15.parquet',
+                          'filtered_stop_times_2023-11-14.parquet', 'data_stops_2023-11-14.parquet']:
+            self.assertFalse(os.path.exists(os.path.join('/tmp', file_name)))
+
+    def test_lambda_handler_backfill(self):
+        self.run_backfill(workers=1)
+
+    def test_lambda_handler_backfill_process_pool(self):
+        self.run_backfill(workers=2)
+
+    def test_lambda_handler_intraday_and_reconcile(self):
+        # Snapshots of the positions of the fixtures, as written by STM_Fetch_GTFS_VehiclePositions (ids as strings)
+        eastern = pytz.timezone('America/Montreal')
+        snapshots = {}
+        df_positions = pl.concat([pl.read_parquet(os.path.join(TEST_FILES, f'Daily_merge_2023-11-1{day}.parquet'))
+                                  for day in [4, 5]]).with_columns(pl.col('id', 'vehicle_trip_tripId').cast(pl.Utf8))
+        for df_snapshot in df_positions.partition_by('timefetch'):
+            timefetch = df_snapshot['timefetch'][0]
+            folder_name = datetime.fromtimestamp(timefetch, eastern).strftime('%Y/%m/%d')
+            snapshots[f'{folder_name}/STM_GTFS_VehiclePositions_{timefetch}.v2.parquet'] = df_snapshot.drop('timefetch')
+        fetched_until = [0]
+        output_files = {}
+
+        def list_keys(bucket, prefix, start_after=None):
+            keys = snapshots if bucket == 'snapshots-bucket' else output_files
+            return sorted(key for key in keys if key.startswith(prefix) and (start_after is None or key > start_after)
+                          and (keys is output_files or int(key.split('_')[-1].split('.')[0]) <= fetched_until[0]))
+
+        def download(bucket, key, local_file_name):
+            if bucket == 'snapshots-bucket':
+                snapshots[key].write_parquet(local_file_name)
+            elif bucket == 'output-bucket' and key.endswith('.json') and key in output_files:
+                with open(local_file_name, 'wb') as f:
+                    f.write(output_files[key])
+            elif bucket == 'output-bucket' and key in output_files:
+                output_files[key].write_parquet(local_file_name)
+            elif os.path.exists(os.path.join(TEST_FILES, os.path.basename(local_file_name))):
+                shutil.copy(os.path.join(TEST_FILES, os.path.basename(local_file_name)), local_file_name)
+            else:
+                return False
+            return local_file_name
+
+        def upload(local_file_name, bucket, key):
+            if key.endswith('.json'):
+                with open(local_file_name, 'rb') as f:
+                    output_files[key] = f.read()
+            else:
+                output_files[key] = pl.read_parquet(local_file_name)
+            return True
+
+        event = {
+            'daily_static_bucket': 'test-bucket',
+            'bucket_vehicle_positions_daily_merge': 'vehicle-positions-bucket',
+            'bucket_vehicle_positions': 'snapshots-bucket',
+            'output_bucket': 'output-bucket',
+            'timezone': 'America/Montreal',
+        }
+        main = 'STM_Services.STM_Analyse_Daily_Stops_Data.main'
+        with patch(f'{main}.list_keys', side_effect=list_keys), \
+                patch(f'{main}.download_file_to_tmp', side_effect=download), \
+                patch(f'{main}.upload_file_from_tmp', side_effect=upload), \
+                patch(f'{main}.delete_file_from_s3', side_effect=lambda bucket, key: output_files.pop(key, None)), \
+                patch(f'{main}.clean_tmp_folder'):
+            # A run every two hours, from the first trips of the day to the last ones after midnight
+            start = int(eastern.localize(datetime(2023, 11, 14, 4)).timestamp())
+            for fetched_until[0] in range(start, start + 24 * 3600, 2 * 3600):
+                result = lambda_handler({**event, 'mode': 'intraday', 'date': '20231114'}, None)
+                self.assertEqual(list(result['stops']), ['2023-11-14'])
+
+            # Once the trips are over, the state is empty and the next runs still start from the cursor: no stop is
+            # finalized twice
+            fetched_until[0] = start + 26 * 3600
+            lambda_handler({**event, 'mode': 'intraday', 'date': '20231114'}, None)
+            self.assertTrue(output_files['2023/11/14/intraday_state_2023-11-14.parquet'].is_empty())
+            result = lambda_handler({**event, 'mode': 'intraday', 'date': '20231114'}, None)
+            self.assertEqual(result['stops'], {'2023-11-14': 0})
+
+            expected_df = pl.read_parquet(os.path.join(TEST_FILES, 'data_stops_2023-11-14.parquet'))
+            intraday_keys = [key for key in output_files if key.startswith('2023/11/14/intraday/')]
+            self.assertIn('2023/11/14/intraday_state_2023-11-14.parquet', output_files)
+            intraday_df = pl.concat([output_files[key] for key in intraday_keys])
+            self.assertEqual(intraday_df.schema, expected_df.schema)
+            # Each stop is finalized once, with the offsets of the daily analysis. The first position of the day is
+            # the only one the daily analysis can't compare to a previous one.
+            sort_columns = ['trip_id', 'stop_sequence']
+            first_stop = (pl.col('trip_id') == expected_df['trip_id'][0]) & (pl.col('stop_sequence') == 1)
+            self.assertTrue(intraday_df.filter(~first_stop).sort(sort_columns).equals(
+                expected_df.filter(~first_stop).sort(sort_columns)))
+
+            # The nightly analysis replaces the intraday stops, and deletes the state and the cursor
+            lambda_handler({**event, 'mode': 'reconcile', 'date': '20231116'}, None)
+            reconciled_keys = [key for key in output_files if key.startswith('2023/11/14/intraday')]
+            self.assertTrue(all(key.endswith('/data_stops_daily.parquet') for key in reconciled_keys))
+            reconciled_df = pl.concat([output_files[key] for key in reconciled_keys])
+            self.assertTrue(reconciled_df.sort(sort_columns).equals(expected_df.sort(sort_columns)))
+            self.assertIn('2023/11/14/data_stops_2023-11-14.parquet', output_files)
+
+    @patch('STM_Services.STM_Analyse_Daily_Stops_Data.main.upload_file_from_tmp')
+    def test_write_intraday_partitions_local_hours(self, mock_upload):
+        # St. John's is 3h30 behind UTC: 10:15 and 10:45 local time are in two different UTC hours
+        newfoundland = pytz.timezone('America/St_Johns')
+        arrivals = [int(newfoundland.localize(datetime(2023, 11, 14, 10, minute)).timestamp()) for minute in [15, 45]]
+        df_stops = pl.DataFrame({'trip_id': [1, 1], 'arrival_time_unix': arrivals})
+
+        keys = write_intraday_partitions(df_stops, 'output-bucket', newfoundland.localize(datetime(2023, 11, 14)),
+                                         'daily', 'America/St_Johns')
+
+        hour_start_unix = int(newfoundland.localize(datetime(2023, 11, 14, 10)).timestamp())
+        self.assertEqual(keys, [f'2023/11/14/intraday/{hour_start_unix}/data_stops_daily.parquet'])
+        mock_upload.assert_called_once()
 
     @patch('STM_Services.STM_Analyse_Daily_Stops_Data.main.boto3.client')
     def test_download_file_to_tmp_success(self, mock_boto3_client):
@@ -150,5 +445,42 @@ class TestLambdaFunction(unittest.TestCase):
         # Verify result
         self.assertEqual(actual_unix_timestamps, expected_unix_timestamps)
 
+    def test_adding_arrival_time_unix_from_seconds(self):
+        # The static files store the times in seconds, the output keeps HH:MM:SS
+        df = pl.DataFrame({
+            'arrival_time': [86399, 88200],
+            'trip_id': [1, 2],
+            'stop_id': [101, 102],
+            'stop_sequence': [1, 2]
+        }).cast({'arrival_time': pl.Int32})
+        date_obj = datetime(2023, 12, 1, tzinfo=pytz.timezone('America/Montreal'))
+
+        result_df = adding_arrival_time_unix(df, date_obj)
+
+        self.assertEqual(result_df['arrival_time_unix'].to_list(), [1701493199, 1701495000])
+        self.assertEqual(result_df['arrival_time'].to_list(), ['23:59:59', '24:30:00'])
+    def test_match_stop_times(self):
+        # Positions sorted by trip_id, vehicle_currentStopSequence and timefetch
+        df_vehicle_positions = pl.DataFrame({
+            'trip_id': [1, 1, 1, 2, 3],
+            'vehicle_currentStopSequence': [1, 1, 2, 1, 1],
+            'timefetch': [1000 - 7200, 1000 + 86400, 200 + 7201, 50, 10],
+            'vehicle_timestamp': [1, 2, 3, 4, 5]
+        })
+        df_stops_unix = pl.DataFrame({
+            'trip_id': [1, 1, 2, 2],
+            'arrival_time': ['00:16:40', '00:03:20', '00:00:40', '01:23:20'],
+            'stop_id': [101, 102, 103, 104],
+            'stop_sequence': [1, 2, 1, 2],
+            'arrival_time_unix': [1000, 200, 40, 5000]
+        })
+
+        result_df = match_stop_times(df_vehicle_positions, df_stops_unix)
+
+        # At the tolerance: matched. The next day, past the tolerance or without a stop event: dropped
+        self.assertEqual(result_df['vehicle_timestamp'].to_list(), [1, 4])
+        self.assertEqual(result_df['stop_id'].to_list(), [101, 103])
+        self.assertEqual(result_df['arrival_time_unix'].to_list(), [1000, 40])
+
 if __name__ == '__main__':
     unittest.main()
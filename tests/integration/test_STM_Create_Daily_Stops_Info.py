@@ -5,29 +5,54 @@ import polars as pl
 import pytz
 import tempfile
 import os
-from STM_Services.STM_Create_Daily_Stops_Info.main import lambda_handler, download_file_to_tmp, upload_file_from_tmp, read_parquet_from_tmp, write_df_to_parquet_to_tmp, convert_to_unix
+import shutil
+from unittest.mock import MagicMock
+from STM_Services.STM_Create_Daily_Stops_Info import main
+from STM_Services.STM_Create_Daily_Stops_Info.main import lambda_handler, download_file_to_tmp, upload_file_from_tmp, read_parquet_from_tmp, write_df_to_parquet_to_tmp, gtfs_time_to_unix, DimensionCache
+from STM_Services.STM_Create_Daily_Stops_Info.main import build_daily_stops_info, STOPS_INFO_COLUMNS
+from STM_Services.STM_Analyse_Daily_Stops_Data import main as analyse_main
 
 class TestS3DataProcessing(unittest.TestCase):
+
+    def setUp(self):
+        # Empty dimension cache for each test, the ETag of the static tables does not change
+        self.cache_directory = tempfile.TemporaryDirectory()
+        self.mock_s3 = MagicMock()
+        self.mock_s3.head_object.return_value = {'ETag': '"etag"'}
+        cache = DimensionCache(self.mock_s3, lambda bucket, key: main.load_static_table(bucket, key),
+                               directory=self.cache_directory.name)
+        patcher = patch.object(main, 'dimension_cache', cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.cache_directory.cleanup)
     
+    def write_static_files(self, tables):
+        """
+        Write the tables in Parquet files, and return a stand-in of download_file_to_tmp serving them by key (the
+        key of a table ends with <table>.parquet or <table>_<date>.parquet).
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for table, df in tables.items():
+            df.write_parquet(os.path.join(directory.name, f'{table}.parquet'))
+
+        def download_file_to_tmp(bucket, key):
+            table = next(table for table in tables if os.path.basename(key).startswith(table))
+            local_path = os.path.join(directory.name, f'download_{table}.parquet')
+            shutil.copy(os.path.join(directory.name, f'{table}.parquet'), local_path)
+            return local_path
+        return download_file_to_tmp
+
+    @patch('STM_Services.STM_Create_Daily_Stops_Info.main.load_feed_index', return_value=[])
     @patch('STM_Services.STM_Create_Daily_Stops_Info.main.upload_file_from_tmp')
     @patch('STM_Services.STM_Create_Daily_Stops_Info.main.download_file_to_tmp')
-    @patch('STM_Services.STM_Create_Daily_Stops_Info.main.pl.read_parquet')
-    @patch('STM_Services.STM_Create_Daily_Stops_Info.main.pl.DataFrame.write_parquet')
-    def test_lambda_handler_success(self, mock_write_parquet, mock_read_parquet, mock_download, mock_upload):
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file_1, \
-             tempfile.NamedTemporaryFile(delete=False) as temp_file_2, \
-             tempfile.NamedTemporaryFile(delete=False) as temp_file_3, \
-             tempfile.NamedTemporaryFile(delete=False) as temp_file_4:
-            mock_download.side_effect = [temp_file_1.name, temp_file_2.name, temp_file_3.name, temp_file_4.name]
-        
-        # Mocking read_parquet to return dataframes
-        mock_stops_df = pl.DataFrame({'stop_id': ['1'], 'stop_name': ['Stop A'], 'stop_lat': [40.7128], 'stop_lon': [-74.0060], 'wheelchair_boarding': [1]})
-        mock_trips_df = pl.DataFrame({ 'trip_id': ['1'],'route_id': ['101'],'trip_headsign': ['North'], 'direction_id': [0],'shape_id': ['1'],'wheelchair_accessible': [1]})
-        mock_stop_times_df = pl.DataFrame({'trip_id': ['1'], 'arrival_time': ['12:00:00'], 'stop_id': ['1']})
-        mock_routes_df = pl.DataFrame({'route_id': ['101'], 'route_long_name': ['Route 101']})
-        
-        mock_read_parquet.side_effect = [mock_stops_df, mock_trips_df, mock_stop_times_df, mock_routes_df]
-        mock_write_parquet.return_value = None
+    def test_lambda_handler_success(self, mock_download, mock_upload, mock_feed_index):
+        mock_download.side_effect = self.write_static_files({
+            'stops': pl.DataFrame({'stop_id': ['1'], 'stop_name': ['Stop A'], 'stop_lat': [40.7128], 'stop_lon': [-74.0060], 'wheelchair_boarding': [1]}),
+            'filtered_trips': pl.DataFrame({'trip_id': ['1'], 'route_id': ['101'], 'trip_headsign': ['North'], 'direction_id': [0], 'shape_id': ['1'], 'wheelchair_accessible': [1]}),
+            'filtered_stop_times': pl.DataFrame({'trip_id': ['1'], 'arrival_time': ['12:00:00'], 'stop_id': ['1']}),
+            'routes': pl.DataFrame({'route_id': ['101'], 'route_long_name': ['Route 101']}),
+        })
 
         event = {
             'static_bucket': 'my-static-bucket',
@@ -41,8 +66,66 @@ class TestS3DataProcessing(unittest.TestCase):
 
         # Assertions to ensure the mocked functions were called as expected
         mock_download.assert_called()
-        mock_upload.assert_called()
-        mock_write_parquet.assert_called_once()
+        mock_upload.assert_called_once()
+        output_df = pl.read_parquet(mock_upload.call_args.args[2])
+        self.assertEqual(output_df.row(0, named=True)['route_info'], '101 Route 101 dir. h')
+        self.assertEqual(output_df['arrival_time_unix'].to_list(),
+                         [int(pytz.timezone('America/Montreal').localize(datetime(2023, 4, 1, 12)).timestamp())])
+        # Without a feed index, the static tables are read at their key before the versions
+        self.assertEqual(mock_download.call_args_list[0].args, ('my-static-bucket', 'stops/stops.parquet'))
+
+    @patch('STM_Services.STM_Create_Daily_Stops_Info.main.load_feed_index')
+    @patch('STM_Services.STM_Create_Daily_Stops_Info.main.upload_file_from_tmp')
+    @patch('STM_Services.STM_Create_Daily_Stops_Info.main.download_file_to_tmp')
+    def test_lambda_handler_feed_version(self, mock_download, mock_upload, mock_feed_index):
+        mock_feed_index.return_value = [
+            {'version': 'a', 'published': '20230301', 'start_date': '20230301', 'end_date': '20230430',
+             'tables': {'stops': 'tables/stops/1/stops.parquet', 'routes': 'tables/routes/1/routes.parquet'}},
+            {'version': 'b', 'published': '20230410', 'start_date': '20230410', 'end_date': '20230630',
+             'tables': {'stops': 'tables/stops/2/stops.parquet', 'routes': 'tables/routes/1/routes.parquet'}},
+        ]
+        # Dtypes of the static files
+        mock_download.side_effect = self.write_static_files({
+            'stops': pl.DataFrame({'stop_id': ['1'], 'stop_name': ['Stop A'], 'stop_lat': [40.7128],
+                                   'stop_lon': [-74.0060], 'wheelchair_boarding': [1]}).cast({'stop_id': pl.Categorical}),
+            'filtered_trips': pl.DataFrame({'trip_id': [1], 'route_id': [101], 'trip_headsign': ['Nord N'],
+                                            'direction_id': [0], 'shape_id': [1], 'wheelchair_accessible': [1]}
+                                           ).cast({'trip_headsign': pl.Categorical}),
+            'filtered_stop_times': pl.DataFrame({'trip_id': [1], 'arrival_time': [43200], 'stop_id': [1]}
+                                                ).cast({'arrival_time': pl.Int32}),
+            'routes': pl.DataFrame({'route_id': [101], 'route_long_name': ['Route 101']}),
+        })
+
+        lambda_handler({'static_bucket': 'my-static-bucket', 'daily_static_bucket': 'my-daily-static-bucket',
+                        'output_bucket': 'my-output-bucket', 'date': '20230401'}, None)
+
+        # The version published after the day does not apply to it
+        keys = [call.args[1] for call in mock_download.call_args_list]
+        self.assertEqual(keys[0], 'tables/stops/1/stops.parquet')
+        self.assertEqual(keys[3], 'tables/routes/1/routes.parquet')
+        output_df = pl.read_parquet(mock_upload.call_args.args[2])
+        self.assertEqual(output_df.select('route_info', 'stop_id', 'stop_name').row(0),
+                         ('101 Route 101 dir. NORD', '1', 'Stop A'))
+
+    def test_build_daily_stops_info(self):
+        stop_times_df = pl.DataFrame({'trip_id': [1, 1, 2, 3], 'arrival_time': [3600, 3700, None, 3600],
+                                      'stop_id': [10, 11, 10, 12]}).cast({'arrival_time': pl.Int32})
+        trips_df = pl.DataFrame({'trip_id': [1, 2, 3], 'route_id': [5, 5, 6],
+                                 'trip_headsign': ['Station Papineau / N', 'Station Papineau / N', 'Ouest X'],
+                                 'direction_id': [0, 0, 1], 'shape_id': [7, 7, 8], 'wheelchair_accessible': [1, 1, 2]})
+        stops_df = pl.DataFrame({'stop_id': ['10', '11'], 'stop_name': ['A', 'B'], 'stop_lat': [1.0, 2.0],
+                                 'stop_lon': [3.0, 4.0], 'wheelchair_boarding': [1, 2]})
+        routes_df = pl.DataFrame({'route_id': [5, 6], 'route_long_name': ['Papineau', 'Sherbrooke']})
+
+        result = build_daily_stops_info(stop_times_df.lazy(), trips_df.lazy(), stops_df.lazy(), routes_df.lazy(),
+                                        datetime(2023, 11, 14), 'America/Montreal').collect(streaming=True)
+
+        result = result.sort(['trip_id', 'stop_id'])
+        self.assertEqual(result.columns, STOPS_INFO_COLUMNS)
+        # A direction letter not in the mapping is kept
+        self.assertEqual(result['route_info'].to_list(), ['5 Papineau dir. NORD'] * 3 + ['6 Sherbrooke dir. X'])
+        self.assertEqual(result['stop_name'].to_list(), ['A', 'B', 'A', None])
+        self.assertEqual(result['arrival_time_unix'].to_list(), [1699941600, 1699941700, None, 1699941600])
 
     @patch('STM_Services.STM_Create_Daily_Stops_Info.main.s3_client.download_file')
     def test_download_file_to_tmp(self, mock_download_file):
@@ -65,14 +148,110 @@ class TestS3DataProcessing(unittest.TestCase):
         upload_file_from_tmp(bucket, key, local_path)
         mock_upload_file.assert_called_with(Filename=local_path, Bucket=bucket, Key=key)
     
-    def test_convert_to_unix(self):
-        time_str = '24:00:00'
-        base_date = datetime(2023, 1, 1, tzinfo=pytz.timezone('America/Montreal'))
-        timezone_str = 'America/Montreal'
-        result = convert_to_unix(time_str, base_date, timezone_str)
-        
-        expected = int(pytz.timezone(timezone_str).localize(datetime(2023, 1, 2)).timestamp())
-        self.assertEqual(result, expected)
+    def test_gtfs_time_to_unix(self):
+        eastern = pytz.timezone('America/Montreal')
+        df = pl.DataFrame({'arrival_time': ['24:00:00', '08:15:30', '5:00:00', None]})
+
+        result = df.select(gtfs_time_to_unix('arrival_time', datetime(2023, 1, 1), 'America/Montreal'))
+
+        expected = [int(eastern.localize(datetime(2023, 1, 2)).timestamp()),
+                    int(eastern.localize(datetime(2023, 1, 1, 8, 15, 30)).timestamp()),
+                    int(eastern.localize(datetime(2023, 1, 1, 5)).timestamp()),
+                    None]
+        self.assertEqual(result.to_series().to_list(), expected)
+
+    def test_gtfs_time_to_unix_on_dst_days(self):
+        eastern = pytz.timezone('America/Montreal')
+        df = pl.DataFrame({'arrival_time': ['00:30:00', '02:30:00', '12:00:00', '25:10:00']})
+
+        for service_date in [datetime(2024, 3, 10), datetime(2023, 11, 5)]:
+            result = df.select(gtfs_time_to_unix('arrival_time', service_date, 'America/Montreal')).to_series()
+
+            # The times are measured from noon minus 12h, a time that is missing (02:30 in March) or ambiguous
+            # (in November) on the wall clock still has one UNIX value
+            reference = int(eastern.localize(service_date.replace(hour=12)).timestamp()) - 12 * 3600
+            self.assertEqual(result.to_list(), [reference + 1800, reference + 9000, reference + 43200,
+                                                reference + 90600])
+            self.assertEqual(result[2], int(eastern.localize(service_date.replace(hour=12)).timestamp()))
+
+    def test_gtfs_time_to_unix_from_seconds(self):
+        # Times stored in seconds by STM_Fetch_Update_GTFS_Static_files give the same UNIX times as HH:MM:SS
+        df = pl.DataFrame({'arrival_time': ['24:00:00', '08:15:30', None],
+                           'arrival_seconds': [86400, 29730, None]}).cast({'arrival_seconds': pl.Int32})
+
+        result = df.select(
+            gtfs_time_to_unix('arrival_time', datetime(2024, 3, 10), 'America/Montreal').alias('arrival_time'),
+            gtfs_time_to_unix('arrival_seconds', datetime(2024, 3, 10), 'America/Montreal',
+                              pl.Int32).alias('arrival_seconds'))
+
+        self.assertEqual(result['arrival_seconds'].to_list(), result['arrival_time'].to_list())
+
+    def test_gtfs_time_to_unix_same_as_analyse_copy(self):
+        # The copy in STM_Analyse_Daily_Stops_Data gives the same UNIX times, past 24:00:00 and on the DST days
+        df = pl.DataFrame({'arrival_time': ['00:30:00', '01:30:00', '02:30:00', '12:00:00', '23:59:59', '24:00:00',
+                                            '25:10:00', '26:30:00', '27:45:15', None],
+                           'arrival_seconds': [1800, 5400, 9000, 43200, 86399, 86400, 90600, 95400, 99915,
+                                               None]}).cast({'arrival_seconds': pl.Int32})
+
+        for service_date in [datetime(2024, 3, 9), datetime(2024, 3, 10), datetime(2024, 3, 11),
+                             datetime(2023, 11, 4), datetime(2023, 11, 5), datetime(2023, 11, 6)]:
+            for column, dtype in [('arrival_time', pl.Utf8), ('arrival_seconds', pl.Int32)]:
+                with self.subTest(service_date=service_date.date(), dtype=dtype):
+                    result = df.select(
+                        gtfs_time_to_unix(column, service_date, 'America/Montreal', dtype).alias('create'),
+                        analyse_main.gtfs_time_to_unix(column, service_date, 'America/Montreal',
+                                                       dtype).alias('analyse'))
+
+                    self.assertEqual(result['analyse'].to_list(), result['create'].to_list())
+                    self.assertEqual(result['create'].null_count(), 1)
+
+class TestDimensionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.mock_s3 = MagicMock()
+        self.mock_s3.head_object.return_value = {'ETag': '"1"'}
+        self.loaded = []
+
+    def load(self, bucket, key):
+        self.loaded.append(key)
+        return pl.DataFrame({'stop_id': ['1', '2'], 'version': [len(self.loaded)] * 2}).with_columns(
+            pl.col('stop_id').cast(pl.Categorical))
+
+    def test_mutable_key(self):
+        cache = DimensionCache(self.mock_s3, self.load, directory=self.directory.name)
+
+        first = cache.get('static', 'stops/stops.parquet')
+        self.assertTrue(cache.get('static', 'stops/stops.parquet').equals(first))
+        self.assertEqual(first.schema['stop_id'], pl.Categorical)
+        self.assertEqual(self.loaded, ['stops/stops.parquet'])
+
+        # A new ETag is a new table, its previous file is removed
+        self.mock_s3.head_object.return_value = {'ETag': '"2"'}
+        self.assertEqual(cache.get('static', 'stops/stops.parquet')['version'].to_list(), [2, 2])
+        self.assertEqual(len(os.listdir(self.directory.name)), 1)
+        self.assertEqual(cache.metrics, {'memory_hits': 1, 'disk_hits': 0, 'misses': 2, 'head_requests': 3})
+
+    def test_immutable_key(self):
+        cache = DimensionCache(self.mock_s3, self.load, directory=self.directory.name, max_tables=1)
+
+        cache.get('static', 'tables/stops/a/stops.parquet', immutable=True)
+        cache.get('static', 'tables/stops/a/stops.parquet', immutable=True)
+        self.mock_s3.head_object.assert_not_called()
+
+        # Over max_tables, the least recently used table is removed
+        cache.get('static', 'tables/stops/b/stops.parquet', immutable=True)
+        cache.get('static', 'tables/stops/a/stops.parquet', immutable=True)
+        self.assertEqual(self.loaded, ['tables/stops/a/stops.parquet', 'tables/stops/b/stops.parquet',
+                                       'tables/stops/a/stops.parquet'])
+        self.assertEqual(len(os.listdir(self.directory.name)), 1)
+
+        # A new instance in the same container reads the file left in /tmp
+        cache = DimensionCache(self.mock_s3, self.load, directory=self.directory.name)
+        self.assertEqual(cache.get('static', 'tables/stops/a/stops.parquet', immutable=True)['version'].to_list(),
+                         [3, 3])
+        self.assertEqual(cache.metrics, {'memory_hits': 0, 'disk_hits': 1, 'misses': 0, 'head_requests': 0})
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,22 +1,23 @@
 import unittest
+import polars as pl
 from unittest.mock import patch, MagicMock
-from STM_Services.STM_Fetch_GTFS_TripUpdates.main import lambda_handler  # Adjust this import according to your module's structure
+from google.transit import gtfs_realtime_pb2
+from STM_Services.STM_Fetch_GTFS_TripUpdates.main import lambda_handler, decode_trip_updates, snapshot_stats, TRIP_UPDATES_SCHEMA  # Adjust this import according to your module's structure
 
 class TestLambdaHandler(unittest.TestCase):
 
+    @patch.dict('STM_Services.STM_Fetch_GTFS_TripUpdates.main.last_snapshot', {'etag': None, 'last_modified': None, 'feed_timestamp': None, 'digest': None})
     @patch('STM_Services.STM_Fetch_GTFS_TripUpdates.main.os.environ.get')
-    @patch('STM_Services.STM_Fetch_GTFS_TripUpdates.main.urlopen')
+    @patch('STM_Services.STM_Fetch_GTFS_TripUpdates.main.http')
     @patch('STM_Services.STM_Fetch_GTFS_TripUpdates.main.s3')
-    @patch('STM_Services.STM_Fetch_GTFS_TripUpdates.main.os.remove')
-    @patch('STM_Services.STM_Fetch_GTFS_TripUpdates.main.pd.DataFrame.to_parquet')
-    def test_lambda_handler(self, mock_to_parquet, mock_remove, mock_s3, mock_urlopen, mock_get_env):
-        mock_get_env.side_effect = lambda k: {'API_URL_STM_TRIP': 'https://api_url', 'API_KEY_STM': 'api_key'}.get(k)
+    @patch('STM_Services.STM_Fetch_GTFS_TripUpdates.main.pl.DataFrame.write_parquet')
+    def test_lambda_handler(self, mock_to_parquet, mock_s3, mock_http, mock_get_env):
+        mock_get_env.side_effect = lambda k, default=None: {'API_URL_STM_TRIP': 'https://api_url', 'API_KEY_STM': 'api_key'}.get(k, default)
 
-        mock_response = MagicMock()
-        mock_response.read.return_value = b'' 
-        mock_urlopen.return_value = mock_response
+        mock_response = MagicMock(status=200, data=b'', headers={})
+        mock_http.request.return_value = mock_response
 
-        mock_s3.upload_file.return_value = None
+        mock_s3.put_object.return_value = None
 
         event = {
             'bucket_name': 'test-bucket'
@@ -25,10 +26,64 @@ class TestLambdaHandler(unittest.TestCase):
         lambda_handler(event, None)
 
         #Check if everything has been called
-        mock_urlopen.assert_called()  
+        mock_http.request.assert_called()  
         mock_to_parquet.assert_called_once()  
-        mock_s3.upload_file.assert_called_once()  
-        mock_remove.assert_called_once() 
+        mock_s3.put_object.assert_called_once()
+        _, kwargs = mock_s3.put_object.call_args
+        self.assertIn('ChecksumSHA256', kwargs)
+
+    @patch.dict('STM_Services.STM_Fetch_GTFS_TripUpdates.main.last_snapshot', {'etag': '"abc"', 'last_modified': None, 'feed_timestamp': None, 'digest': None})
+    @patch.dict('STM_Services.STM_Fetch_GTFS_TripUpdates.main.snapshot_stats', {'fetched': 0, 'skipped': 0})
+    @patch('STM_Services.STM_Fetch_GTFS_TripUpdates.main.http')
+    @patch('STM_Services.STM_Fetch_GTFS_TripUpdates.main.s3')
+    def test_lambda_handler_not_modified_and_error(self, mock_s3, mock_http):
+        mock_http.request.side_effect = [MagicMock(status=304, data=b'', headers={}),
+                                         MagicMock(status=500, data=b'', headers={})]
+
+        response = lambda_handler({'bucket_name': 'test-bucket'}, None)
+        self.assertTrue(response['skipped'])
+        self.assertEqual(response['skip_rate'], 1.0)
+
+        # A failed request is a fetch, not a skip, and nothing is stored
+        self.assertIsNone(lambda_handler({'bucket_name': 'test-bucket'}, None))
+        self.assertEqual(snapshot_stats, {'fetched': 2, 'skipped': 1})
+        mock_s3.put_object.assert_not_called()
+
+    def test_decode_trip_updates(self):
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = '2.0'
+
+        entity = feed.entity.add()
+        entity.id = '1'
+        entity.trip_update.trip.trip_id = '256789'
+        entity.trip_update.trip.route_id = '51'
+        entity.trip_update.timestamp = 1700000000
+        stop_time_update = entity.trip_update.stop_time_update.add()
+        stop_time_update.stop_sequence = 1
+        stop_time_update.stop_id = '52345'
+        stop_time_update.arrival.time = 1700000100
+        stop_time_update = entity.trip_update.stop_time_update.add()
+        stop_time_update.stop_sequence = 2
+        stop_time_update.stop_id = '52346'
+        stop_time_update.departure.time = 1700000200
+
+        # Canceled trip without stop_time_update
+        entity = feed.entity.add()
+        entity.id = '2'
+        entity.trip_update.trip.trip_id = '256788'
+        entity.trip_update.trip.schedule_relationship = gtfs_realtime_pb2.TripDescriptor.CANCELED
+
+        df = decode_trip_updates(feed, 1700000050)
+
+        self.assertEqual(df.schema, TRIP_UPDATES_SCHEMA)
+        self.assertEqual(df['trip_id'].to_list(), ['256788', '256789', '256789'])
+        self.assertEqual(df['stop_sequence'].to_list(), [None, 1, 2])
+        self.assertEqual(df['stop_id'].cast(pl.Utf8).to_list(), [None, '52345', '52346'])
+        self.assertEqual(df['arrival_time'].to_list(), [None, 1700000100, None])
+        self.assertEqual(df['departure_time'].to_list(), [None, None, 1700000200])
+        self.assertEqual(df['trip_schedule_relationship'].cast(pl.Utf8).to_list(), ['CANCELED', None, None])
+        self.assertEqual(df['timestamp'].to_list(), [None, 1700000000, 1700000000])
+        self.assertEqual(df['timefetch'].to_list(), [1700000050] * 3)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,38 +1,173 @@
+import io
 import unittest
-from unittest.mock import patch, MagicMock, mock_open
-from STM_Services.STM_Fetch_GTFS_VehiclePositions.main import lambda_handler
+import polars as pl
+import pyarrow.parquet as pq
+from unittest.mock import patch, MagicMock
+from STM_Services.STM_Fetch_GTFS_VehiclePositions.main import (lambda_handler, decode_vehicle_positions, VEHICLE_POSITIONS_SCHEMA,
+                                                         VEHICLE_POSITIONS_SCHEMA_VERSION, MICRO_BATCH_SCHEMA_VERSION)
 from google.transit import gtfs_realtime_pb2
 from datetime import datetime 
 
+EMPTY_SNAPSHOT = {'etag': None, 'last_modified': None, 'feed_timestamp': None, 'digest': None}
+
+
 class TestLambdaHandler(unittest.TestCase):
 
+    @patch.dict('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.last_snapshot', EMPTY_SNAPSHOT)
     @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.os.environ.get')
-    @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.urlopen')
+    @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.http')
     @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.s3')
-    @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.os.remove')
-    @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.pd.DataFrame.to_parquet')
-    @patch('builtins.open', new_callable=mock_open)
-    def test_lambda_handler(self, mock_file_open, mock_to_parquet, mock_remove, mock_s3, mock_urlopen, mock_get_env):
-        mock_get_env.side_effect = lambda k: {'API_URL_STM_VEHICLE': 'https://api_url', 'API_KEY_STM': 'api_key'}.get(k)
+    @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.pl.DataFrame.write_parquet')
+    def test_lambda_handler(self, mock_to_parquet, mock_s3, mock_http, mock_get_env):
+        mock_get_env.side_effect = lambda k, default=None: {'API_URL_STM_VEHICLE': 'https://api_url', 'API_KEY_STM': 'api_key'}.get(k, default)
         
         feed = gtfs_realtime_pb2.FeedMessage()
         feed.header.gtfs_realtime_version = '2.0'
         feed.header.incrementality = feed.header.DIFFERENTIAL
         feed.header.timestamp = int(datetime.now().timestamp())
 
-        mock_response = MagicMock()
-        mock_response.read.return_value = feed.SerializeToString()
-        mock_urlopen.return_value = mock_response
+        mock_response = MagicMock(status=200, data=feed.SerializeToString(), headers={'ETag': '"abc"'})
+        mock_http.request.return_value = mock_response
 
-        mock_s3.upload_file.return_value = None
+        mock_s3.put_object.return_value = None
 
         lambda_handler({'bucket_name': 'test-bucket'}, None)
 
         # Assertions to ensure that the mocks were called as expected
-        mock_urlopen.assert_called()  
+        mock_http.request.assert_called()  
         mock_to_parquet.assert_called_once()
-        mock_s3.upload_file.assert_called_once()  
-        mock_remove.assert_called_once()
+        mock_s3.put_object.assert_called_once()
+        _, kwargs = mock_s3.put_object.call_args
+        self.assertEqual(kwargs['Key'].split('.')[-1], 'parquet')
+        # The version of the schema in the registry of the merge is part of the file name
+        self.assertTrue(kwargs['Key'].endswith(f'.v{VEHICLE_POSITIONS_SCHEMA_VERSION}.parquet'))
+        self.assertIn('ChecksumSHA256', kwargs)
+
+    @patch.dict('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.last_snapshot', EMPTY_SNAPSHOT)
+    @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.os.environ.get')
+    @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.http')
+    @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.s3')
+    @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.pl.DataFrame.write_parquet')
+    def test_lambda_handler_skips_unchanged_snapshot(self, mock_to_parquet, mock_s3, mock_http, mock_get_env):
+        mock_get_env.side_effect = lambda k, default=None: {'API_URL_STM_VEHICLE': 'https://api_url', 'API_KEY_STM': 'api_key'}.get(k, default)
+
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = '2.0'
+        feed.header.timestamp = 1700000000
+        mock_http.request.return_value = MagicMock(status=200, data=feed.SerializeToString(),
+                                                   headers={'ETag': '"abc"'})
+
+        first = lambda_handler({'bucket_name': 'test-bucket'}, None)
+        second = lambda_handler({'bucket_name': 'test-bucket', 'duplicate_policy': 'marker'}, None)
+
+        self.assertFalse(first['skipped'])
+        self.assertTrue(second['skipped'])
+        self.assertGreater(second['skip_rate'], 0)
+        self.assertEqual(mock_s3.put_object.call_count, 2)
+        self.assertTrue(mock_s3.put_object.call_args_list[0][1]['Key'].endswith('.parquet'))
+
+        # The second request is conditional on the ETag of the stored snapshot
+        _, kwargs = mock_http.request.call_args
+        self.assertEqual(kwargs['headers']['If-None-Match'], '"abc"')
+
+        # The skipped snapshot is recorded as a zero-byte marker
+        _, kwargs = mock_s3.put_object.call_args
+        self.assertTrue(kwargs['Key'].endswith('.duplicate'))
+        self.assertEqual(kwargs['Body'], b'')
+        self.assertEqual(kwargs['Metadata']['feed-timestamp'], '1700000000')
+
+    @patch.dict('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.last_snapshot', dict(EMPTY_SNAPSHOT, etag='"abc"'))
+    @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.http')
+    @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.s3')
+    def test_lambda_handler_not_modified(self, mock_s3, mock_http):
+        mock_http.request.return_value = MagicMock(status=304, data=b'', headers={})
+
+        response = lambda_handler({'bucket_name': 'test-bucket'}, None)
+
+        self.assertTrue(response['skipped'])
+        mock_s3.put_object.assert_not_called()
+
+    @patch.dict('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.last_snapshot', EMPTY_SNAPSHOT)
+    @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.time.sleep')
+    @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.http')
+    @patch('STM_Services.STM_Fetch_GTFS_VehiclePositions.main.s3')
+    def test_lambda_handler_micro_batch(self, mock_s3, mock_http, mock_sleep):
+        responses = []
+        for timestamp in [1700000000, 1700000015, 1700000015, 1700000045]:
+            feed = gtfs_realtime_pb2.FeedMessage()
+            feed.header.gtfs_realtime_version = '2.0'
+            feed.header.timestamp = timestamp
+            entity = feed.entity.add()
+            entity.id = '1'
+            entity.vehicle.timestamp = timestamp
+            responses.append(MagicMock(status=200, data=feed.SerializeToString(), headers={}))
+        mock_http.request.side_effect = responses
+
+        uploaded = {}
+
+        def read_uploaded_file(Bucket, Key, Body, ChecksumSHA256, Metadata):
+            uploaded['key'] = Key
+            uploaded['file'] = pq.ParquetFile(io.BytesIO(Body))
+            uploaded['df'] = pl.read_parquet(io.BytesIO(Body))
+
+        mock_s3.put_object.side_effect = read_uploaded_file
+
+        response = lambda_handler({'bucket_name': 'test-bucket', 'poll_interval': 15, 'poll_window': 60}, None)
+
+        # 4 polls, the third one is the same snapshot as the second one
+        self.assertFalse(response['skipped'])
+        self.assertEqual(mock_http.request.call_count, 4)
+        mock_s3.put_object.assert_called_once()
+        self.assertEqual(uploaded['file'].num_row_groups, 3)
+        self.assertTrue(uploaded['key'].endswith(f'.v{MICRO_BATCH_SCHEMA_VERSION}.parquet'))
+        self.assertEqual(uploaded['df']['vehicle_timestamp'].to_list(), [1700000000, 1700000015, 1700000045])
+        self.assertIn('timefetch', uploaded['df'].columns)
+        self.assertEqual(uploaded['df'].columns, sorted(uploaded['df'].columns))
+
+    def test_decode_vehicle_positions(self):
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = '2.0'
+
+        entity = feed.entity.add()
+        entity.id = '1'
+        entity.vehicle.trip.trip_id = '256789'
+        entity.vehicle.trip.route_id = '51'
+        entity.vehicle.position.latitude = 45.5
+        entity.vehicle.position.longitude = -73.5
+        entity.vehicle.current_stop_sequence = 7
+        entity.vehicle.current_status = gtfs_realtime_pb2.VehiclePosition.STOPPED_AT
+        entity.vehicle.timestamp = 1700000000
+        entity.vehicle.vehicle.id = '40123'
+        entity.vehicle.occupancy_status = gtfs_realtime_pb2.VehiclePosition.MANY_SEATS_AVAILABLE
+
+        # Entity without position nor status, those columns must stay null
+        entity = feed.entity.add()
+        entity.id = '2'
+        entity.vehicle.trip.trip_id = '256790'
+
+        # Entity that is not a vehicle position is ignored
+        entity = feed.entity.add()
+        entity.id = '3'
+        entity.trip_update.trip.trip_id = '256791'
+
+        df = decode_vehicle_positions(feed)
+
+        self.assertEqual(df.schema, VEHICLE_POSITIONS_SCHEMA)
+        self.assertEqual(df.columns, sorted(df.columns))
+        self.assertEqual(df['id'].to_list(), ['1', '2'])
+        self.assertEqual(df['vehicle_trip_tripId'].to_list(), ['256789', '256790'])
+        self.assertEqual(df['vehicle_timestamp'].to_list(), [1700000000, None])
+        self.assertEqual(df['vehicle_currentStopSequence'].to_list(), [7, None])
+        self.assertEqual(df['vehicle_currentStatus'].to_list(), ['STOPPED_AT', None])
+        self.assertEqual(df['vehicle_occupancyStatus'].to_list(), ['MANY_SEATS_AVAILABLE', None])
+        self.assertEqual(df['vehicle_position_latitude'].to_list(), [45.5, None])
+
+    def test_decode_vehicle_positions_empty_feed(self):
+        df = decode_vehicle_positions(gtfs_realtime_pb2.FeedMessage())
+
+        self.assertEqual(df.height, 0)
+        self.assertEqual(df.schema, VEHICLE_POSITIONS_SCHEMA)
+        self.assertIsInstance(df, pl.DataFrame)
 
 if __name__ == '__main__':
     unittest.main()
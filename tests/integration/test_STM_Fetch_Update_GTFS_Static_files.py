@@ -2,8 +2,63 @@ from unittest import TestCase, mock
 from unittest.mock import MagicMock, patch
 from io import BytesIO
 import datetime
+import json
 
-from STM_Services.STM_Fetch_Update_GTFS_Static_files.main import lambda_handler
+import zipfile
+
+import polars as pl
+import pyarrow.parquet as pq
+
+from STM_Services.STM_Fetch_Update_GTFS_Static_files.main import lambda_handler, convert_member_to_parquet, \
+    convert_stop_patterns, build_stop_patterns
+
+
+def make_feed(stop_times_trips, dates=()):
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('stop_times.txt', '\ufefftrip_id,arrival_time,departure_time,stop_id,stop_sequence\r\n' + ''.join(
+            f'{trip},{23 + sequence}:59:0{sequence},{23 + sequence}:59:0{sequence},{50000 + sequence},{sequence}\r\n'
+            for trip in stop_times_trips for sequence in range(1, 4)))
+        z.writestr('trips.txt', 'route_id,service_id,trip_id,trip_headsign,note_fr\n'
+                                '10,23N-H50N000S-80-S,261000001,Nord,\n10,23N-H50N000S-81-S,261000002,Sud,Note\n')
+        z.writestr('calendar_dates.txt', 'service_id,date,exception_type\n' + ''.join(
+            f'23N-H50N000S-80-S,{date},1\n' for date in dates))
+    buffer.seek(0)
+    return zipfile.ZipFile(buffer)
+
+
+class FakeS3:
+    class exceptions:
+        NoSuchKey = KeyError
+
+    def __init__(self):
+        self.objects = {}
+        self.aborted = []
+
+    def get_object(self, Bucket, Key):
+        body = self.objects[Key]
+        return {'Body': BytesIO(body.encode() if isinstance(body, str) else body)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = bytes(Body) if not isinstance(Body, str) else Body
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.objects[Key] = b''
+        return {'UploadId': Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self.objects[Key] += Body
+        return {'ETag': f'etag-{PartNumber}'}
+
+    def complete_multipart_upload(self, **kwargs):
+        pass
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(Key)
+        del self.objects[Key]
+
+    def read(self, key):
+        return pl.read_parquet(BytesIO(self.objects[key]))
 
 class TestLambdaHandler(TestCase):
     @patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.requests.get')
@@ -11,9 +66,8 @@ class TestLambdaHandler(TestCase):
     @patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.boto3.client')
     @patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.zipfile.ZipFile')
     @patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.os.remove')
-    @patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.pl.read_csv')
     @patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.datetime.datetime', wraps=datetime.datetime)
-    def test_files_are_the_same(self, mock_datetime, mock_read_csv, mock_remove, mock_zipfile, mock_boto3_client, mock_requests_head, mock_requests_get):    
+    def test_files_are_the_same(self, mock_datetime, mock_remove, mock_zipfile, mock_boto3_client, mock_requests_head, mock_requests_get):    
         mock_s3 = MagicMock()
         mock_boto3_client.return_value = mock_s3
         mock_s3.get_object.side_effect = None
@@ -31,9 +85,6 @@ class TestLambdaHandler(TestCase):
         mock_zipfile.return_value = mock_zipfile_instance
         mock_zipfile_instance.__enter__.return_value.namelist.return_value = ['test.txt']
 
-        df_mock = MagicMock()
-        mock_read_csv.return_value = df_mock
-
         event = {'bucket_name': 'test-bucket', 'url': 'http://example.com/data.zip'}
         lambda_handler(event, None)
 
@@ -53,7 +104,10 @@ class TestLambdaHandler(TestCase):
         mock_boto_client.return_value = s3_mock
         mock_last_modified_in_s3 = MagicMock()
         mock_last_modified_in_s3.read.return_value = b"Wed, 01 Jan 2020 00:00:00 GMT"
-        s3_mock.get_object.return_value = {'Body': mock_last_modified_in_s3}
+        # No feed index yet
+        s3_mock.exceptions.NoSuchKey = KeyError
+        s3_mock.get_object.side_effect = lambda Bucket, Key: {'Body': mock_last_modified_in_s3} \
+            if Key == 'Last_modified.txt' else {}[Key]
         
         mock_response_head = MagicMock()
         mock_response_head.headers = {'Last-Modified': datetime.datetime.now().strftime('%a, %d %b %Y %H:%M:%S GMT')}
@@ -77,5 +131,155 @@ class TestLambdaHandler(TestCase):
         # Verify that the new file was uploaded
         s3_mock.put_object.assert_called()
 
+
+class TestConvertMemberToParquet(TestCase):
+    def test_declared_schema(self):
+        s3 = FakeS3()
+        z = make_feed([261000001, 261000002])
+        for table in ['stop_times', 'trips', 'calendar_dates']:
+            convert_member_to_parquet(s3, 'bucket', f'{table}/{table}.parquet', z, f'{table}.txt', table)
+
+        stop_times_df = s3.read('stop_times/stop_times.parquet')
+        self.assertEqual(dict(stop_times_df.schema), {'trip_id': pl.Int64, 'arrival_time': pl.Int32,
+                                                      'departure_time': pl.Int32, 'stop_id': pl.Int64,
+                                                      'stop_sequence': pl.Int64})
+        # Times in seconds from noon minus 12h, past 24:00:00
+        self.assertEqual(stop_times_df['arrival_time'].to_list()[:3], [89941, 93542, 97143])
+
+        trips_df = s3.read('trips/trips.parquet')
+        self.assertEqual(trips_df.schema['service_id'], pl.Categorical)
+        self.assertEqual(trips_df.schema['trip_headsign'], pl.Categorical)
+        # Not declared: kept as a string
+        self.assertEqual(trips_df['note_fr'].to_list(), [None, 'Note'])
+
+        # Header only: the columns are kept
+        calendar_dates_df = s3.read('calendar_dates/calendar_dates.parquet')
+        self.assertEqual(calendar_dates_df.height, 0)
+        self.assertEqual(calendar_dates_df.schema['date'], pl.Date)
+
+    @patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.MULTIPART_PART_SIZE', 64)
+    @patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.ROW_GROUP_SIZE', 4)
+    @patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.CSV_BLOCK_SIZE', 128)
+    def test_sorted_stop_times_are_streamed(self):
+        s3 = FakeS3()
+        rows = convert_member_to_parquet(s3, 'bucket', 'stop_times/stop_times.parquet',
+                                         make_feed(range(261000001, 261000021)), 'stop_times.txt', 'stop_times')
+
+        self.assertEqual(rows, 60)
+        self.assertEqual(s3.aborted, [])
+        parquet_file = pq.ParquetFile(BytesIO(s3.objects['stop_times/stop_times.parquet']))
+        self.assertEqual(parquet_file.metadata.num_row_groups, 15)
+        self.assertTrue(parquet_file.metadata.row_group(0).column(0).statistics.has_min_max)
+
+    @patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.MULTIPART_PART_SIZE', 64)
+    @patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.ROW_GROUP_SIZE', 4)
+    @patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.CSV_BLOCK_SIZE', 128)
+    def test_unsorted_stop_times_are_sorted(self):
+        s3 = FakeS3()
+        trips = list(range(261000001, 261000021))
+        convert_member_to_parquet(s3, 'bucket', 'stop_times/stop_times.parquet', make_feed(trips[10:] + trips[:10]),
+                                  'stop_times.txt', 'stop_times')
+
+        self.assertEqual(s3.aborted, ['stop_times/stop_times.parquet'])
+        stop_times_df = s3.read('stop_times/stop_times.parquet')
+        self.assertTrue(stop_times_df.equals(stop_times_df.sort(['trip_id', 'stop_sequence'])))
+        self.assertEqual(stop_times_df.height, 60)
+
+
+class TestStopPatterns(TestCase):
+    @patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.CSV_BLOCK_SIZE', 128)
+    def test_stop_patterns(self):
+        s3 = FakeS3()
+        keys = {'stop_patterns': 'stop_patterns.parquet', 'trip_patterns': 'trip_patterns.parquet'}
+        trips = list(range(261000001, 261000021))
+
+        # The trips of the feed share their stops and times: one pattern, whatever the blocks their rows are in
+        self.assertEqual(convert_stop_patterns(s3, 'bucket', keys, make_feed(trips), 'stop_times.txt'), (1, 20))
+        stop_patterns_df = s3.read('stop_patterns.parquet')
+        self.assertEqual(stop_patterns_df['stop_sequence'].to_list(), [1, 2, 3])
+        self.assertEqual(stop_patterns_df['arrival_offset'].to_list(), [0, 3601, 7202])
+        trip_patterns_df = s3.read('trip_patterns.parquet')
+        self.assertEqual(trip_patterns_df['trip_id'].to_list(), trips)
+        self.assertEqual(trip_patterns_df['start_time'].unique().to_list(), [86340 + 3601])
+
+        # An unsorted stop_times gives the same tables
+        convert_stop_patterns(s3, 'bucket', keys, make_feed(trips[10:] + trips[:10]), 'stop_times.txt')
+        self.assertTrue(s3.read('stop_patterns.parquet').equals(stop_patterns_df))
+        self.assertTrue(s3.read('trip_patterns.parquet').equals(trip_patterns_df))
+
+    def test_build_stop_patterns(self):
+        stop_times_df = pl.DataFrame({
+            'trip_id': [1, 1, 2, 2, 3, 3, 4, 4],
+            'stop_sequence': [1, 2, 1, 2, 1, 2, 1, 2],
+            'stop_id': [5, 6, 5, 6, 5, 7, 5, 6],
+            'arrival_time': [100, 200, 300, 400, None, 600, 1000, 1100],
+            'departure_time': [100, 210, 300, 410, 550, 600, 1000, 1110],
+        }).cast({'arrival_time': pl.Int32, 'departure_time': pl.Int32})
+
+        # Trip 2 is split between two DataFrames
+        stop_patterns_df, trip_patterns_df = build_stop_patterns([stop_times_df.slice(0, 3), stop_times_df.slice(3)])
+
+        self.assertEqual(trip_patterns_df.rows(), [(1, 0, 100), (2, 0, 300), (3, 1, 550), (4, 0, 1000)])
+        self.assertEqual(stop_patterns_df.rows(), [(0, 1, 5, 0, 0), (0, 2, 6, 100, 110),
+                                                   (1, 1, 5, None, 0), (1, 2, 7, 50, 50)])
+
+
+class TestLambdaHandlerFeed(TestCase):
+    def run_handler(self, s3, last_modified, feed):
+        feed.fp.seek(0)
+        with patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.boto3.client', return_value=s3), \
+                patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.requests.head') as mock_requests_head, \
+                patch('STM_Services.STM_Fetch_Update_GTFS_Static_files.main.requests.get') as mock_requests_get:
+            mock_requests_head.return_value.headers = {'Last-Modified': last_modified}
+            mock_requests_get.return_value.iter_content.return_value = [feed.fp.read()]
+            lambda_handler({'bucket_name': 'test-bucket', 'url': 'http://example.com/data.zip'}, None)
+        return json.loads(s3.objects['feed_index.json'])['versions']
+
+    def test_feed_is_converted(self):
+        s3 = FakeS3()
+
+        versions = self.run_handler(s3, 'Wed, 21 Oct 2020 07:28:00 GMT', make_feed([261000001], [20201019, 20201115]))
+
+        self.assertEqual(len(versions), 1)
+        version = versions[0]
+        self.assertEqual((version['published'], version['start_date'], version['end_date']),
+                         ('20201021', '20201019', '20201115'))
+        self.assertEqual(sorted(version['tables']), ['calendar_dates', 'stop_patterns', 'stop_times', 'trip_patterns',
+                                                     'trips'])
+        self.assertTrue(all(key.startswith(f'tables/{table}/') and key.endswith(f'/{table}.parquet')
+                            for table, key in version['tables'].items()))
+        self.assertEqual(json.loads(s3.objects[f"feeds/{version['version']}/manifest.json"]), version)
+        self.assertEqual(sorted(s3.objects), sorted(['Last_modified.txt', 'feed_index.json',
+                                                     f"feeds/{version['version']}/manifest.json",
+                                                     *version['tables'].values()]))
+        self.assertEqual(s3.read(version['tables']['trips']).height, 2)
+
+    def test_unchanged_tables_are_kept(self):
+        s3 = FakeS3()
+        first = self.run_handler(s3, 'Wed, 21 Oct 2020 07:28:00 GMT', make_feed([261000001]))[0]
+        uploads = []
+        s3.put_object = MagicMock(side_effect=lambda Bucket, Key, Body, **kwargs: uploads.append(Key) or
+                                  FakeS3.put_object(s3, Bucket, Key, Body))
+        s3.create_multipart_upload = MagicMock(side_effect=lambda Bucket, Key, **kwargs: uploads.append(Key) or
+                                               FakeS3.create_multipart_upload(s3, Bucket, Key))
+
+        # Same feed published again: no table is written and the version does not change
+        versions = self.run_handler(s3, 'Thu, 22 Oct 2020 07:28:00 GMT', make_feed([261000001]))
+        self.assertEqual(versions, [first])
+        self.assertEqual([key for key in uploads if key.startswith('tables/')], [])
+
+        # Only stop_times changed: the other tables of the new version are the ones of the first version
+        versions = self.run_handler(s3, 'Fri, 23 Oct 2020 07:28:00 GMT', make_feed([261000001, 261000002]))
+        self.assertEqual(len(versions), 2)
+        second = versions[1]
+        self.assertEqual([key for key in uploads[1:] if key.startswith('tables/')],
+                         [second['tables'][table] for table in ['stop_times', 'stop_patterns', 'trip_patterns']])
+        self.assertNotEqual(second['tables']['stop_times'], first['tables']['stop_times'])
+        self.assertEqual(second['tables']['trips'], first['tables']['trips'])
+        self.assertEqual(second['tables']['calendar_dates'], first['tables']['calendar_dates'])
+        self.assertEqual(s3.read(first['tables']['stop_times']).height, 3)
+        self.assertEqual(s3.read(second['tables']['stop_times']).height, 6)
+
+
 if __name__ == '__main__':
     TestCase.main()
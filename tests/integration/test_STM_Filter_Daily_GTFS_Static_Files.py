@@ -1,19 +1,30 @@
+import io
 from unittest import TestCase, mock
 from unittest.mock import patch
 import polars as pl
 import pytz
-from datetime import datetime
-from STM_Services.STM_Filter_Daily_GTFS_Static_files.main import lambda_handler
+from botocore.exceptions import ClientError
+from datetime import date, datetime
+import json
+from STM_Services.STM_Filter_Daily_GTFS_Static_files.main import lambda_handler, build_service_index, load_service_index
+from STM_Services.STM_Filter_Daily_GTFS_Static_files.main import resolve_feed_version, expand_stop_patterns
+from STM_Services.STM_Fetch_Update_GTFS_Static_files.main import build_stop_patterns
+
+NO_SUCH_KEY = ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
 
 class TestLambdaHandler(TestCase):
     @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.boto3.client')
     @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.os.remove')
+    @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.pl.scan_parquet')
     @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.pl.read_parquet')
     @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.datetime', wraps=datetime)
+    @patch('polars.LazyFrame.sink_parquet')
     @patch('polars.DataFrame.write_parquet')  
-    def test_lambda_handler(self, mock_write_parquet, mock_datetime, mock_read_parquet, mock_os_remove, mock_boto3_client):    
+    def test_lambda_handler(self, mock_write_parquet, mock_sink_parquet, mock_datetime, mock_read_parquet,
+                            mock_scan_parquet, mock_os_remove, mock_boto3_client):
         mock_s3 = mock.MagicMock()
         mock_boto3_client.return_value = mock_s3
+        mock_s3.get_object.side_effect = NO_SUCH_KEY
 
         eastern = pytz.timezone('America/Montreal')
         test_date = datetime(2023, 1, 1, tzinfo=eastern)
@@ -31,7 +42,9 @@ class TestLambdaHandler(TestCase):
         stop_times_columns = ['trip_id', 'stop_id', 'arrival_time']
         stop_times_data = [['trip_123', 'stop_1', '08:00:00']]
         expected_stop_times_df = pl.DataFrame(stop_times_data, schema=stop_times_columns)
-        mock_read_parquet.side_effect = [expected_calendar_df, expected_trips_df, expected_stop_times_df]
+        calendar_dates_df = pl.DataFrame({'service_id': [2], 'date': [20230101], 'exception_type': [1]})
+        mock_read_parquet.side_effect = [expected_calendar_df, calendar_dates_df, expected_trips_df]
+        mock_scan_parquet.return_value = expected_stop_times_df.lazy()
 
         mock_write_parquet.return_value = None
 
@@ -48,6 +61,216 @@ class TestLambdaHandler(TestCase):
         mock_boto3_client.assert_called_with('s3')
         mock_read_parquet.assert_called()
         mock_write_parquet.assert_called()
+        mock_sink_parquet.assert_called_once_with('/tmp/filtered_stop_times_2023-01-01.parquet')
+        # The service index is stored for the next runs
+        _, kwargs = mock_s3.put_object.call_args
+        self.assertEqual(kwargs['Key'], 'service_index/service_index.parquet')
+
+    @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.boto3.client')
+    @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.os.remove')
+    @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.pl.scan_parquet')
+    @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.pl.read_parquet')
+    @patch('polars.LazyFrame.sink_parquet', autospec=True)
+    @patch('polars.DataFrame.write_parquet', autospec=True)
+    def test_lambda_handler_date_range(self, mock_write_parquet, mock_sink_parquet, mock_read_parquet, mock_scan_parquet,
+                                       mock_os_remove, mock_boto3_client):
+        mock_s3 = mock.MagicMock()
+        mock_boto3_client.return_value = mock_s3
+        # The index of the current version of the feed is already stored
+        service_index_df = pl.DataFrame({'service_id': ['weekday', 'weekday', 'weekend'],
+                                         'date': [date(2023, 11, 16), date(2023, 11, 17), date(2023, 11, 18)]})
+        # The static bucket has no feed index yet: the tables are at <table>/<table>.parquet
+        def get_object(Bucket, Key):
+            if Key == 'feed_index.json':
+                raise NO_SUCH_KEY
+            if Key == 'Last_modified.txt':
+                return {'Body': io.BytesIO(b'Wed, 01 Nov 2023 00:00:00 GMT')}
+            return {'Body': io.BytesIO(b'index'), 'Metadata': {'feed-version': 'Wed, 01 Nov 2023 00:00:00 GMT'}}
+        mock_s3.get_object.side_effect = get_object
+        trips_df = pl.DataFrame({'service_id': ['weekday', 'weekend'], 'trip_id': ['trip_1', 'trip_2']})
+        stop_times_df = pl.DataFrame({'trip_id': ['trip_1', 'trip_1', 'trip_2'], 'stop_sequence': [1, 2, 1],
+                                      'pickup_type': [0, 0, 0]})
+        mock_read_parquet.side_effect = [service_index_df, trips_df]
+        mock_scan_parquet.return_value = stop_times_df.lazy()
+        written = {}
+        mock_write_parquet.side_effect = lambda df, path: written.update({path: df})
+        mock_sink_parquet.side_effect = lambda lf, path: written.update({path: lf.collect()})
+
+        event = {
+            'input_bucket': 'input-bucket',
+            'output_bucket': 'output-bucket',
+            'start_date': '20231116',
+            'end_date': '20231118',
+        }
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        # trips and stop_times are downloaded once for the 3 days, the index is not rebuilt
+        downloaded = [kwargs['Key'] for _, kwargs in mock_s3.download_file.call_args_list]
+        self.assertEqual(downloaded, ['trips/trips.parquet', 'stop_times/stop_times.parquet'])
+        mock_s3.put_object.assert_not_called()
+        uploaded = [kwargs['Key'] for _, kwargs in mock_s3.upload_file.call_args_list]
+        self.assertEqual(len(uploaded), 6)
+        self.assertIn('2023/11/18/filtered_stop_times/filtered_stop_times_2023-11-18.parquet', uploaded)
+        self.assertEqual(written['/tmp/filtered_stop_times_2023-11-17.parquet']['stop_sequence'].to_list(), [1, 2])
+        self.assertEqual(written['/tmp/filtered_stop_times_2023-11-18.parquet']['trip_id'].to_list(), ['trip_2'])
+        # Only the columns used downstream are read
+        self.assertEqual(written['/tmp/filtered_stop_times_2023-11-18.parquet'].columns, ['trip_id', 'stop_sequence'])
+
+    @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.boto3.client')
+    @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.os.remove')
+    @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.pl.scan_parquet')
+    @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.pl.read_parquet')
+    @patch('polars.LazyFrame.sink_parquet', autospec=True)
+    @patch('polars.DataFrame.write_parquet', autospec=True)
+    def test_lambda_handler_feed_versions(self, mock_write_parquet, mock_sink_parquet, mock_read_parquet,
+                                          mock_scan_parquet, mock_os_remove, mock_boto3_client):
+        mock_s3 = mock.MagicMock()
+        mock_boto3_client.return_value = mock_s3
+        # A new version of the feed, published on Nov 17, replaces the trips from Nov 18
+        feed_index = {'versions': [
+            {'version': 'v1', 'published': '20231101', 'start_date': '20231101', 'end_date': '20231130',
+             'tables': {'trips': 'tables/trips/a/trips.parquet', 'stop_times': 'tables/stop_times/b/stop_times.parquet'}},
+            {'version': 'v2', 'published': '20231117', 'start_date': '20231118', 'end_date': '20231231',
+             'tables': {'trips': 'tables/trips/c/trips.parquet', 'stop_times': 'tables/stop_times/b/stop_times.parquet'}},
+        ]}
+        service_index_df = pl.DataFrame({'service_id': ['daily'] * 3,
+                                         'date': [date(2023, 11, 16), date(2023, 11, 17), date(2023, 11, 18)]})
+
+        def get_object(Bucket, Key):
+            if Key == 'feed_index.json':
+                return {'Body': io.BytesIO(json.dumps(feed_index).encode())}
+            version = Key.split('/')[-1].replace('.parquet', '')
+            return {'Body': io.BytesIO(b'index'), 'Metadata': {'feed-version': version}}
+        mock_s3.get_object.side_effect = get_object
+        mock_read_parquet.side_effect = [service_index_df, pl.DataFrame({'service_id': ['daily'], 'trip_id': [1]}),
+                                         service_index_df, pl.DataFrame({'service_id': ['daily'], 'trip_id': [2]})]
+        mock_scan_parquet.return_value = pl.DataFrame({'trip_id': [1, 2], 'stop_sequence': [1, 1]}).lazy()
+        written = {}
+        mock_write_parquet.side_effect = lambda df, path: written.update({path: df})
+        mock_sink_parquet.side_effect = lambda lf, path: written.update({path: lf.collect()})
+
+        lambda_handler({'input_bucket': 'input-bucket', 'output_bucket': 'output-bucket',
+                        'start_date': '20231116', 'end_date': '20231118'}, {})
+
+        # The tables of each version are downloaded once, from their versioned keys
+        downloaded = [kwargs['Key'] for _, kwargs in mock_s3.download_file.call_args_list]
+        self.assertEqual(downloaded, ['tables/trips/a/trips.parquet', 'tables/stop_times/b/stop_times.parquet',
+                                      'tables/trips/c/trips.parquet', 'tables/stop_times/b/stop_times.parquet'])
+        self.assertEqual(written['/tmp/filtered_stop_times_2023-11-17.parquet']['trip_id'].to_list(), [1])
+        self.assertEqual(written['/tmp/filtered_stop_times_2023-11-18.parquet']['trip_id'].to_list(), [2])
+        mock_s3.put_object.assert_not_called()
+
+    @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.boto3.client')
+    @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.os.remove')
+    @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.pl.scan_parquet')
+    @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.pl.read_parquet')
+    @patch('polars.DataFrame.write_parquet', autospec=True)
+    def test_lambda_handler_stop_patterns(self, mock_write_parquet, mock_read_parquet, mock_scan_parquet,
+                                          mock_os_remove, mock_boto3_client):
+        mock_s3 = mock.MagicMock()
+        mock_boto3_client.return_value = mock_s3
+        feed_index = {'versions': [
+            {'version': 'v1', 'published': '20231101', 'start_date': '20231101', 'end_date': '20231130',
+             'tables': {'trips': 'tables/trips/a/trips.parquet', 'stop_times': 'tables/stop_times/b/stop_times.parquet',
+                        'stop_patterns': 'tables/stop_patterns/b/stop_patterns.parquet',
+                        'trip_patterns': 'tables/trip_patterns/b/trip_patterns.parquet'}},
+        ]}
+
+        def get_object(Bucket, Key):
+            if Key == 'feed_index.json':
+                return {'Body': io.BytesIO(json.dumps(feed_index).encode())}
+            return {'Body': io.BytesIO(b'index'), 'Metadata': {'feed-version': 'v1'}}
+        mock_s3.get_object.side_effect = get_object
+        stop_patterns_df = pl.DataFrame({'pattern_id': [0, 0], 'stop_sequence': [1, 2], 'stop_id': [5, 6],
+                                         'arrival_offset': [0, 60], 'departure_offset': [0, 60]})
+        trip_patterns_df = pl.DataFrame({'trip_id': [1, 2], 'pattern_id': [0, 0], 'start_time': [3600, 7200]})
+        mock_read_parquet.side_effect = [
+            pl.DataFrame({'service_id': ['daily'], 'date': [date(2023, 11, 16)]}),
+            pl.DataFrame({'service_id': ['daily', 'weekend'], 'trip_id': [1, 2]}),
+            stop_patterns_df, trip_patterns_df]
+        written = {}
+        mock_write_parquet.side_effect = lambda df, path: written.update({path: df})
+
+        lambda_handler({'input_bucket': 'input-bucket', 'output_bucket': 'output-bucket', 'date': '20231116'}, {})
+
+        # The stop times of the day are expanded from the patterns, stop_times is not downloaded
+        downloaded = [kwargs['Key'] for _, kwargs in mock_s3.download_file.call_args_list]
+        self.assertNotIn('tables/stop_times/b/stop_times.parquet', downloaded)
+        mock_scan_parquet.assert_not_called()
+        self.assertEqual(written['/tmp/filtered_stop_times_2023-11-16.parquet'].rows(),
+                         [(1, 3600, 3600, 5, 1), (1, 3660, 3660, 6, 2)])
+
+    def test_expand_stop_patterns(self):
+        stop_times_df = pl.DataFrame({
+            'trip_id': [1, 1, 1, 2, 2, 2, 3, 3],
+            'arrival_time': [100, 200, None, 300, 400, None, 90000, 90100],
+            'departure_time': [100, 210, 320, 300, 410, 520, 90000, 90130],
+            'stop_id': [5, 6, 7, 5, 6, 7, 8, 6],
+            'stop_sequence': [1, 2, 3, 1, 2, 3, 1, 2],
+        }).cast({'arrival_time': pl.Int32, 'departure_time': pl.Int32})
+        stop_patterns_df, trip_patterns_df = build_stop_patterns([stop_times_df])
+        self.assertEqual(trip_patterns_df['pattern_id'].n_unique(), 2)
+
+        # The stop times of any set of trips are rebuilt from their patterns
+        self.assertTrue(expand_stop_patterns(trip_patterns_df, stop_patterns_df).equals(stop_times_df))
+        self.assertTrue(expand_stop_patterns(trip_patterns_df.filter(pl.col('trip_id') == 2), stop_patterns_df)
+                        .equals(stop_times_df.filter(pl.col('trip_id') == 2)))
+
+    def test_resolve_feed_version(self):
+        feed_index = [
+            {'version': 'v1', 'published': '20231025', 'start_date': '20231030', 'end_date': '20240107'},
+            {'version': 'v2', 'published': '20231110', 'start_date': '20231101', 'end_date': '20240107'},
+            {'version': 'v3', 'published': '20240101', 'start_date': '20240108', 'end_date': '20240331'},
+        ]
+
+        def version(day):
+            return resolve_feed_version(feed_index, day)['version']
+
+        self.assertEqual(version(date(2023, 11, 5)), 'v1')  # v2 was not published yet
+        self.assertEqual(version(date(2023, 11, 10)), 'v2')
+        self.assertEqual(version(date(2024, 1, 7)), 'v2')  # v3 is published but not in effect yet
+        self.assertEqual(version(date(2024, 1, 8)), 'v3')
+        self.assertEqual(version(date(2023, 10, 30)), 'v1')
+        self.assertEqual(version(date(2024, 6, 1)), 'v3')  # No version covers the date: the last one
+        self.assertIsNone(resolve_feed_version([], date(2024, 6, 1)))
+
+    def test_build_service_index(self):
+        weekdays = {'monday': [1, 0], 'tuesday': [1, 0], 'wednesday': [1, 0], 'thursday': [1, 0], 'friday': [1, 0],
+                    'saturday': [0, 1], 'sunday': [0, 1]}
+        calendar_df = pl.DataFrame({'service_id': [1, 2], **weekdays, 'start_date': [20231113, 20231113],
+                                    'end_date': [20231119, 20231119]})
+        # Service 1 removed on Tuesday, services 2 and 3 added on Thursday
+        calendar_dates_df = pl.DataFrame({'service_id': [1, 2, 3], 'date': [20231114, 20231116, 20231116],
+                                          'exception_type': [2, 1, 1]})
+
+        service_index_df = build_service_index(calendar_df, calendar_dates_df)
+
+        days = service_index_df.group_by('date').agg(pl.col('service_id').sort()).sort('date')
+        self.assertEqual(days['date'].to_list(), [date(2023, 11, d) for d in range(13, 20) if d != 14])
+        self.assertEqual(days['service_id'].to_list(), [['1'], ['1'], ['1', '2', '3'], ['1'], ['2'], ['2']])
+        # calendar_dates alone is a valid calendar
+        self.assertEqual(build_service_index(None, calendar_dates_df).height, 2)
+
+    @patch('STM_Services.STM_Filter_Daily_GTFS_Static_files.main.os.remove')
+    def test_load_service_index_rebuilt_for_new_feed_version(self, mock_os_remove):
+        mock_s3 = mock.MagicMock()
+        mock_s3.get_object.side_effect = lambda Bucket, Key: (
+            {'Body': io.BytesIO(b'new version')} if Key == 'Last_modified.txt' else
+            {'Body': io.BytesIO(b'index'), 'Metadata': {'feed-version': 'old version'}})
+        calendar_dates_df = pl.DataFrame({'service_id': ['1'], 'date': ['20231116'], 'exception_type': [1]})
+
+        def download_file_to_tmp(bucket, key):
+            if key == 'calendar/calendar.parquet':
+                raise NO_SUCH_KEY
+            return key
+
+        service_index_df = load_service_index(mock_s3, 'input-bucket', 'output-bucket', download_file_to_tmp,
+                                              lambda path: calendar_dates_df)
+
+        self.assertEqual(service_index_df.rows(), [('1', date(2023, 11, 16))])
+        _, kwargs = mock_s3.put_object.call_args
+        self.assertEqual(kwargs['Metadata'], {'feed-version': 'new version'})
 
 if __name__ == '__main__':
     TestCase.main()
@@ -1,14 +1,27 @@
+import io
+import itertools
 import unittest
 import polars as pl
+import pyarrow.parquet as pq
+import pytz
+import time
+from botocore.exceptions import ClientError
+from datetime import datetime
 from unittest.mock import patch, MagicMock
 
-from STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main import download_from_s3, upload_to_s3, process_file, process_files, lambda_handler
+from STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main import (download_from_s3, upload_to_s3, process_file, process_files,
+                                                                     lambda_handler, read_parquet_schema, resolve_schema,
+                                                                     S3MultipartUpload, compact_hour, get_day_hour_starts,
+                                                                     read_row_groups, AdaptiveConcurrency, merge_sorted,
+                                                                     drop_repeated_observations, select_day_head,
+                                                                     VEHICLE_POSITIONS_SCHEMAS)
+from STM_Services.STM_Fetch_GTFS_VehiclePositions.main import (VEHICLE_POSITIONS_SCHEMA, VEHICLE_POSITIONS_SCHEMA_VERSION,
+                                                               MICRO_BATCH_SCHEMA_VERSION)
 
 class TestS3DataProcessing(unittest.TestCase):
     
-    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.boto3.client')
-    def test_download_from_s3_success(self, mock_boto3_client):
-        mock_s3 = mock_boto3_client.return_value
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.s3')
+    def test_download_from_s3_success(self, mock_s3):
         mock_response = {'Body': MagicMock(read=MagicMock(return_value=b'content'))}
         mock_s3.get_object.return_value = mock_response
 
@@ -20,35 +33,171 @@ class TestS3DataProcessing(unittest.TestCase):
             mock_read_parquet.assert_called_once()
             self.assertEqual(df.frame_equal(expected_df), True)
 
-    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.boto3.client')
-    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.os.remove')
-    def test_upload_to_s3_success(self, mock_remove, mock_boto3_client):
-        mock_s3 = mock_boto3_client.return_value
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.time.sleep')
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.s3')
+    def test_download_from_s3_retries_throttled_get(self, mock_s3, mock_sleep):
+        buffer = io.BytesIO()
+        pl.DataFrame({'test': [1, 2, 3]}).write_parquet(buffer)
+        throttled = ClientError({'Error': {'Code': 'SlowDown'}}, 'GetObject')
+        mock_s3.get_object.side_effect = [throttled, {'Body': io.BytesIO(buffer.getvalue())}]
 
-        df_to_upload = pl.DataFrame({'test': [1, 2, 3]})
+        concurrency = AdaptiveConcurrency(8)
+        df = download_from_s3('bucket-name', 'file-key', concurrency)
 
-        with patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.pl.DataFrame.write_parquet', return_value=None) as mock_write_parquet:
-            upload_to_s3('bucket-name', 'file-key', df_to_upload)
+        self.assertEqual(df['test'].to_list(), [1, 2, 3])
+        self.assertEqual(mock_s3.get_object.call_count, 2)
+        self.assertEqual(concurrency.throttled, 1)
+        self.assertEqual(concurrency.limit, 6)
+
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.time.perf_counter')
+    def test_adaptive_concurrency(self, mock_perf_counter):
+        # Each window of requests takes the same time, so a bigger window has a better throughput
+        mock_perf_counter.side_effect = itertools.count(step=0.5)
+        concurrency = AdaptiveConcurrency(2, maximum=16)
+
+        # Slow start: the limit doubles after each window of requests with a better throughput
+        for _ in range(2 + 4):
+            concurrency.on_success(1000)
+        self.assertEqual(concurrency.limit, 8)
+
+        # The GETs throttled together only cut the limit once
+        concurrency.on_throttle()
+        concurrency.on_throttle()
+        self.assertEqual(concurrency.limit, 6)
+        self.assertEqual(concurrency.throttled, 2)
+        self.assertFalse(concurrency.slow_start)
+
+        # Then it grows by one, up to the maximum
+        for _ in range(6 + 7):
+            concurrency.on_success(1000)
+        self.assertEqual(concurrency.limit, 8)
+
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.process_file')
+    def test_process_files_keeps_order(self, mock_process_file):
+        def slow_first_file(file_key, schema, source_bucket_name, concurrency):
+            # The first files take longer to download, they complete after the next ones
+            time.sleep(0.05 if file_key < 'key-03' else 0)
+            return pl.DataFrame({'key': [file_key]})
+
+        mock_process_file.side_effect = slow_first_file
+
+        file_keys = [f'key-{i:02d}' for i in range(20)]
+        dfs = list(process_files(file_keys, {'key': pl.Utf8}, 'bucket-name', 4))
+
+        self.assertEqual([df['key'][0] for df in dfs], file_keys)
+
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.s3')
+    def test_upload_to_s3_success(self, mock_s3):
+
+        schema = {'test': pl.Int64, 'timefetch': pl.Int64}
+        dfs = [pl.DataFrame({'test': [1, 2, 3], 'timefetch': [1, 1, 1]}),
+               pl.DataFrame({'test': [4, 5], 'timefetch': [2, 2]})]
+
+        rows = upload_to_s3('bucket-name', 'file-key', iter(dfs), schema, row_group_size=3)
+
+        # Smaller than a part, the file is stored with a single put_object
+        self.assertEqual(rows, 5)
+        mock_s3.create_multipart_upload.assert_not_called()
+        _, kwargs = mock_s3.put_object.call_args
+        self.assertEqual(kwargs['Key'], 'file-key')
+        self.assertIn('ChecksumSHA256', kwargs)
+        parquet_file = pq.ParquetFile(io.BytesIO(kwargs['Body']))
+        self.assertEqual(parquet_file.num_row_groups, 2)
+        self.assertEqual(pl.read_parquet(io.BytesIO(kwargs['Body']))['test'].to_list(), [1, 2, 3, 4, 5])
+
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.s3')
+    def test_upload_to_s3_row_group_statistics(self, mock_s3):
+        schema = {'test': pl.Int64, 'timefetch': pl.Int64}
+        dfs = [pl.DataFrame({'test': [1, 2], 'timefetch': [1, 2]}),
+               pl.DataFrame({'test': [3, 4, 5], 'timefetch': [3, 4, 5]})]
+
+        upload_to_s3('bucket-name', 'file-key', iter(dfs), schema, row_group_size=2)
+
+        # Row groups of exactly row_group_size rows, with min/max statistics on timefetch only
+        _, kwargs = mock_s3.put_object.call_args
+        metadata = pq.ParquetFile(io.BytesIO(kwargs['Body'])).metadata
+        self.assertEqual([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)], [2, 2, 1])
+        timefetch = [metadata.row_group(i).column(1).statistics for i in range(metadata.num_row_groups)]
+        self.assertEqual([(stats.min, stats.max) for stats in timefetch], [(1, 2), (3, 4), (5, 5)])
+        self.assertIsNone(metadata.row_group(0).column(0).statistics)
+
+    def test_merge_sorted(self):
+        sort_columns = ['trip', 'seq']
+        sources = [
+            [pl.DataFrame({'trip': [None, 1, 3], 'seq': [1, 1, 1]}), pl.DataFrame({'trip': [3, 7], 'seq': [2, 1]})],
+            [pl.DataFrame({'trip': [2, 3], 'seq': [1, 3]}), pl.DataFrame({'trip': [5, 5, 9], 'seq': [1, 2, 1]})],
+            [],
+        ]
+
+        chunks = list(merge_sorted([iter(source) for source in sources], sort_columns))
+
+        merged = pl.concat(chunks)
+        expected = pl.concat([df for source in sources for df in source]).sort(sort_columns, nulls_last=False)
+        self.assertTrue(merged.equals(expected))
+        # The first rows are emitted before the sources are read to the end
+        self.assertGreater(len(chunks), 2)
+
+    def test_multipart_upload(self):
+        mock_s3 = MagicMock()
+        mock_s3.create_multipart_upload.return_value = {'UploadId': 'upload-id'}
+        mock_s3.upload_part.side_effect = lambda **kwargs: {'ETag': f'etag-{kwargs["PartNumber"]}'}
+
+        sink = S3MultipartUpload(mock_s3, 'bucket-name', 'file-key', part_size=4)
+        sink.write(b'abcde')
+        sink.write(b'fg')
+        sink.close()
+
+        bodies = [kwargs['Body'] for _, kwargs in mock_s3.upload_part.call_args_list]
+        self.assertEqual(bodies, [b'abcde', b'fg'])
+        _, kwargs = mock_s3.complete_multipart_upload.call_args
+        self.assertEqual([part['ETag'] for part in kwargs['MultipartUpload']['Parts']], ['etag-1', 'etag-2'])
+        mock_s3.put_object.assert_not_called()
+
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.s3')
+    def test_upload_to_s3_failure_aborts_upload(self, mock_s3):
+        mock_s3.create_multipart_upload.return_value = {'UploadId': 'upload-id'}
+        mock_s3.upload_part.return_value = {'ETag': 'etag'}
+
+        def failing_dataframes():
+            yield pl.DataFrame({'test': list(range(100000)), 'timefetch': [1] * 100000})
+            raise RuntimeError('download failed')
+
+        with patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.MULTIPART_PART_SIZE', 1024):
+            with self.assertRaises(RuntimeError):
+                upload_to_s3('bucket-name', 'file-key', failing_dataframes(), {'test': pl.Int64, 'timefetch': pl.Int64},
+                             row_group_size=100000)
+
+        mock_s3.upload_part.assert_called()
+        mock_s3.abort_multipart_upload.assert_called_once_with(Bucket='bucket-name', Key='file-key', UploadId='upload-id')
+        mock_s3.complete_multipart_upload.assert_not_called()
 
-            # Verify write_parquet and upload_file are called as expected
-            mock_write_parquet.assert_called_once()
-            mock_s3.upload_file.assert_called_once_with('/tmp/file.parquet', 'bucket-name', 'file-key')
-            mock_remove.assert_called_once_with('/tmp/file.parquet')
-    
     @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.download_from_s3')
     def test_process_file_success(self, mock_download):
         mock_df = pl.DataFrame({'a': [1], 'b': [2]})
         mock_download.return_value = mock_df
 
         file_key = '20200101_123456.parquet'
-        all_columns = ['a', 'b', 'c', 'timefetch']
+        schema = {'a': pl.Int64, 'b': pl.Int64, 'c': pl.Utf8, 'timefetch': pl.Int64}
 
-        processed_df = process_file(file_key, all_columns, 'bucket-name')
+        processed_df = process_file(file_key, schema, 'bucket-name')
 
-        expected_columns = sorted(all_columns)
+        expected_columns = sorted(schema)
         self.assertEqual(processed_df.columns, expected_columns)
         self.assertIn('c', processed_df.columns)  
         self.assertIn('timefetch', processed_df.columns) 
+        self.assertEqual(processed_df.schema, schema)
+        self.assertEqual(processed_df['timefetch'].to_list(), [123456])
+
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.download_from_s3')
+    def test_process_file_casts_legacy_snapshot(self, mock_download):
+        # Snapshot written before the registry, the integers are strings
+        mock_download.return_value = pl.DataFrame({'id': ['1'], 'vehicle_timestamp': ['1700000000']})
+
+        schema = {'id': pl.Utf8, 'vehicle_timestamp': pl.Int64, 'timefetch': pl.Int64}
+        processed_df = process_file('2023/11/14/STM_GTFS_VehiclePositions_1700000005.parquet', schema, 'bucket-name')
+
+        self.assertEqual(processed_df['vehicle_timestamp'].to_list(), [1700000000])
+        self.assertEqual(processed_df['timefetch'].to_list(), [1700000005])
 
     @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.process_file')
     def test_process_files_success(self, mock_process_file):
@@ -56,34 +205,96 @@ class TestS3DataProcessing(unittest.TestCase):
         mock_process_file.return_value = mock_df
 
         file_keys = ['20200101_123456.parquet', '20200102_123456.parquet']
-        all_columns = ['a', 'b', 'c', 'timefetch']
+        schema = {'a': pl.Int64, 'b': pl.Int64, 'c': pl.Utf8, 'timefetch': pl.Int64}
 
-        processed_dfs = process_files(file_keys, all_columns, 'bucket-name', 2)  
+        processed_dfs = list(process_files(file_keys, schema, 'bucket-name', 2))
 
         self.assertEqual(len(processed_dfs), 2) 
         for df in processed_dfs:
-            self.assertEqual(df.columns, sorted(all_columns)) 
+            self.assertEqual(df.columns, sorted(schema)) 
+
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.s3')
+    def test_read_parquet_schema_from_footer(self, mock_s3):
+        buffer = io.BytesIO()
+        pl.DataFrame({'id': ['1'] * 10000, 'vehicle_timestamp': list(range(10000))}).write_parquet(buffer)
+        data = buffer.getvalue()
+
+        def ranged_get(Bucket, Key, Range):
+            start = int(Range.split('=-')[1])
+            return {'Body': MagicMock(read=MagicMock(return_value=data[-start:]))}
+
+        mock_s3.get_object.side_effect = ranged_get
+
+        schema = read_parquet_schema('bucket-name', 'file-key')
+
+        self.assertEqual(schema, {'id': pl.Utf8, 'vehicle_timestamp': pl.Int64})
+        # Only the end of the file is requested
+        for _, kwargs in mock_s3.get_object.call_args_list:
+            self.assertTrue(kwargs['Range'].startswith('bytes=-'))
+
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.read_parquet_schema')
+    def test_resolve_schema(self, mock_read_parquet_schema):
+        mock_read_parquet_schema.return_value = {'id': pl.Utf8, 'vehicle_timestamp': pl.Utf8, 'legacy': pl.Utf8}
+
+        file_keys = ['2023/11/14/STM_GTFS_VehiclePositions_1700000000.parquet',
+                     '2023/11/14/STM_GTFS_VehiclePositions_1700000060.v2.parquet',
+                     '2023/11/14/STM_GTFS_VehiclePositions_1700000120.v2.parquet',
+                     '2023/11/14/STM_GTFS_VehiclePositions_1700000180.v3.parquet']
+        schema = resolve_schema('bucket-name', file_keys)
+
+        # Only the file without a version is read, from its footer
+        mock_read_parquet_schema.assert_called_once_with('bucket-name', file_keys[0])
+        self.assertEqual(list(schema), sorted(schema))
+        self.assertEqual(schema['vehicle_timestamp'], pl.Int64)
+        self.assertEqual(schema['legacy'], pl.Utf8)
+        self.assertEqual(schema['timefetch'], pl.Int64)
+        # The bearings are not truncated
+        self.assertEqual(schema['vehicle_position_bearing'], pl.Float64)
+
+    def test_registry_matches_fetcher_schema(self):
+        self.assertEqual(VEHICLE_POSITIONS_SCHEMAS[VEHICLE_POSITIONS_SCHEMA_VERSION], VEHICLE_POSITIONS_SCHEMA)
+        self.assertEqual(VEHICLE_POSITIONS_SCHEMAS[MICRO_BATCH_SCHEMA_VERSION],
+                         {**VEHICLE_POSITIONS_SCHEMA, 'timefetch': pl.Int64})
 
     @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.upload_to_s3')
-    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.process_files')
-    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.download_from_s3')
-    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.boto3.client')
-    def test_lambda_handler_success(self, mock_boto3, mock_download, mock_process_files, mock_upload):
-        mock_s3_client = MagicMock()
-        mock_boto3.return_value = mock_s3_client
-        mock_s3_client.get_paginator.return_value.paginate.return_value = [{
-            'Contents': [{'Key': '20200101_123456.parquet'}]
-        }]
-
-        mock_download.return_value = pl.DataFrame({'a': [1], 'b': [2]})
-        mock_process_files.return_value = [pl.DataFrame({'a': [1], 'b': [2], 'c': [None], 'timefetch': [123456789]})]
-        mock_upload.return_value = None
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.read_row_groups')
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.read_parquet_schema')
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.compact_hour')
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.s3')
+    def test_lambda_handler_success(self, mock_s3_client, mock_compact_hour, mock_read_parquet_schema, mock_read_row_groups,
+                                    mock_upload):
+        # 2023-11-14 in Montreal: 24 hours starting at 05:00 UTC, the hour of 10:00 local was not compacted
+        hour_starts = [1699938000 + hour * 3600 for hour in range(24)]
+        part_keys = [f'2023/11/14/hourly/Hourly_GTFS_VehiclePosition_{unix}.parquet' for unix in hour_starts]
+        snapshot_keys = ['2023/11/14/STM_GTFS_VehiclePositions_1699974000.v2.parquet',
+                         '2023/11/14/STM_GTFS_VehiclePositions_1699977540.v2.parquet',
+                         '2023/11/14/STM_GTFS_VehiclePositions_1699977600.v2.parquet']
+
+        def paginate(Bucket, Prefix):
+            if Bucket == 'output-bucket':
+                return [{'Contents': [{'Key': key} for key in part_keys if key != part_keys[10]]}]
+            return [{'Contents': [{'Key': key} for key in snapshot_keys]}]
+
+        mock_s3_client.get_paginator.return_value.paginate.side_effect = paginate
+        # The part of 10:00 was compacted before the suppression of the repeated observations
+        mock_s3_client.head_object.side_effect = lambda Bucket, Key: {
+            'Metadata': {} if Key == part_keys[10] else {'suppressed-rows': '2'}}
+
+        mock_compact_hour.return_value = 100
+        schema = {'a': pl.Int64, 'timefetch': pl.Int64, 'vehicle_currentStopSequence': pl.Int64,
+                  'vehicle_trip_tripId': pl.Int64}
+        mock_read_parquet_schema.return_value = schema
+        mock_read_row_groups.side_effect = lambda bucket_name, key, schema: iter(
+            [pl.DataFrame({'a': [1], 'timefetch': [int(key.split('_')[-1].split('.')[0])],
+                           'vehicle_currentStopSequence': [1], 'vehicle_trip_tripId': [1]})])
+        merged = {}
+        mock_upload.side_effect = lambda bucket_name, key, dfs, schema: merged.setdefault(key, pl.concat(list(dfs)))
 
         event = {
             'input_bucket': 'input-bucket',
             'output_bucket': 'output-bucket',
-            'timezone': 'UTC',
-            'date': '20200101',
+            'timezone': 'America/Montreal',
+            'date': '20231115',
         }
 
         response = lambda_handler(event, None)
@@ -92,10 +303,179 @@ class TestS3DataProcessing(unittest.TestCase):
         self.assertIn('Data processing and upload completed successfully.', response['body'])
 
         # Verify mock calls
-        mock_boto3.assert_called_with('s3')
-        mock_download.assert_called()
-        mock_process_files.assert_called()
-        mock_upload.assert_called()
+        mock_s3_client.get_paginator.assert_called_with('list_objects_v2')
+        # Only the missing hour is compacted, with the snapshots fetched during this hour
+        mock_compact_hour.assert_called_once()
+        args, _ = mock_compact_hour.call_args
+        self.assertEqual(int(args[2].timestamp()), hour_starts[10])
+        self.assertEqual(args[3], snapshot_keys[:2])
+        # The daily file is the merge of the 24 sorted parts
+        self.assertEqual([args[1] for args, _ in mock_read_row_groups.call_args_list], part_keys)
+        self.assertEqual(mock_read_parquet_schema.call_count, 24)
+        self.assertEqual(list(merged), ['2023/11/14/Daily_GTFS_VehiclePosition_2023-11-14.parquet',
+                                        '2023/11/14/Daily_GTFS_VehiclePosition_2023-11-14_head.parquet'])
+        daily_df, head_df = merged.values()
+        self.assertEqual(daily_df['timefetch'].to_list(), hour_starts)
+        # The head has the rows fetched before 06:00, and the last row of the stop sequence fetched after it, with
+        # only the columns of the sort
+        head_rows = head_df.filter(pl.col('timefetch') < hour_starts[6])
+        self.assertTrue(head_rows.equals(daily_df.head(6)))
+        self.assertEqual(head_df.filter(pl.col('timefetch') >= hour_starts[6]).unique().rows(),
+                         [(None, hour_starts[23], 1, 1)])
+        self.assertEqual(head_df['timefetch'].to_list(), sorted(head_df['timefetch']))
+        self.assertEqual(response['observations'], 24 + 23 * 2)
+        self.assertEqual(response['suppressed_rows'], 46)
+        self.assertAlmostEqual(response['dedup_ratio'], 46 / 70)
+
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.compact_hour')
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.list_parquet_keys')
+    def test_lambda_handler_hourly(self, mock_list_parquet_keys, mock_compact_hour):
+        mock_list_parquet_keys.return_value = ['2023/11/14/STM_GTFS_VehiclePositions_1699973999.v2.parquet',
+                                               '2023/11/14/STM_GTFS_VehiclePositions_1699974000.v2.parquet',
+                                               '2023/11/14/STM_GTFS_VehiclePositions_1699977599.v3.parquet',
+                                               '2023/11/14/STM_GTFS_VehiclePositions_1699977600.v2.parquet']
+
+        event = {
+            'mode': 'hourly',
+            'hour': '2023111410',
+            'input_bucket': 'input-bucket',
+            'output_bucket': 'output-bucket',
+            'timezone': 'America/Montreal',
+        }
+
+        response = lambda_handler(event, None)
+
+        self.assertEqual(response['statusCode'], 200)
+        mock_list_parquet_keys.assert_called_once_with('input-bucket', '2023/11/14/')
+        args, _ = mock_compact_hour.call_args
+        self.assertEqual(int(args[2].timestamp()), 1699974000)
+        self.assertEqual(args[3], mock_list_parquet_keys.return_value[1:3])
+
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.upload_to_s3')
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.process_files')
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.resolve_schema')
+    def test_compact_hour(self, mock_resolve_schema, mock_process_files, mock_upload):
+        schema = {'id': pl.Int32, 'timefetch': pl.Int64, 'vehicle_currentStopSequence': pl.Int64,
+                  'vehicle_timestamp': pl.Int64, 'vehicle_trip_tripId': pl.Int64, 'vehicle_vehicle_id': pl.Utf8}
+        mock_resolve_schema.return_value = schema
+        snapshots = [
+            pl.DataFrame({'id': [3, 1], 'timefetch': [1699974000, 1699974000], 'vehicle_currentStopSequence': [4, 2],
+                          'vehicle_timestamp': [1699973990, 1699973950], 'vehicle_trip_tripId': [20, 10],
+                          'vehicle_vehicle_id': ['3', '1']}, schema=schema),
+            pl.DataFrame({'id': [2, 1, 3], 'timefetch': [1699974060] * 3, 'vehicle_currentStopSequence': [1, 2, 5],
+                          'vehicle_timestamp': [1699974050, 1699973950, 1699974055],
+                          'vehicle_trip_tripId': [None, 10, 20], 'vehicle_vehicle_id': ['2', '1', '3']}, schema=schema)]
+        mock_process_files.side_effect = lambda *args: iter(snapshots)
+        hour_start = pytz.timezone('America/Montreal').localize(datetime(2023, 11, 14, 10))
+
+        # One run for the hour, and one run per snapshot merged back
+        for run_size in [1024, 1]:
+            with self.subTest(run_size=run_size), \
+                    patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.RUN_SIZE', run_size):
+                uploaded = []
+                mock_upload.side_effect = lambda bucket_name, key, dfs, schema, row_group_size, metadata: \
+                    uploaded.append(pl.concat(list(dfs))) or 4
+
+                rows = compact_hour('input-bucket', 'output-bucket', hour_start, ['key-1', 'key-2'], 2)
+
+                self.assertEqual(rows, 4)
+                args, kwargs = mock_upload.call_args
+                # The key only depends on the hour, a rerun replaces the part
+                self.assertEqual(args[:2],
+                                 ('output-bucket', '2023/11/14/hourly/Hourly_GTFS_VehiclePosition_1699974000.parquet'))
+                # Sorted by trip (without trip first), stop sequence and timefetch, the vehicle 1 did not report again
+                part = uploaded[0]
+                self.assertEqual(part['id'].to_list(), [2, 1, 3, 3])
+                self.assertEqual(part['timefetch'].to_list(), [1699974060, 1699974000, 1699974000, 1699974060])
+                self.assertEqual(kwargs['metadata'], {'suppressed-rows': '1'})
+
+    def test_drop_repeated_observations(self):
+        dfs = [pl.DataFrame({'vehicle_vehicle_id': ['1', '1', '2'], 'vehicle_timestamp': [10, 10, None]}),
+               pl.DataFrame({'vehicle_vehicle_id': ['2', '3', '3'], 'vehicle_timestamp': [None, 20, 20]}),
+               pl.DataFrame({'vehicle_vehicle_id': ['3', '3'], 'vehicle_timestamp': [20, 30]})]
+        counts = {'observations': 0, 'suppressed_rows': 0}
+
+        kept = pl.concat(list(drop_repeated_observations(iter(dfs), counts)))
+
+        # The repetitions are dropped within and across the DataFrames, not the rows without timestamp
+        self.assertEqual(kept['vehicle_vehicle_id'].to_list(), ['1', '2', '2', '3', '3'])
+        self.assertEqual(kept['vehicle_timestamp'].to_list(), [10, None, None, 20, 30])
+        self.assertEqual(counts, {'observations': 8, 'suppressed_rows': 3})
+
+    def test_drop_repeated_observations_without_trip(self):
+        # Two hourly parts sorted by trip, stop sequence and timefetch: the vehicles without a trip go first, their
+        # rows interleaved by timefetch. The vehicle 7 is parked from one hour to the next.
+        schema = {'vehicle_trip_tripId': pl.Int64, 'vehicle_currentStopSequence': pl.Int64, 'timefetch': pl.Int64,
+                  'vehicle_vehicle_id': pl.Utf8, 'vehicle_timestamp': pl.Int64}
+        parts = [
+            [pl.DataFrame({'vehicle_trip_tripId': [None, None, None, None, 10],
+                           'vehicle_currentStopSequence': [None] * 4 + [3],
+                           'timefetch': [100, 100, 160, 160, 100],
+                           'vehicle_vehicle_id': ['7', '8', '7', '8', '9'],
+                           'vehicle_timestamp': [90, 95, 90, 155, 99]}, schema=schema)],
+            [pl.DataFrame({'vehicle_trip_tripId': [None, None, None, 10],
+                           'vehicle_currentStopSequence': [None] * 3 + [3],
+                           'timefetch': [3700, 3700, 3760, 3700],
+                           'vehicle_vehicle_id': ['7', '8', '7', '9'],
+                           'vehicle_timestamp': [90, 3690, 90, 3695]}, schema=schema)],
+        ]
+        counts = {'observations': 0, 'suppressed_rows': 0}
+
+        kept = pl.concat(list(drop_repeated_observations(
+            merge_sorted(parts, ['vehicle_trip_tripId', 'vehicle_currentStopSequence', 'timefetch']), counts)))
+
+        # The first observation of the vehicle 7 is kept once, for the two hours
+        self.assertEqual(kept.filter(pl.col('vehicle_vehicle_id') == '7')['timefetch'].to_list(), [100])
+        self.assertEqual(kept.filter(pl.col('vehicle_vehicle_id') == '8')['vehicle_timestamp'].to_list(),
+                         [95, 155, 3690])
+        self.assertEqual(counts, {'observations': 9, 'suppressed_rows': 3})
+
+    def test_select_day_head(self):
+        # Sorted rows of a day, the head ends at 15: the rows fetched after it are replaced by the last row of their
+        # stop sequence, in its place
+        df = pl.DataFrame({'vehicle_trip_tripId': [None, None, None, 7, 7, 7, 7, 7, 7],
+                           'vehicle_currentStopSequence': [1, 1, 1, 1, 1, 2, 2, 3, 3],
+                           'timefetch': [5, 20, 21, 3, 4, 30, 31, 10, 25],
+                           'vehicle_currentStatus': ['STOPPED_AT'] * 9},
+                          schema_overrides={'vehicle_trip_tripId': pl.Int64})
+
+        df_head = select_day_head(df, 15, ['vehicle_trip_tripId', 'vehicle_currentStopSequence', 'timefetch'])
+
+        self.assertEqual(df_head.schema, df.schema)
+        self.assertEqual(df_head.select('vehicle_trip_tripId', 'vehicle_currentStopSequence', 'timefetch').rows(),
+                         [(None, 1, 5), (None, 1, 21), (7, 1, 3), (7, 1, 4), (7, 2, 31), (7, 3, 10), (7, 3, 25)])
+        self.assertEqual(df_head['vehicle_currentStatus'].null_count(), 3)
+
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.upload_to_s3')
+    def test_compact_hour_without_snapshots(self, mock_upload):
+        hour_start = pytz.timezone('America/Montreal').localize(datetime(2023, 11, 14, 3))
+
+        self.assertEqual(compact_hour('input-bucket', 'output-bucket', hour_start, [], 2), 0)
+        mock_upload.assert_not_called()
+
+    @patch('STM_Services.STM_Merge_Daily_GTFS_VehiclePositions.main.s3')
+    def test_read_row_groups(self, mock_s3):
+        buffer = io.BytesIO()
+        pq.write_table(pl.DataFrame({'id': ['1', '2', '3'], 'timefetch': [1, 1, 2]}).to_arrow(), buffer, row_group_size=2)
+        body = io.BytesIO(buffer.getvalue())
+        body.read = MagicMock(wraps=body.read)
+        mock_s3.get_object.return_value = {'Body': body}
+
+        schema = {'id': pl.Utf8, 'timefetch': pl.Int64, 'vehicle_timestamp': pl.Int64}
+        dfs = list(read_row_groups('output-bucket', '2023/11/14/hourly/part-key.parquet', schema))
+
+        self.assertEqual([df.height for df in dfs], [2, 1])
+        for df in dfs:
+            self.assertEqual(df.schema, schema)
+        # The body is streamed to /tmp by chunks, never read whole in memory
+        self.assertTrue(all(call.args for call in body.read.call_args_list))
+
+    def test_get_day_hour_starts(self):
+        eastern = pytz.timezone('America/Montreal')
+        self.assertEqual(len(get_day_hour_starts(eastern.localize(datetime(2023, 11, 14)))), 24)
+        # End and start of the DST
+        self.assertEqual(len(get_day_hour_starts(eastern.localize(datetime(2023, 11, 5)))), 25)
+        self.assertEqual(len(get_day_hour_starts(eastern.localize(datetime(2024, 3, 10)))), 23)
 
 if __name__ == '__main__':
     unittest.main()
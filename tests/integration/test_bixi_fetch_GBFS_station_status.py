@@ -1,6 +1,4 @@
 import json
-import os
-import tempfile
 import unittest
 import io
 from unittest.mock import patch, MagicMock
@@ -9,9 +7,9 @@ from BIXI_Services.BIXI_Fetch_GBFS_Station_Status.main import lambda_handler
 class TestLambdaFunction(unittest.TestCase):
 
     @patch('BIXI_Services.BIXI_Fetch_GBFS_Station_Status.main.pd.DataFrame')
-    @patch('BIXI_Services.BIXI_Fetch_GBFS_Station_Status.main.boto3.client')
+    @patch('BIXI_Services.BIXI_Fetch_GBFS_Station_Status.main.s3')
     @patch('BIXI_Services.BIXI_Fetch_GBFS_Station_Status.main.urlopen')
-    def test_success_path(self, mock_urlopen, mock_boto3, mock_dataframe):
+    def test_success_path(self, mock_urlopen, mock_s3, mock_dataframe):
         response_data = json.dumps({
             "data": {"stations": [{"id": "1", "name": "Test Station"}]}
         }).encode('utf-8')
@@ -20,17 +18,10 @@ class TestLambdaFunction(unittest.TestCase):
         mock_response.read.return_value = response_data
         mock_urlopen.return_value = mock_response
 
-        mock_s3_client = MagicMock()
-        mock_boto3.return_value = mock_s3_client
-
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            temp_file_path = os.path.join(tmpdirname, 'file.parquet')
-            
-            lambda_handler({
-                'bucket_name': 'test-bucket', 
-                'url': 'http://test.url', 
-                'file_path': temp_file_path
-            }, None)
+        lambda_handler({
+            'bucket_name': 'test-bucket', 
+            'url': 'http://test.url'
+        }, None)
 
         # Verify that urlopen was called with the expected URL
         assert mock_urlopen.call_args[0][0].get_full_url() == 'http://test.url'
@@ -39,30 +30,26 @@ class TestLambdaFunction(unittest.TestCase):
         mock_dataframe.assert_called_once_with([{"id": "1", "name": "Test Station"}])
     
     @patch('BIXI_Services.BIXI_Fetch_GBFS_Station_Status.main.pd.DataFrame')
-    @patch('BIXI_Services.BIXI_Fetch_GBFS_Station_Status.main.boto3.client')
+    @patch('BIXI_Services.BIXI_Fetch_GBFS_Station_Status.main.s3')
     @patch('BIXI_Services.BIXI_Fetch_GBFS_Station_Status.main.urlopen')
-    def test_data_fetch_failure(self, mock_urlopen, mock_boto3, mock_dataframe):
+    def test_data_fetch_failure(self, mock_urlopen, mock_s3, mock_dataframe):
         mock_urlopen.side_effect = Exception("Simulated fetch failure")
 
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            temp_file_path = os.path.join(tmpdirname, 'file.parquet')
-
-            with self.assertRaises(Exception) as context:
-                lambda_handler({
-                    'bucket_name': 'test-bucket', 
-                    'url': 'http://test.url', 
-                    'file_path': temp_file_path
-                }, None)
+        with self.assertRaises(Exception) as context:
+            lambda_handler({
+                'bucket_name': 'test-bucket', 
+                'url': 'http://test.url'
+            }, None)
 
-            self.assertTrue("Simulated fetch failure" in str(context.exception))
+        self.assertTrue("Simulated fetch failure" in str(context.exception))
         
         # Verify that the DataFrame creation and S3 upload were not attempted due to the fetch failure
         mock_dataframe.assert_not_called()
-        mock_boto3.upload_file.assert_not_called()
+        mock_s3.put_object.assert_not_called()
     
-    @patch('BIXI_Services.BIXI_Fetch_GBFS_Station_Status.main.boto3.client')
+    @patch('BIXI_Services.BIXI_Fetch_GBFS_Station_Status.main.s3')
     @patch('BIXI_Services.BIXI_Fetch_GBFS_Station_Status.main.urlopen')
-    def test_upload_failure(self, mock_urlopen, mock_boto3):
+    def test_upload_failure(self, mock_urlopen, mock_s3):
         response_data = json.dumps({
              "data": {"stations": [{"id": "1", "name": "Test Station"}]}
         }).encode('utf-8')
@@ -71,27 +58,24 @@ class TestLambdaFunction(unittest.TestCase):
         mock_response.read.return_value = response_data
         mock_urlopen.return_value = mock_response    
         
-        mock_s3_client = MagicMock()
-        mock_boto3.return_value = mock_s3_client
-
         # Simulate failure to upload to S3
-        mock_s3_client.upload_file.side_effect = Exception("Simulated S3 upload failure")
+        mock_s3.put_object.side_effect = Exception("Simulated S3 upload failure")
 
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            temp_file_path = os.path.join(tmpdirname, 'file.parquet')
-            with patch('sys.stdout', new_callable=io.StringIO) as mock_stdout:
-                lambda_handler({
-                    'bucket_name': 'test-bucket', 
-                    'url': 'http://test.url', 
-                    'file_path': temp_file_path
-                }, None)
+        with patch('sys.stdout', new_callable=io.StringIO) as mock_stdout:
+            lambda_handler({
+                'bucket_name': 'test-bucket', 
+                'url': 'http://test.url'
+            }, None)
 
 
         # Check if the correct error message was printed
         self.assertIn("Failed to upload to S3: Simulated S3 upload failure", mock_stdout.getvalue())
 
-        # Verify that upload_file was indeed called
-        mock_s3_client.upload_file.assert_called_once()
+        # Verify that put_object was indeed called, with the checksum of the in-memory file
+        mock_s3.put_object.assert_called_once()
+        _, kwargs = mock_s3.put_object.call_args
+        self.assertEqual(kwargs['Key'].split('/')[-1][:25], 'gbfs_data_station_status_')
+        self.assertIn('ChecksumSHA256', kwargs)
 
 
 if __name__ == '__main__':